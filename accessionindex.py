@@ -0,0 +1,96 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+import schemacache
+
+
+class AccessionIndex:
+    def __init__(self, meta_structure, cache_dir=schemacache.DEFAULT_CACHE_DIR):
+        """
+        A local copy of the system and user accessions of all the records in a database, one json file per server url next to the schema cache.
+
+        It is downloaded with refresh, a cypher query per sheet, and used by the offline validation of submission.py instead of the database:
+        Validator.duplication_check takes it in place of a Poster, and Validator.link_check looks up the linked accessions in it.
+        :param: meta_structure - the MetaStructure obj, the cache file is the one of its url.
+        :param: cache_dir - the directory to keep the json files.
+        """
+        self.meta_structure = meta_structure
+        self.url = meta_structure.url
+        self.cache_dir = cache_dir
+        self.user_name = None
+        self.saved_time = None
+        self.system_accessions = dict()  # category -> set of the system accessions of all the users.
+        self.user_records = dict()  # category -> a list of (system accession, user accession) of the records of user_name.
+        self.user_accessions = dict()  # category -> set of the user accessions of user_name.
+
+    def get_path(self):
+        """Return the path of the cache file of the server url."""
+        name = hashlib.sha1(self.url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "accessions_" + name + ".json")
+
+    def load(self):
+        """Read the cache file, returns False if there is none."""
+        path = self.get_path()
+        try:
+            with open(path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError) as error:
+            logging.debug("Unable to read accession cache %s: %s" % (path, error))
+            return False
+        if cached.get("url") != self.url:
+            return False
+        self._set(cached["user"], cached["time"], cached["categories"])
+        logging.info("Loaded %d accessions of %s saved at %s." % (sum(len(x) for x in self.system_accessions.values()), self.url, time.ctime(self.saved_time)))
+        return True
+
+    def refresh(self, db_poster):
+        """Download the accessions of every sheet with Poster.fetch_all_accession, it needs a cypher key. Then save them to the cache file."""
+        meta_structure = self.meta_structure
+        categories = dict()
+        for sheet_name in meta_structure.schema_dict.keys():
+            records = db_poster.fetch_all_accession(sheet_name)
+            categories[meta_structure.get_category(sheet_name)] = [[x["system_accession"], x["user_accession"], x["user"]] for x in records]
+        self._set(db_poster.user_name, time.time(), categories)
+        self.save(categories)
+
+    def save(self, categories):
+        path = self.get_path()
+        cached = {"url": self.url,
+                  "user": self.user_name,
+                  "time": self.saved_time,
+                  "categories": categories
+                  }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump(cached, cache_file)
+            os.replace(temp_path, path)  # never leave a half written cache.
+        except (IOError, OSError) as error:
+            logging.warning("Unable to write accession cache %s: %s" % (path, error))
+
+    def _set(self, user_name, saved_time, categories):
+        self.user_name = user_name
+        self.saved_time = saved_time
+        self.system_accessions = dict()
+        self.user_records = dict()
+        self.user_accessions = dict()
+        for category, records in categories.items():
+            self.system_accessions[category] = set(x[0] for x in records)
+            self.user_records[category] = [(x[0], x[1]) for x in records if x[2] == user_name]
+            self.user_accessions[category] = set(x[1] for x in self.user_records[category])
+
+    def fetch_user_accession(self, sheet_name):
+        """Same as Poster.fetch_user_accession, from the cache: a list of {accession, user_accession} of the user's records in a sheet."""
+        user_records = self.user_records.get(self.meta_structure.get_category(sheet_name), [])
+        return [{"accession": system_accession, "user_accession": user_accession} for system_accession, user_accession in user_records]
+
+    def has_system_accession(self, category, accession):
+        return accession in self.system_accessions.get(category, ())
+
+    def has_user_accession(self, category, accession):
+        """If the user has a record of the user accession in the category."""
+        return accession in self.user_accessions.get(category, ())
@@ -0,0 +1,116 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+
+import schemacache
+
+FULL_SYNC_AGE = 24 * 3600  # seconds, a category is downloaded again in full once a day, so deleted records go away.
+
+
+class AccessionMirror:
+    def __init__(self, meta_structure, cache_dir=schemacache.DEFAULT_CACHE_DIR, full_sync_age=FULL_SYNC_AGE):
+        """
+        A local SQLite copy of (category, user, user accession, system accession, date_modified) of all the records in a database, one file per server url.
+
+        It is kept up to date by sync, which only downloads the records changed since the last sync, and queried instead of the database:
+        Validator.duplication_check takes it in place of a Poster, BookData.resolve looks up the user accessions not in the workbook,
+        and Validator.link_check takes it in place of an accessionindex.AccessionIndex.
+        :param: meta_structure - the MetaStructure obj, the file is the one of its url.
+        :param: cache_dir - the directory to keep the SQLite files.
+        :param: full_sync_age - download a category in full if its last full download is older than this many seconds.
+        """
+        self.meta_structure = meta_structure
+        self.url = meta_structure.url
+        self.path = os.path.join(cache_dir, "accessions_" + hashlib.sha1(self.url.encode("utf-8")).hexdigest()[:16] + ".sqlite")
+        self.full_sync_age = full_sync_age
+        self._lock = threading.Lock()  # one connection shared by the submitter threads.
+        os.makedirs(cache_dir, exist_ok=True)
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS accessions (category TEXT NOT NULL, system_accession TEXT NOT NULL, "
+                                     "user_accession TEXT, user TEXT, date_modified TEXT, PRIMARY KEY (category, system_accession))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS user_accessions ON accessions (category, user_accession, user)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS sync (category TEXT PRIMARY KEY, date_modified TEXT, accession TEXT, full_sync_time REAL)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)")
+        self.user_name = self._get_setting("user")
+
+    def close(self):
+        self._connection.close()
+
+    def is_empty(self):
+        return self._query_one("SELECT COUNT(*) FROM sync")[0] == 0
+
+    def sync(self, db_poster):
+        """
+        Download the records changed since the last sync of every sheet with Poster.fetch_accession_changes, it needs a cypher key.
+
+        The high-water marks are the latest date_modified and the last system accession seen in a category.
+        :return: the number of records downloaded.
+        """
+        meta_structure = self.meta_structure
+        if db_poster.user_name != self.user_name:
+            self.user_name = db_poster.user_name
+            self._set_setting("user", self.user_name)
+        downloaded = 0
+        for sheet_name in meta_structure.schema_dict.keys():
+            category = meta_structure.get_category(sheet_name)
+            mark = self._query_one("SELECT date_modified, accession, full_sync_time FROM sync WHERE category = ?", (category,))
+            full = mark is None or mark[2] is None or time.time() - mark[2] > self.full_sync_age
+            if full:
+                records = db_poster.fetch_accession_changes(sheet_name)
+                date_modified, accession, full_sync_time = None, None, time.time()
+            else:
+                date_modified, accession, full_sync_time = mark
+                records = db_poster.fetch_accession_changes(sheet_name, date_modified, accession)
+            for x in records:
+                if x["date_modified"] is not None and (date_modified is None or x["date_modified"] > date_modified):
+                    date_modified = x["date_modified"]
+                if accession is None or (len(x["system_accession"]), x["system_accession"]) > (len(accession), accession):
+                    accession = x["system_accession"]
+            with self._lock, self._connection:
+                if full:
+                    self._connection.execute("DELETE FROM accessions WHERE category = ?", (category,))
+                self._connection.executemany("INSERT OR REPLACE INTO accessions VALUES (?, ?, ?, ?, ?)",
+                                             [(category, x["system_accession"], x["user_accession"], x["user"], x["date_modified"]) for x in records])
+                self._connection.execute("INSERT OR REPLACE INTO sync VALUES (?, ?, ?, ?)", (category, date_modified, accession, full_sync_time))
+            logging.debug("%s %d records of %s to the accession mirror." % ("Downloaded" if full else "Synced", len(records), category))
+            downloaded += len(records)
+        logging.info("Synced the accession mirror %s: %d records downloaded." % (self.path, downloaded))
+        return downloaded
+
+    def fetch_user_accession(self, sheet_name):
+        """Same as Poster.fetch_user_accession, from the mirror: a list of {accession, user_accession} of the user's records in a sheet."""
+        rows = self._query("SELECT system_accession, user_accession FROM accessions WHERE category = ? AND user = ?",
+                           (self.meta_structure.get_category(sheet_name), self.user_name))
+        return [{"accession": system_accession, "user_accession": user_accession} for system_accession, user_accession in rows]
+
+    def get_system_accession(self, category, user_accession):
+        """Return the system accession of the user's record with user_accession, None if there is none."""
+        row = self._query_one("SELECT system_accession FROM accessions WHERE category = ? AND user_accession = ? AND user = ?", (category, user_accession, self.user_name))
+        return None if row is None else row[0]
+
+    def has_system_accession(self, category, accession):
+        return self._query_one("SELECT 1 FROM accessions WHERE category = ? AND system_accession = ?", (category, accession)) is not None
+
+    def has_user_accession(self, category, accession):
+        """If the user has a record of the user accession in the category."""
+        return self.get_system_accession(category, accession) is not None
+
+    def _get_setting(self, name):
+        row = self._query_one("SELECT value FROM settings WHERE name = ?", (name,))
+        return None if row is None else row[0]
+
+    def _set_setting(self, name, value):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (name, value))
+
+    def _query(self, statement, params=()):
+        with self._lock:
+            return self._connection.execute(statement, params).fetchall()
+
+    def _query_one(self, statement, params=()):
+        with self._lock:
+            return self._connection.execute(statement, params).fetchone()
@@ -0,0 +1,113 @@
+# bench_column_index.py
+# Per-cell cost of the column lookups used by RowData.add and Validator.cell_value_audit on a wide sheet,
+# comparing the old linear scans with the MetaStructure.sheet_index lookups.
+# Usage: python3 benchmarks/bench_column_index.py --columns 200 --links 40 --rows 200
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import metastructure  # noqa: E402
+import schemacache  # noqa: E402
+import rowdata  # noqa: E402
+
+SHEET_NAME = "Widesheet"
+CATEGORY = "widesheet"
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--columns', action="store", dest="columns", type=int, default=200, help="number of schema columns.\n")
+    parser.add_argument('--links', action="store", dest="links", type=int, default=40, help="number of relationship columns.\n")
+    parser.add_argument('--rows', action="store", dest="rows", type=int, default=200, help="number of rows.\n")
+    return parser.parse_args()
+
+
+def wide_meta_structure(columns, links):
+    """Build a MetaStructure with one wide sheet from a temporary schema cache, without any connection."""
+    schema = [{"name": "user_accession", "text": "User accession", "type": "text", "required": False}]
+    schema += [{"name": "field_%d" % i, "text": "Field %d" % i, "type": "text", "required": False} for i in range(columns)]
+    connections = [{"name": "link_%d" % i, "display_name": "Link %d" % i, "to": CATEGORY, "all": CATEGORY + "s", "placeholder": ""} for i in range(links)]
+    link = {"one": CATEGORY, "all": CATEGORY + "s", "prefix": "TRGTWID000", "usr_prefix": "USRWID000", "connections": connections}
+    cache = schemacache.SchemaCache(tempfile.mkdtemp())
+    url = metastructure.TESTURL_META
+    cache.save(url, [CATEGORY], {"current": "bench"}, {SHEET_NAME: schema}, {SHEET_NAME: link})
+    return metastructure.MetaStructure(all_categories=[CATEGORY], schema_cache=cache, offline=True)
+
+
+class LegacyLookup:
+    """The linear scans MetaStructure used before the sheet index, kept here as the baseline."""
+    def __init__(self, meta_structure):
+        self.meta_structure = meta_structure
+
+    def get_schema_column_headers(self, sheet_name):
+        return [x["text"] for x in self.meta_structure.get_sheet_schema(sheet_name)]
+
+    def get_link_column_headers(self, sheet_name):
+        return [x["display_name"] for x in self.meta_structure.get_sheet_link(sheet_name)["connections"]]
+
+    def get_column_dict(self, sheet_name, column_header):
+        if column_header in self.get_schema_column_headers(sheet_name):
+            return [x for x in self.meta_structure.get_sheet_schema(sheet_name) if x["text"] == column_header][0]
+        return [x for x in self.meta_structure.get_sheet_link(sheet_name)["connections"] if x["display_name"] == column_header][0]
+
+    def get_linkto(self, sheet_name, column_header):
+        category = [x["to"] for x in self.meta_structure.get_sheet_link(sheet_name)["connections"] if x["display_name"] == column_header][0]
+        return self.meta_structure.category_to_sheet_name[category]
+
+
+def legacy_cell(lookup, column_header):
+    """The lookups of one RowData.add plus one cell_value_audit before the sheet index."""
+    lookup.get_column_dict(SHEET_NAME, column_header)["name"]  # get_column_name
+    if column_header in lookup.get_link_column_headers(SHEET_NAME):
+        lookup.get_linkto(SHEET_NAME, column_header)
+    elif column_header in lookup.get_schema_column_headers(SHEET_NAME):
+        pass
+    lookup.get_column_dict(SHEET_NAME, column_header).get("type")  # cell_value_audit
+
+
+def indexed_cell(meta_structure, column_header):
+    """The same lookups with the sheet index."""
+    meta_structure.get_column_name(SHEET_NAME, column_header)
+    if meta_structure.is_link_column(SHEET_NAME, column_header):
+        meta_structure.get_linkto(SHEET_NAME, column_header)
+    elif meta_structure.is_schema_column(SHEET_NAME, column_header):
+        pass
+    meta_structure.get_column_dict(SHEET_NAME, column_header).get("type")
+
+
+def per_cell(cell, lookup, headers, rows):
+    """Returns seconds per cell."""
+    start = time.perf_counter()
+    for _ in range(rows):
+        for column_header in headers:
+            cell(lookup, column_header)
+    return (time.perf_counter() - start) / (rows * len(headers))
+
+
+def main():
+    args = get_args()
+    meta_structure = wide_meta_structure(args.columns, args.links)
+    headers = meta_structure.get_all_column_headers(SHEET_NAME)
+    before = per_cell(legacy_cell, LegacyLookup(meta_structure), headers, args.rows)
+    after = per_cell(indexed_cell, meta_structure, headers, args.rows)
+    print("%d columns x %d rows" % (len(headers), args.rows))
+    print("before: %.2f us per cell" % (before * 1e6))
+    print("after:  %.2f us per cell" % (after * 1e6))
+    print("speedup: %.1fx" % (before / after))
+
+    # RowData.add end to end with the index.
+    start = time.perf_counter()
+    for _ in range(args.rows):
+        row_data = rowdata.RowData(SHEET_NAME, meta_structure)
+        for column_header in headers:
+            row_data.add(column_header, "")
+    print("RowData.add: %.2f us per cell" % ((time.perf_counter() - start) / (args.rows * len(headers)) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
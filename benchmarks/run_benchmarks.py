@@ -0,0 +1,193 @@
+# run_benchmarks.py
+# Time the hot paths of a submission on generated workbooks of growing size, and write the timings as json.
+# Everything runs against an in-process fakeserver.FakeServer, no network is needed.
+# Usage: python3 benchmarks/run_benchmarks.py --sizes 1000,10000,100000 --stream -o results.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import tempfile
+import datetime
+
+import xlrd
+import xlsxwriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import metastructure  # noqa: E402
+import sheetreader  # noqa: E402
+import validator  # noqa: E402
+import bookdata  # noqa: E402
+import poster  # noqa: E402
+import fakeserver  # noqa: E402
+import xlsxreader  # noqa: E402
+import linkgraph  # noqa: E402
+import workbook_generator  # noqa: E402
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', action="store", dest="sizes", default="1000,10000,100000", help="comma separated rows per sheet to run. default is 1000,10000,100000.\n")
+    parser.add_argument('--sheets', action="store", dest="sheets", default=",".join(workbook_generator.DEFAULT_SHEETS), help="comma separated sheets to fill.\n")
+    parser.add_argument('--link-density', action="store", dest="link_density", type=float, default=0.5, help="see workbook_generator.py. default is 0.5.\n")
+    parser.add_argument('--restricted-fraction', action="store", dest="restricted_fraction", type=float, default=0.5, help="see workbook_generator.py. default is 0.5.\n")
+    parser.add_argument('--existing-records', action="store", dest="existing_records", type=int, default=1000,
+                        help="number of records already in the database per category, half of them belong to the user. default is 1000.\n")
+    parser.add_argument('--stream', '-s', action="store_true", dest="stream", help="read the workbooks with xlsxreader instead of xlrd.\n")
+    parser.add_argument('--output', '-o', action="store", dest="output", help="write the results to this json file, instead of stdout.\n")
+    parser.add_argument('--keep', action="store", dest="keep", help="keep the generated workbooks in this directory.\n")
+    return parser.parse_args()
+
+
+class Timer:
+    def __init__(self):
+        """Collect the seconds and the number of items of every named step."""
+        self.timings = dict()
+
+    def time(self, name, items, action, *args):
+        start = time.perf_counter()
+        result = action(*args)
+        seconds = time.perf_counter() - start
+        self.timings[name] = {"seconds": round(seconds, 6),
+                              "items": items,
+                              "items_per_second": round(items / seconds, 1) if seconds > 0 else None
+                              }
+        return result
+
+
+def open_workbook(file_name, stream):
+    return xlsxreader.StreamingBook(file_name) if stream else xlrd.open_workbook(file_name)
+
+
+def load_sheets(workbook, sheet_names):
+    """Returns {sheet_name: sheet_obj}, xlsxreader parses the worksheets here."""
+    return {x: workbook.sheet_by_name(x) for x in sheet_names}
+
+
+def read_book(meta_structure, workbook, sheets):
+    reader = sheetreader.SheetReader(meta_structure)
+    book_data = bookdata.BookData(meta_structure)
+    for sheet_name, sheet_obj in sheets.items():
+        sheet_data, validation = reader.read_sheet(sheet_obj, workbook.datemode)
+        if not validation:
+            raise validator.ValidatorError("generated sheet %s is not valid!" % sheet_name)
+        book_data.add_sheet(sheet_data)
+    return book_data
+
+
+def audit_cells(meta_structure, workbook, sheets):
+    """Validator.cell_value_audit on every cell, one call per cell."""
+    data_validator = validator.Validator(meta_structure)
+    reader = sheetreader.SheetReader(meta_structure)
+    for sheet_name, sheet_obj in sheets.items():
+        column_headers = reader.get_sheet_headers(sheet_obj)
+        for row in range(reader.excel_data_start_row, sheet_obj.nrows):
+            for col, column_header in enumerate(column_headers):
+                data_validator.cell_value_audit(sheet_name, column_header, sheet_obj.cell(row, col), workbook.datemode)
+
+
+def audit_columns(meta_structure, workbook, sheets):
+    """Validator.get_column_batch_audit on every column, one call per column."""
+    data_validator = validator.Validator(meta_structure)
+    reader = sheetreader.SheetReader(meta_structure)
+    for sheet_name, sheet_obj in sheets.items():
+        for col, column_header in enumerate(reader.get_sheet_headers(sheet_obj)):
+            column_audit = data_validator.get_column_batch_audit(sheet_name, column_header)
+            column_audit(sheet_obj.col_values(col, reader.excel_data_start_row), sheet_obj.col_types(col, reader.excel_data_start_row), workbook.datemode)
+
+
+def audit_rows(meta_structure, book_data):
+    data_validator = validator.Validator(meta_structure)
+    for sheet_data in book_data.data.values():
+        for record in sheet_data.all_records:
+            data_validator.row_value_audit(record)
+
+
+def check_duplication(meta_structure, db_poster, book_data):
+    data_validator = validator.Validator(meta_structure)
+    for sheet_data in book_data.data.values():
+        data_validator.duplication_check(db_poster, sheet_data)
+
+
+def get_waves(book_data):
+    return linkgraph.LinkGraph(book_data).get_waves()
+
+
+def write_book(meta_structure, book_data, file_name):
+    workbook = xlsxwriter.Workbook(file_name, {"constant_memory": True})
+    reader = sheetreader.SheetReader(meta_structure)
+    reader.write_book_header(workbook)
+    reader.write_book(workbook, book_data)
+    workbook.close()
+
+
+def run(args, rows, sheet_names, work_dir):
+    """Returns the result of one size."""
+    existing = args.existing_records // 2
+    with fakeserver.FakeServer(records=existing, foreign_records=args.existing_records - existing) as server:
+        meta_structure = metastructure.MetaStructure(meta_url=server.url, submit_url=server.url)
+        workbook_generator.restrict_columns(meta_structure, sheet_names, args.restricted_fraction)
+        db_poster = poster.Poster("benchmark", "benchmark", False, False, meta_structure, server.cypher_url)
+        file_name = os.path.join(work_dir, "generated_%d.xlsx" % rows)
+        total_rows = rows * len(sheet_names)
+        timer = Timer()
+        timer.time("generate", total_rows, workbook_generator.write_workbook, meta_structure, file_name, rows, sheet_names, args.link_density)
+        workbook = timer.time("open_workbook", total_rows, open_workbook, file_name, args.stream)
+        sheets = timer.time("load_sheets", total_rows, load_sheets, workbook, sheet_names)
+        cells = sum(len(meta_structure.get_all_column_headers(x)) for x in sheet_names) * rows
+        timer.time("cell_value_audit", cells, audit_cells, meta_structure, workbook, sheets)
+        timer.time("column_batch_audit", cells, audit_columns, meta_structure, workbook, sheets)
+        book_data = timer.time("read_sheet", total_rows, read_book, meta_structure, workbook, sheets)
+        timer.time("row_value_audit", total_rows, audit_rows, meta_structure, book_data)
+        timer.time("duplication_check", total_rows, check_duplication, meta_structure, db_poster, book_data)
+        timer.time("link_graph", total_rows, get_waves, book_data)
+        timer.time("swipe_accession", total_rows, book_data.swipe_accession)
+        timer.time("write_book", total_rows, write_book, meta_structure, book_data, os.path.join(work_dir, "written_%d.xlsx" % rows))
+        if hasattr(workbook, "release_resources"):
+            workbook.release_resources()
+    return {"rows_per_sheet": rows,
+            "rows": total_rows,
+            "cells": cells,
+            "file_bytes": os.path.getsize(file_name),
+            "timings": timer.timings
+            }
+
+
+def main():
+    args = get_args()
+    logging.getLogger().setLevel(logging.WARNING)  # SheetReader.write_book logs every row.
+    sheet_names = args.sheets.split(",")
+    work_dir = args.keep or tempfile.mkdtemp(prefix="bulkupload_benchmark_")
+    os.makedirs(work_dir, exist_ok=True)
+    results = {"date": datetime.datetime.now().isoformat(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "reader": "xlsxreader" if args.stream else "xlrd",
+               "sheets": sheet_names,
+               "link_density": args.link_density,
+               "restricted_fraction": args.restricted_fraction,
+               "existing_records": args.existing_records,
+               "results": []
+               }
+    try:
+        for rows in [int(x) for x in args.sizes.split(",")]:
+            logging.warning("benchmarking %d rows per sheet." % rows)
+            results["results"].append(run(args, rows, sheet_names, work_dir))
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir)
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
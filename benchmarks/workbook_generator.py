@@ -0,0 +1,136 @@
+# workbook_generator.py
+# Write schema valid workbooks of any size, with the same headers as populate_metadata_Excel.py (SheetReader.write_book_header).
+# The structure comes from --server, or from an in-process fakeserver.FakeServer if it is not provided.
+# Usage: python3 benchmarks/workbook_generator.py -x big.xlsx --rows 10000 --sheets Bioproject,Litter,Mouse,Biosample --link-density 0.8
+
+import os
+import sys
+import random
+import argparse
+import datetime
+
+import xlsxwriter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import metastructure  # noqa: E402
+import sheetreader  # noqa: E402
+import fakeserver  # noqa: E402
+
+DEFAULT_SHEETS = ["Bioproject", "Litter", "Mouse", "Biosample"]
+
+# Columns checked by Validator.row_value_audit, filled with fixed valid values and never restricted by restrict_columns.
+FIXED_VALUES = {
+    "Biosample": {"tissue": "Liver", "tissue_classification": "Target", "collection_protocol": "NA", "cell_culture_protocol": "NA", "culture_length": "NA", "passage_number": 0},
+    "File": {"run_type": "single-end", "pair": "NA", "paired_file": ""},
+    "Mouse": {"fasted": "No", "fasted_hours": 0},
+}
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--excel', '-x', action="store", dest="excel", required=True, help="The excel file to write. Required.\n")
+    parser.add_argument('--rows', action="store", dest="rows", type=int, default=1000, help="number of rows per sheet. default is 1000.\n")
+    parser.add_argument('--sheets', action="store", dest="sheets", default=",".join(DEFAULT_SHEETS), help="comma separated sheets to fill. default is %s.\n" % ",".join(DEFAULT_SHEETS))
+    parser.add_argument('--link-density', action="store", dest="link_density", type=float, default=0.5,
+                        help="the chance a relationship cell links to a record in the workbook. default is 0.5.\n")
+    parser.add_argument('--restricted-fraction', action="store", dest="restricted_fraction", type=float, default=0,
+                        help="the fraction of free text columns turned into restricted vocabulary columns. default is 0.\n")
+    parser.add_argument('--vocabulary-size', action="store", dest="vocabulary_size", type=int, default=20, help="number of values of a restricted column. default is 20.\n")
+    parser.add_argument('--seed', action="store", dest="seed", type=int, default=0, help="random seed. default is 0.\n")
+    parser.add_argument('--server', action="store", dest="server", help="get the structure from this server instead of the built-in one.\n")
+    return parser.parse_args()
+
+
+def get_meta_structure(server=None):
+    """Return (meta_structure, fake_server). fake_server is None with a server url, otherwise stop it once done."""
+    fake_server = None
+    if server is None:
+        fake_server = fakeserver.FakeServer().start()
+        server = fake_server.url
+    return metastructure.MetaStructure(meta_url=server, submit_url=server), fake_server
+
+
+def restrict_columns(meta_structure, sheet_names, fraction, vocabulary_size=20, seed=0):
+    """
+    Turn a fraction of the free text columns of the sheets into restricted vocabulary columns, in place.
+
+    Call it before reading or writing any workbook with the meta_structure, so the workbook, the reader and the validator agree.
+    :return: the number of columns changed.
+    """
+    generator = random.Random(seed)
+    changed = 0
+    for sheet_name in sheet_names:
+        fixed = FIXED_VALUES.get(sheet_name, {})
+        for column_dict in meta_structure.get_sheet_schema(sheet_name)[2:]:  # skip the accessions.
+            if column_dict["type"] != "text" or "values" in column_dict or column_dict["name"] in fixed:
+                continue
+            if generator.random() < fraction:
+                column_dict["values"] = ["%s_%d" % (column_dict["name"], i) for i in range(vocabulary_size)]
+                column_dict["values_restricted"] = True
+                changed += 1
+    return changed
+
+
+def get_user_accession(meta_structure, sheet_name, row):
+    return meta_structure.get_user_accession_rule(sheet_name) + "%06d" % row
+
+
+def write_workbook(meta_structure, file_name, rows, sheet_names=DEFAULT_SHEETS, link_density=0.5, seed=0):
+    """
+    Write a workbook with rows of new records in each of sheet_names, all passing SheetReader.read_sheet.
+
+    Relationship cells link to a random record of the linked sheet if it is in sheet_names, with a chance of link_density.
+    The worksheets are written row by row in constant memory, so the Lists worksheet only keeps its first column.
+    """
+    generator = random.Random(seed)
+    workbook = xlsxwriter.Workbook(file_name, {"constant_memory": True})
+    reader = sheetreader.SheetReader(meta_structure)
+    reader.write_book_header(workbook)
+    date_format = workbook.add_format({"num_format": "yyyy-mm-dd"})
+    first_date = datetime.date(2016, 1, 1)
+    for sheet_name in sheet_names:
+        sheet = workbook.get_worksheet_by_name(sheet_name)
+        fixed = FIXED_VALUES.get(sheet_name, {})
+        columns = list(meta_structure.get_sheet_schema(sheet_name)) + list(meta_structure.get_sheet_link(sheet_name)["connections"])
+        schema_count = len(meta_structure.get_sheet_schema(sheet_name))
+        for row in range(rows):
+            excel_row = row + reader.excel_data_start_row
+            for col, column_dict in enumerate(columns):
+                name = column_dict["name"]
+                if col == 0:  # System Accession, all the records are new.
+                    continue
+                elif col == 1:
+                    sheet.write_string(excel_row, col, get_user_accession(meta_structure, sheet_name, row))
+                elif name in fixed:
+                    sheet.write(excel_row, col, fixed[name])
+                elif col >= schema_count:  # relationship columns
+                    linkto = meta_structure.category_to_sheet_name.get(column_dict["to"])
+                    if linkto in sheet_names and linkto != sheet_name and generator.random() < link_density:
+                        sheet.write_string(excel_row, col, get_user_accession(meta_structure, linkto, generator.randrange(rows)))
+                elif "values" in column_dict:
+                    sheet.write_string(excel_row, col, generator.choice(column_dict["values"]))
+                elif column_dict["type"] == "date":
+                    sheet.write_datetime(excel_row, col, first_date + datetime.timedelta(days=generator.randrange(1000)), date_format)
+                elif column_dict["type"] in ("number", "float", "textnumber"):
+                    sheet.write_number(excel_row, col, round(generator.uniform(0, 100), 2))
+                else:
+                    sheet.write_string(excel_row, col, "%s %d" % (name, row))
+    workbook.close()
+
+
+def main():
+    args = get_args()
+    sheet_names = args.sheets.split(",")
+    meta_structure, fake_server = get_meta_structure(args.server)
+    try:
+        restrict_columns(meta_structure, sheet_names, args.restricted_fraction, args.vocabulary_size, args.seed)
+        write_workbook(meta_structure, args.excel, args.rows, sheet_names, args.link_density, args.seed)
+    finally:
+        if fake_server is not None:
+            fake_server.stop()
+    print("wrote %d rows in %s to %s" % (args.rows, ", ".join(sheet_names), args.excel))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,15 @@ class BookData:
         self.meta_structure = meta_structure
         self.data = dict()
         self.submission_log = dict()
+        self.accession_index = dict()  # category -> {user accession: system accession}
+        self.accession_mirror = None  # an accessionmirror.AccessionMirror obj, for the user accessions of records not in the book.
 
     def add_sheet(self, sheet_data):
+        """Add a sheet and index the accessions of its records. Records added to the sheet later need index_record."""
         sheet_name = sheet_data.name
         self.data[sheet_name] = sheet_data
+        for record in sheet_data.all_records:
+            self.index_record(record)
 
     def save_submission(self, sheet_name, accession):
         category = self.meta_structure.get_category(sheet_name)
@@ -15,29 +20,61 @@ class BookData:
         else:
             self.submission_log.update({category: [accession]})
 
+    def index_record(self, record):
+        """
+        Point the user accession of a record, and the old one replaced for the test database, to its system accession in the index of its category.
+
+        Call it again whenever the system accession of the record changes, e.g. once it is submitted.
+        Empty and "NA-web" user accessions are not unique, they are never indexed.
+        """
+        index = self.accession_index.setdefault(self.meta_structure.get_category(record.sheet_name), dict())
+        system_accession = record.schema.get("accession", "")
+        for user_accession in (record.schema.get("user_accession", ""), record.old_accession()):
+            if user_accession != "" and user_accession != "NA-web":
+                index[user_accession] = system_accession
+
+    def resolve(self, linkto_category, accession):
+        """Return the system accession of a user accession in linkto_category, or the accession itself if it is not a known user accession."""
+        system_accession = self.accession_index.get(linkto_category, {}).get(accession)
+        if system_accession is None:
+            system_accession = self._resolve_existing(linkto_category, accession)
+        return system_accession
+
+    def _resolve_existing(self, linkto_category, accession):
+        """Look up a user accession not in the book in the accession mirror, returns the accession itself if it is not there."""
+        if self.accession_mirror is None or accession == "" or accession == "NA-web":
+            return accession
+        system_accession = self.accession_mirror.get_system_accession(linkto_category, accession)
+        return accession if system_accession is None else system_accession
+
+    def resolve_links(self, record):
+        """
+        Replace the user accessions in the relationships of a record with system accessions, each looked up in the index of the linked category.
+
+        With an accession mirror, the user accessions not in the book are looked up in it too.
+        A record of the book without a system accession, e.g. its post request failed, is linked to "", which is never posted.
+        :return: a list of (linkto_category, user accession) linked to such records.
+        """
+        unresolved = []
+        for linkto in record.relationships.values():
+            for linkto_category, accession_list in linkto.items():
+                index = self.accession_index.get(linkto_category)
+                if index or self.accession_mirror is not None:
+                    for position, accession in enumerate(accession_list):
+                        if index and accession in index:
+                            accession_list[position] = index[accession]
+                            if index[accession] == "":
+                                unresolved.append((linkto_category, accession))
+                        elif self.accession_mirror is not None:
+                            system_accession = self._resolve_existing(linkto_category, accession)
+                            if system_accession != accession:
+                                accession_list[position] = system_accession
+        return unresolved
+
     def swipe_accession(self):
         """
         for all the relationships in the bookdata, point it to a system accession according to user accession.
         """
-        accession_table = dict()
-        for sheet in self.data:
-            sheet_data = self.data[sheet]
-            all_records = sheet_data.all_records
-            for record in all_records:
-                user_accession = record.schema["user_accession"]
-                system_accession = record.schema["accession"]
-                accession_table.update({user_accession: system_accession})
-                old_accession = record.old_accession()
-                if old_accession != "":
-                    accession_table.update({old_accession: system_accession})
-
-        for sheet in self.data:
-            sheet_data = self.data[sheet]
-            all_records = sheet_data.all_records
-            for record in all_records:
-                for column_name in record.relationships:
-                    for linkto in record.relationships[column_name]:
-                        accession_list = record.relationships[column_name][linkto]
-                        for index, accession in enumerate(accession_list):
-                            if accession in accession_table:
-                                accession_list[index] = accession_table[accession]
+        for sheet_data in self.data.values():
+            for record in sheet_data.all_records:
+                self.resolve_links(record)
@@ -0,0 +1,514 @@
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import threading
+import collections
+import socketserver
+import http.server
+import urllib.parse
+
+import metastructure
+import poster
+
+FAKE_VERSION = {"current": "3.0.5-fake"}
+
+
+def _field(name, text, data_type="text", required=False, values=None, values_restricted=False, placeholder=""):
+    field = {"name": name, "text": text, "type": data_type, "required": required, "placeholder": placeholder}
+    if values is not None:
+        field["values"] = values
+        field["values_restricted"] = values_restricted
+    return field
+
+
+def _connection(name, display_name, to, all_name, placeholder=""):
+    return {"name": name, "display_name": display_name, "to": to, "all": all_name, "placeholder": placeholder}
+
+
+# category -> (categories, accession code, schema without user_accession, connections)
+BUILTIN_STRUCTURE = collections.OrderedDict([
+    ("lab", ("labs", "LAB", [
+        _field("lab_name", "Lab name", required=True),
+        _field("institution", "Institution"),
+        _field("contact", "Contact")
+    ], [])),
+    ("bioproject", ("bioprojects", "BPR", [
+        _field("project_name", "Project name", required=True),
+        _field("description", "Description")
+    ], [
+        _connection("part_of", "Lab", "lab", "labs")
+    ])),
+    ("litter", ("litters", "LTR", [
+        _field("litter_size_total", "Litter size (total)", "number"),
+        _field("litter_size_survived", "Litter size (survived to weaning)", "number"),
+        _field("litter_number", "Litter number", "number"),
+        _field("male_female_ratio", "Male/female ratio", "textnumber"),
+        _field("dam_weight_mating", "Dam weight, mating (g)", "textnumber"),
+        _field("dam_weight_weaning", "Dam weight, weaning (g)", "textnumber"),
+        _field("dam_weight_preexposure", "Dam weight, pre-exposure (g)", "textnumber"),
+        _field("date_born", "Date born", "date"),
+        _field("comments", "Comments", "textarea")
+    ], [
+        _connection("part_of", "Bioproject", "bioproject", "bioprojects"),
+        _connection("sire", "Sire", "mouse", "mice"),
+        _connection("dam", "Dam", "mouse", "mice")
+    ])),
+    ("mouse", ("mice", "MUS", [
+        _field("strain", "Strain", values=["C57BL/6", "Collaborative Cross/CC", "Diversity Outbred"]),
+        _field("sex", "Sex", values=["male", "female"], values_restricted=True),
+        _field("life_stage", "Life stage at sac", values=["preconception", "in utero", "neonate", "weanling", "adult"], values_restricted=True),
+        _field("fasted", "Fasted", values=["Yes", "No"], values_restricted=True),
+        _field("fasted_hours", "Fasted hours", "number"),
+        _field("comments", "Comments")
+    ], [
+        _connection("part_of", "Litter", "litter", "litters"),
+        _connection("treated_with", "Treatment", "treatment", "treatments"),
+        _connection("fed", "Diet", "diet", "diets")
+    ])),
+    ("diet", ("diets", "DIE", [
+        _field("diet_name", "Diet name", required=True),
+        _field("manufacturer", "Manufacturer"),
+        _field("fat_percentage", "Fat (%)", "number")
+    ], [])),
+    ("treatment", ("treatments", "TRT", [
+        _field("exposure_type", "Exposure type", values=["Endocrine-disrupting chemical", "metal", "particle"]),
+        _field("exposure", "Exposure", values=["BPA (Bisphenol A)", "TBT (Tributyltin)", "Genestein"]),
+        _field("route", "Route of exposure", values=["Oral", "Parenteral"], values_restricted=True),
+        _field("dose", "Dose", "number")
+    ], [
+        _connection("part_of", "Bioproject", "bioproject", "bioprojects")
+    ])),
+    ("biosample", ("biosamples", "SAM", [
+        _field("tissue", "Tissue", values=["Liver", "Blood", "Skin", "Lung"]),
+        _field("tissue_classification", "Tissue classification", values=["Target", "Surrogate"], values_restricted=True),
+        _field("collection_protocol", "Collection protocol"),
+        _field("cell_culture_protocol", "Cell culture protocol"),
+        _field("culture_length", "Culture length"),
+        _field("passage_number", "Passage number", "number"),
+        _field("comments", "Comments")
+    ], [
+        _connection("derived_from", "Mouse", "mouse", "mice")
+    ])),
+    ("library", ("libraries", "LIB", [
+        _field("population", "Population", values=["DNA", "mRNA", "rRNA-depleted"], values_restricted=True),
+        _field("starting_amount", "Starting amount", "number"),
+        _field("comments", "Comments")
+    ], [
+        _connection("derived_from", "Biosample", "biosample", "biosamples")
+    ])),
+    ("assay", ("assays", "ASY", [
+        _field("technique", "Technique", values=["ATAC-seq", "RNA-seq", "RRBS-seq", "ChIP-seq"], values_restricted=True),
+        _field("date_performed", "Date performed", "date"),
+        _field("comments", "Comments")
+    ], [
+        _connection("assay_input", "Library", "library", "libraries"),
+        _connection("assay_input", "Biosample", "biosample", "biosamples"),
+        _connection("reagent", "Reagent", "reagent", "reagents")
+    ])),
+    ("reagent", ("reagents", "REA", [
+        _field("reagent", "Reagent"),
+        _field("source", "Source"),
+        _field("product_id", "Product ID"),
+        _field("lot_id", "Lot ID"),
+        _field("antigen_sequence", "Antigen sequence"),
+        _field("clonality", "Clonality", values=["monoclonal", "polyclonal"]),
+        _field("host", "Host organism", values=["horse", "rabbit"]),
+        _field("isotype", "Isotype", values=["IgA", "IgG"]),
+        _field("purification_method", "Purification method"),
+        _field("comments", "Comments")
+    ], [])),
+    ("file", ("files", "FIL", [
+        _field("filename", "File name", required=True),
+        _field("md5sum", "md5sum"),
+        _field("format", "Format", values=["fastq", "bam"]),
+        _field("run_type", "Run type", values=["single-end", "paired-end"], values_restricted=True),
+        _field("pair", "Pair"),
+        _field("submission_id", "Submission ID")
+    ], [
+        _connection("derived_from", "Assay", "assay", "assays"),
+        _connection("paired_file", "Paired file", "file", "files")
+    ])),
+    ("mergedFile", ("mergedFiles", "FM", [
+        _field("merged_date", "Merged date", "date"),
+        _field("comments", "Comments")
+    ], [
+        _connection("merged_from", "File", "file", "files")
+    ])),
+    ("experiment", ("experiments", "EXP", [
+        _field("experiment_alias", "Experiment Alias", required=True),
+        _field("design_description", "Design Description")
+    ], [
+        _connection("performed_under", "Bioproject", "bioproject", "bioprojects"),
+        _connection("includes", "File", "file", "files")
+    ])),
+])
+
+
+def builtin_schema(category):
+    """Return the /schema/<category>.json data of the built-in structure."""
+    categories, code, fields, connections = BUILTIN_STRUCTURE[category]
+    user_accession = _field("user_accession", "User accession", placeholder="USR%s####" % code)
+    return [user_accession] + [dict(x) for x in fields]
+
+
+def builtin_link(category):
+    """Return the /schema/relationships/<category>.json data of the built-in structure."""
+    categories, code, fields, connections = BUILTIN_STRUCTURE[category]
+    return {"one": category,
+            "all": categories,
+            "prefix": "TRGT%s000" % code,
+            "usr_prefix": "USR%s000" % code,
+            "connections": [dict(x) for x in connections]
+            }
+
+
+def _now():
+    """The date_modified of a record, an ISO time string like the real databases."""
+    now = time.time()
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) + ".%06dZ" % (now % 1 * 1000000)
+
+
+class FakeServer:
+    def __init__(self, host="127.0.0.1", port=0, latency=0, error_rate=0, error_status=503, records=0, foreign_records=0, user_name="tester", seed=0):
+        """
+        A local stand-in of the metadata api, the submission api and the cypher endpoint, served by one threaded http server.
+
+        All the data is in memory and starts with the built-in structure in BUILTIN_STRUCTURE, which covers metastructure.ALL_CATEGORIES.
+        Records are posted form encoded and links as json, the same as the real servers. The cypher endpoint only understands the statements Poster sends.
+        Use it as a context manager, then point MetaStructure(meta_url=, submit_url=) and Poster(cypher_url=) at server.url and server.cypher_url.
+        :param: port - 0 picks a free port.
+        :param: latency - seconds every request waits before it is answered.
+        :param: error_rate - the fraction of requests answered with error_status instead, drawn from a random generator seeded with seed.
+        :param: error_status - the http status code of the injected errors.
+        :param: records - the number of records of user_name already in every category.
+        :param: foreign_records - the number of records of another user already in every category.
+        :param: user_name - the user name of every API key.
+
+        :attributes: stats - a Counter of the answered requests per route, including the injected errors as "error".
+        :attributes: max_in_flight - the max number of requests handled at the same time.
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.user_name = user_name
+        self.stats = collections.Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._nodes = collections.OrderedDict((x, collections.OrderedDict()) for x in BUILTIN_STRUCTURE)  # category -> accession -> node.
+        self._categories = {builtin_link(x)["all"]: x for x in BUILTIN_STRUCTURE}  # "mice" -> "mouse"
+        self._counters = collections.Counter()
+        self._submissions = collections.OrderedDict()
+        for category in BUILTIN_STRUCTURE:
+            for user, count in ((user_name, records), ("someone_else", foreign_records)):
+                for i in range(count):
+                    self._create(category, user, self._example_schema(category, "%s_%d" % (user, i)))
+        self._httpd = _ThreadingHTTPServer((host, port), _Handler)
+        self._httpd.fake_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return "http://%s:%d" % (host, port)
+
+    @property
+    def cypher_url(self):
+        return self.url + poster.CYPHER_PATH
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fakeserver")
+        self._thread.daemon = True
+        self._thread.start()
+        logging.debug("fake server listening on %s" % self.url)
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats.clear()
+            self.max_in_flight = self.in_flight
+
+    def get_node(self, category, accession):
+        """Return {"schema", "added", "user"} of a record, or None. "added" is {connection: {linkto_category: [accessions]}}."""
+        return self._nodes[category].get(accession)
+
+    def count(self, category):
+        return len(self._nodes[category])
+
+    def handle(self, method, path, body, content_type):
+        """Return (http status, response obj) of a request."""
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            inject_error = self.error_rate > 0 and self._random.random() < self.error_rate
+        route = "bad request"
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            if inject_error:
+                route, status, response = "error", self.error_status, {"message": "injected error"}
+            else:
+                route, status, response = self._route(method, path, self._decode_body(body, content_type))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.stats[route] += 1
+        return status, response
+
+    def _route(self, method, path, data):
+        parts = urllib.parse.urlsplit(path).path.strip("/").split("/")
+        with self._lock:
+            if method == "GET" and len(parts) == 2 and parts[0] == "schema":
+                return ("GET /schema",) + self._schema(parts[1], builtin_schema)
+            if method == "GET" and len(parts) == 3 and parts[:2] == ["schema", "relationships"]:
+                return ("GET /schema/relationships",) + self._schema(parts[2], builtin_link)
+            if method == "POST" and "/" + "/".join(parts) == poster.CYPHER_PATH:
+                return "POST cypher", 200, self._cypher(data.get("query", ""), data.get("params", {}))
+            if len(parts) < 2 or parts[0] != "api":
+                return "unknown", 404, {"message": "unknown path %s" % path}
+            if method == "GET" and parts[1] == "version" and len(parts) == 2:
+                return "GET /api/version", 200, FAKE_VERSION
+            if method == "GET" and parts[1] == "usertoken" and len(parts) == 3:
+                return "GET /api/usertoken", 200, {"username": self.user_name}
+            if method == "POST" and parts[1] == "submission" and len(parts) == 2:
+                return "POST /api/submission", 200, self._save_submission(data)
+            category = self._categories.get(parts[1])
+            if category is None:
+                return "unknown", 404, {"message": "unknown category %s" % parts[1]}
+            if len(parts) == 2 and method == "GET":
+                return "GET /api/<categories>", 200, {parts[1]: [self._flat(x) for x in self._nodes[category].values()]}
+            if len(parts) == 2 and method == "POST":
+                return "POST /api/<categories>", 200, self._post_record(category, None, data)
+            if len(parts) == 3 and method == "GET":
+                node = self._nodes[category].get(parts[2])
+                if node is None:
+                    return "GET /api/<categories>/<accession>", 404, {"message": "%s not found" % parts[2]}
+                added = {k: {c: [list(a)] for c, a in v.items()} for k, v in node["added"].items()}  # the accession lists are wrapped in another list.
+                return "GET /api/<categories>/<accession>", 200, {"mainObj": {category: dict(node["schema"]), "added": added}}
+            if len(parts) == 3 and method == "POST":
+                return "POST /api/<categories>/<accession>", 200, self._post_record(category, parts[2], data)
+            if len(parts) == 5 and method == "POST" and parts[4] in ("add", "remove"):
+                return "POST link " + parts[4], 200, self._post_link(category, parts[2], parts[3], parts[4] == "add", data)
+            return "unknown", 404, {"message": "unknown path %s" % path}
+
+    def _decode_body(self, body, content_type):
+        if not body:
+            return {}
+        if "json" in content_type or body.lstrip().startswith(b"{"):  # Poster posts json links without a content type.
+            return json.loads(body.decode("utf-8"))
+        return {k: v[0] for k, v in urllib.parse.parse_qs(body.decode("utf-8"), keep_blank_values=True).items()}
+
+    def _schema(self, file_name, build):
+        category = file_name[:-len(".json")] if file_name.endswith(".json") else file_name
+        if category not in BUILTIN_STRUCTURE:
+            return 404, {"message": "unknown category %s" % category}
+        return 200, {"data": build(category)}
+
+    def _create(self, category, user, schema):
+        self._counters[category] += 1
+        accession = builtin_link(category)["prefix"][:-metastructure.ACCESSION_PLACEHOLDER_DIGITS] + "%04d" % self._counters[category]
+        schema = dict(schema, accession=accession)
+        self._nodes[category][accession] = {"schema": schema, "added": dict(), "user": user, "modified": _now()}
+        return accession
+
+    def _example_schema(self, category, suffix):
+        schema = {"user_accession": builtin_link(category)["usr_prefix"][:-metastructure.ACCESSION_PLACEHOLDER_DIGITS] + suffix}
+        for field in builtin_schema(category)[1:]:
+            if "values" in field:
+                schema[field["name"]] = field["values"][0]
+            elif field["type"] == "date":
+                schema[field["name"]] = "2018-01-01"
+            elif field["type"] in ("number", "float", "textnumber"):
+                schema[field["name"]] = 1
+            else:
+                schema[field["name"]] = "NA"
+        return schema
+
+    def _flat(self, node):
+        return dict(node["schema"], user=node["user"])
+
+    def _post_record(self, category, accession, data):
+        data = dict(data)
+        data.pop("accession", None)
+        if accession is None:
+            user_accession = data.get("user_accession", "")
+            for node in self._nodes[category].values():
+                if node["user"] == self.user_name and user_accession != "" and node["schema"]["user_accession"] == user_accession:
+                    return {"statusCode": 400, "message": "user accession %s already exists" % user_accession}
+            return {"statusCode": 200, "accession": self._create(category, self.user_name, data)}
+        node = self._nodes[category].get(accession)
+        if node is None:
+            return {"statusCode": 404, "message": "%s not found" % accession}
+        node["schema"].update(data)
+        node["modified"] = _now()
+        return {"statusCode": 200, "message": "%s updated" % accession}
+
+    def _post_link(self, category, accession, linkto_category, is_add, data):
+        node = self._nodes[category].get(accession)
+        if node is None:
+            return {"statusCode": 404, "message": "%s not found" % accession}
+        linkto_accessions = data.get("connectionAcsn", [])
+        if not isinstance(linkto_accessions, list):
+            linkto_accessions = [linkto_accessions]
+        existing = node["added"].setdefault(data.get("connectionName"), dict()).setdefault(linkto_category, [])
+        for linkto_accession in linkto_accessions:
+            if is_add and linkto_accession not in existing:
+                existing.append(linkto_accession)
+            elif not is_add and linkto_accession in existing:
+                existing.remove(linkto_accession)
+        return {"statusCode": 200, "message": "success"}
+
+    def _save_submission(self, data):
+        submission_id = "fake%06d" % (len(self._submissions) + 1)
+        self._submissions[submission_id] = {"details": json.loads(data.get("details", "{}")), "update": data.get("update"), "user": self.user_name}
+        return {"statusCode": 201, "submission_id": submission_id}
+
+    def _cypher(self, statement, params):
+        """Answer the cypher statements sent by Poster.fetch_all_accession, fetch_records, fetch_user_all and fetch_submission."""
+        if "RETURN n.accession, n.user_accession, n.user, n.date_modified" in statement:
+            nodes = self._nodes.get(params.get("category"), dict()).values()
+            if "n.date_modified >= {date_modified}" in statement:
+                since = params.get("date_modified", "")
+                last = params.get("accession", "")
+                nodes = [x for x in nodes if x["modified"] >= since or (len(x["schema"]["accession"]), x["schema"]["accession"]) > (len(last), last)]
+            rows = [[x["schema"]["accession"], x["schema"].get("user_accession"), x["user"], x["modified"]] for x in nodes]
+            return {"columns": ["n.accession", "n.user_accession", "n.user", "n.date_modified"], "data": rows}
+        if "RETURN n.accession, n.user_accession, n.user" in statement:
+            nodes = self._nodes.get(params.get("category"), dict()).values()
+            if "n.user={name}" in statement:
+                nodes = [x for x in nodes if x["user"] == params.get("name")]
+            rows = [[x["schema"]["accession"], x["schema"].get("user_accession"), x["user"]] for x in nodes]
+            return {"columns": ["n.accession", "n.user_accession", "n.user"], "data": rows}
+        if "as added" in statement:
+            categories = params.get("schema_categories", list(self._nodes))
+            if "f.submission_id={submission}" in statement:
+                nodes = self._traverse(params.get("submission"), 5)
+            elif "n.accession IN {accessions}" in statement:
+                category = params.get("category")
+                nodes = self._nodes.get(category, dict())
+                nodes = [(category, nodes[x]) for x in params.get("accessions", []) if x in nodes]
+            else:
+                nodes = [(c, x) for c in categories for x in self._nodes.get(c, dict()).values()]
+                if "n.user={name}" in statement:
+                    nodes = [(c, x) for c, x in nodes if x["user"] == params.get("name")]
+            nodes = [(c, x) for c, x in nodes if c in categories]
+            if "ORDER BY n.user_accession" in statement:
+                nodes.sort(key=lambda x: x[1]["schema"].get("user_accession", ""))
+            rows = []
+            for category, node in nodes:
+                added = [{"connection": connection, "to": [linkto_category], "accession": accession}
+                         for connection, linkto in node["added"].items()
+                         for linkto_category, accessions in linkto.items()
+                         for accession in accessions
+                         if linkto_category in categories]
+                if not added:
+                    added = [{"connection": "na", "to": "na", "accession": "na"}]
+                rows.append([{"data": dict(node["schema"])}, added, [category]])
+            if "labels(n) as tabs" not in statement:  # fetch_records only asks for the schema and the relationships.
+                return {"columns": ["schema", "added"], "data": [x[:2] for x in rows]}
+            return {"columns": ["schema", "added", "tabs"], "data": rows}
+        raise CypherError("unsupported statement: %s" % statement)
+
+    def _traverse(self, submission_id, max_depth):
+        """(category, node) of the files with submission_id and everything they link to in up to max_depth steps."""
+        index = {accession: (category, node) for category, nodes in self._nodes.items() for accession, node in nodes.items()}
+        found = collections.OrderedDict((x["schema"]["accession"], ("file", x)) for x in self._nodes["file"].values() if x["schema"].get("submission_id") == submission_id)
+        frontier = list(found)
+        for depth in range(max_depth):
+            next_frontier = []
+            for accession in frontier:
+                for linkto in found[accession][1]["added"].values():
+                    for accessions in linkto.values():
+                        for linkto_accession in accessions:
+                            if linkto_accession in index and linkto_accession not in found:
+                                found[linkto_accession] = index[linkto_accession]
+                                next_frontier.append(linkto_accession)
+            frontier = next_frontier
+        return list(found.values())
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection pooling on the client side is measured too.
+    disable_nagle_algorithm = True  # the headers and the body are written separately, don't wait for the delayed ack in between.
+
+    def do_GET(self):
+        self._answer("GET")
+
+    def do_POST(self):
+        self._answer("POST")
+
+    def _answer(self, method):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            status, response = self.server.fake_server.handle(method, self.path, body, self.headers.get("Content-Type", ""))
+        except (CypherError, ValueError) as error:
+            status, response = 400, {"message": str(error)}
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logging.debug("fakeserver: " + format % args)
+
+
+class CypherError(Exception):
+    """The fake cypher endpoint does not understand the statement."""
+    pass
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', '-p', action="store", dest="port", type=int, default=8000, help="The port to listen on. default is 8000.\n")
+    parser.add_argument('--latency', action="store", dest="latency", type=float, default=0, help="Seconds every request waits before it is answered. default is 0.\n")
+    parser.add_argument('--error-rate', action="store", dest="error_rate", type=float, default=0, help="The fraction of requests answered with an error. default is 0.\n")
+    parser.add_argument('--error-status', action="store", dest="error_status", type=int, default=503, help="The http status code of the injected errors. default is 503.\n")
+    parser.add_argument('--records', action="store", dest="records", type=int, default=0, help="The number of existing records of the user in every category. default is 0.\n")
+    parser.add_argument('--foreign-records', action="store", dest="foreign_records", type=int, default=0, help="The number of existing records of other users in every category. default is 0.\n")
+    parser.add_argument('--seed', action="store", dest="seed", type=int, default=0, help="The seed of the injected errors. default is 0.\n")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.getLogger().setLevel(logging.INFO)
+    server = FakeServer(port=args.port, latency=args.latency, error_rate=args.error_rate, error_status=args.error_status,
+                        records=args.records, foreign_records=args.foreign_records, seed=args.seed)
+    print("fake server on %s, use --server %s with submission.py. Ctrl-C to stop." % (server.url, server.url))
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._httpd.server_close()
+        for route, count in sorted(server.stats.items()):
+            print("%8d %s" % (count, route))
+        print("max requests in flight: %d" % server.max_in_flight)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
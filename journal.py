@@ -0,0 +1,111 @@
+import os
+import json
+import logging
+import threading
+
+import linkwriter
+
+
+class Journal:
+    def __init__(self, path):
+        """
+        An append-only log of the finished post requests of a submission, so a crashed run can be resumed.
+
+        One json object per line, every line is flushed and fsync'd before the request is considered done:
+        {"type": "record", "sheet_name", "row", "user_accession", "accession", "submission"} - a record was submitted or updated.
+        {"type": "link", "edge"} - a relationship (a linkwriter.Edge) was added or removed.
+        {"type": "submission"} - the submission was saved.
+        :param: path - the journal file.
+        """
+        self.path = path
+        self.records = dict()  # (sheet_name, row) -> the record entry.
+        self.links = set()
+        self.submission_saved = False
+        self._lock = threading.Lock()
+        self._file = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def load(self):
+        """Replay the journal. A line cut off by a crash is ignored."""
+        with open(self.path) as journal_file:
+            for line_number, line in enumerate(journal_file):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logging.warning("skip broken line %d in journal %s." % (line_number + 1, self.path))
+                    continue
+                self._add(entry)
+        logging.info("Journal %s: %d records, %d relationships done%s." % (self.path, len(self.records), len(self.links), ", submission saved" if self.submission_saved else ""))
+
+    def open(self):
+        """Open the journal to append. Call load() first to resume. A line cut off by a crash is ended first, so the next entry starts a line of its own."""
+        self._file = open(self.path, "a")
+        if self._file.tell() > 0:
+            with open(self.path, "rb") as journal_file:
+                journal_file.seek(-1, os.SEEK_END)
+                ended = journal_file.read(1) == b"\n"
+            if not ended:
+                self._file.write("\n")
+                self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Delete the journal after a successful run."""
+        self.close()
+        os.remove(self.path)
+
+    def get_record(self, sheet_name, row, user_accession):
+        """
+        Return the journal entry of a record, or None if it was not done.
+
+        :raise: JournalError if the row in the excel file is not the record in the journal.
+        """
+        entry = self.records.get((sheet_name, row))
+        if entry is not None and entry["user_accession"] != user_accession:
+            raise JournalError("Row %d in %s is %s, but it is %s in journal %s. The excel file changed, please delete the journal and start again." % (row, sheet_name, user_accession, entry["user_accession"], self.path))
+        return entry
+
+    def has_link(self, edge):
+        return edge in self.links
+
+    def log_record(self, sheet_name, row, user_accession, row_data):
+        self._append({"type": "record",
+                      "sheet_name": sheet_name,
+                      "row": row,
+                      "user_accession": user_accession,
+                      "accession": row_data.schema["accession"],
+                      "submission": row_data.submission()
+                      })
+
+    def log_link(self, edge):
+        self._append({"type": "link", "edge": list(edge)})
+
+    def log_submission(self):
+        self._append({"type": "submission"})
+
+    def _add(self, entry):
+        if entry["type"] == "record":
+            self.records[(entry["sheet_name"], entry["row"])] = entry
+        elif entry["type"] == "link":
+            self.links.add(linkwriter.Edge(*entry["edge"]))
+        elif entry["type"] == "submission":
+            self.submission_saved = True
+
+    def _append(self, entry):
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._add(entry)
+
+
+class JournalError(Exception):
+    """The journal does not match the excel file."""
+    pass
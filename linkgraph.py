@@ -0,0 +1,149 @@
+import array
+import logging
+
+
+class LinkGraph:
+    def __init__(self, book_data):
+        """
+        The records of a book_data as integer ids and their relationships as adjacency arrays, built in one pass over all the links.
+
+        Record i is records[i], in the order of the sheets and the rows. It links to targets[offsets[i]:offsets[i + 1]].
+        A link is an edge if its accession, user or system, is a record of the linked category in book_data. Links to records
+        already in the database are only counted in external_links, links of a record to itself are kept in self_links instead.
+        :param: book_data - the validated BookData obj, before submission.
+        """
+        self.records = []  # id -> (sheet_name, row, record)
+        self.offsets = array.array("q", [0])
+        self.targets = array.array("q")
+        self.self_links = []  # a list of (id, column_name, linkto_category, accession)
+        self.external_links = 0
+        self._components = None
+        meta_structure = book_data.meta_structure
+        accession_ids = dict()  # category -> {user or system accession: id}
+        for sheet_name, sheet_data in book_data.data.items():
+            ids = accession_ids.setdefault(meta_structure.get_category(sheet_name), dict())
+            for row, record in enumerate(sheet_data.all_records):
+                for accession in (record.schema.get("user_accession", ""), record.schema.get("accession", "")):
+                    if accession != "" and accession != "NA-web":
+                        ids.setdefault(accession, len(self.records))
+                self.records.append((sheet_name, row, record))
+        targets = self.targets
+        for node, (sheet_name, row, record) in enumerate(self.records):
+            for column_name, linkto in record.relationships.items():
+                for linkto_category, accession_list in linkto.items():
+                    ids = accession_ids.get(linkto_category, {})
+                    for accession in accession_list:
+                        if accession == "":
+                            continue
+                        target = ids.get(accession)
+                        if target is None:
+                            self.external_links += 1
+                        elif target == node:
+                            self.self_links.append((node, column_name, linkto_category, accession))
+                        else:
+                            targets.append(target)
+            self.offsets.append(len(targets))
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_targets(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def get_components(self):
+        """
+        Return the strongly connected components as lists of ids, every component comes after all the components it links to.
+
+        Tarjan's algorithm without recursion, so a long chain of links does not hit the recursion limit.
+        """
+        if self._components is not None:
+            return self._components
+        count = len(self.records)
+        offsets = self.offsets
+        targets = self.targets
+        index = array.array("q", [-1]) * count
+        lowlink = array.array("q", [0]) * count
+        on_stack = bytearray(count)
+        stack = []
+        components = []
+        counter = 0
+        for root in range(count):
+            if index[root] != -1:
+                continue
+            index[root] = lowlink[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [[root, offsets[root]]]  # a list of [node, position of the next target]
+            while work:
+                frame = work[-1]
+                node, position = frame
+                if position < offsets[node + 1]:
+                    frame[1] = position + 1
+                    target = targets[position]
+                    if index[target] == -1:
+                        index[target] = lowlink[target] = counter
+                        counter += 1
+                        stack.append(target)
+                        on_stack[target] = 1
+                        work.append([target, offsets[target]])
+                    elif on_stack[target] and index[target] < lowlink[node]:
+                        lowlink[node] = index[target]
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if lowlink[node] < lowlink[parent]:
+                        lowlink[parent] = lowlink[node]
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack[member] = 0
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+        self._components = components
+        return components
+
+    def get_cycles(self):
+        """Return the components of more than one record, the records linking to each other."""
+        return [x for x in self.get_components() if len(x) > 1]
+
+    def get_waves(self):
+        """
+        Group the records into waves, a record only links to records in the earlier waves or in its own cycle.
+
+        So once a wave is created, all the links of its records can be written. Ids in a wave keep the order of the book.
+        :return: a list of lists of ids.
+        """
+        components = self.get_components()
+        offsets = self.offsets
+        targets = self.targets
+        component_of = array.array("q", [0]) * len(self.records)
+        for component_id, component in enumerate(components):
+            for member in component:
+                component_of[member] = component_id
+        levels = array.array("q", [0]) * len(components)
+        for component_id, component in enumerate(components):  # the linked components come first, their levels are known.
+            level = 0
+            for member in component:
+                for position in range(offsets[member], offsets[member + 1]):
+                    target_component = component_of[targets[position]]
+                    if target_component != component_id and levels[target_component] >= level:
+                        level = levels[target_component] + 1
+            levels[component_id] = level
+        waves = [[] for x in range(max(levels) + 1)] if components else []
+        for node in range(len(self.records)):
+            waves[levels[component_of[node]]].append(node)
+        return waves
+
+    def log_problems(self):
+        """Warn about the links of records to themselves, which are never written, and report the cycles."""
+        for node, column_name, linkto_category, accession in self.self_links:
+            sheet_name, row, record = self.records[node]
+            logging.warning("%s of %s in %s links the record to itself, the relationship is skipped." % (column_name, accession, sheet_name))
+        cycles = self.get_cycles()
+        if cycles:
+            logging.info("%d records link to each other in %d cycles, the records of a cycle are created before any of them is linked." % (sum(len(x) for x in cycles), len(cycles)))
@@ -0,0 +1,100 @@
+import logging
+import collections
+import concurrent.futures
+
+import transport
+
+# One relationship to add or remove: from system_accession in sheet_name, through connection_name, to linkto_accession in linkto_category.
+Edge = collections.namedtuple("Edge", ["sheet_name", "system_accession", "linkto_category", "connection_name", "linkto_accession", "is_add"])
+
+
+class LinkWriter:
+    def __init__(self, db_poster, workers=1, record_journal=None, record_snapshot=None):
+        """
+        Write the relationships of a whole workbook at once.
+
+        Collect all the edges first, remove duplicated ones, group the additions per endpoint, then post them with a bounded thread pool.
+        :param: db_poster - the Poster obj.
+        :param: workers - the max number of link requests in flight.
+        :param: record_journal - an opened journal.Journal obj. Edges already in the journal are skipped, written ones are added to it.
+        :param: record_snapshot - a loaded snapshot.Snapshot obj with the existing relationships of the updated records. Records not in it are fetched one by one.
+        """
+        self.db_poster = db_poster
+        self.workers = max(1, workers)
+        self.journal = record_journal
+        self.snapshot = record_snapshot
+
+    def collect(self, records):
+        """
+        Return a list of unique Edge for all the submitted, updated or unchanged records, in the order of records.
+
+        Fetching existing relationships of updated records missing in the snapshot runs in the thread pool, too.
+        """
+        edges = collections.OrderedDict()
+        for record_edges in self._map(self._get_record_changes, records):
+            for edge in record_edges:
+                edges[edge] = None
+        return list(edges)
+
+    def write(self, edges):
+        """
+        Post all the edges. Additions to the same endpoint and connection go in a single request. Removals go one by one, the api only removes one accession at a time.
+
+        :return: a dict, edge -> True if it was successfully written.
+        """
+        edges = list(collections.OrderedDict.fromkeys(edges))
+        if self.journal is not None:
+            done = [x for x in edges if self.journal.has_link(x)]
+            if done:
+                logging.info("%d relationships have been written before, skip them." % len(done))
+                edges = [x for x in edges if not self.journal.has_link(x)]
+        groups = collections.OrderedDict()
+        for edge in edges:
+            if edge.is_add:
+                key = (edge.sheet_name, edge.system_accession, edge.linkto_category, edge.connection_name, True)
+            else:
+                key = edge
+            groups.setdefault(key, []).append(edge)
+
+        results = dict()
+        for group, success in self._map(self._post_group, list(groups.values())):
+            for edge in group:
+                results[edge] = success
+        failed = len([x for x in results.values() if not x])
+        if failed:
+            logging.error("%d of %d relationships failed to be written!" % (failed, len(results)))
+        elif results:
+            logging.info("successfully written all %d relationships in %d requests." % (len(results), len(groups)))
+        return results
+
+    def _get_record_changes(self, record):
+        existing_record = None
+        if self.snapshot is not None and record.submission() in ("updated", "unchanged"):
+            existing_record = self.snapshot.get(record.sheet_name, record.schema["accession"])
+        try:
+            return self.db_poster.get_link_changes(record, existing_record)
+        except transport.TransportError as transport_error:
+            sheet_name = record.sheet_name
+            system_accession = record.schema["accession"]
+            self.db_poster.failed_links.append((sheet_name, system_accession, [], str(transport_error)))
+            logging.error("Unable to fetch existing record %s in %s, skip its relationships!" % (system_accession, sheet_name))
+            return []
+
+    def _post_group(self, group):
+        edge = group[0]
+        if edge.is_add:
+            linkto_accession = [x.linkto_accession for x in group]
+        else:
+            linkto_accession = edge.linkto_accession
+        success = self.db_poster.post_link(edge.sheet_name, edge.system_accession, edge.linkto_category, edge.connection_name, linkto_accession, edge.is_add)
+        if success and self.journal is not None:
+            for x in group:
+                self.journal.log_link(x)
+        return group, success
+
+    def _map(self, action, items):
+        """Same as map(action, items), at most self.workers at the same time, results in the order of items."""
+        if self.workers == 1:
+            return [action(x) for x in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(action, items))
@@ -1,5 +1,6 @@
-import requests
+import types
 import collections
+import transport
 
 ACCESSION_PLACEHOLDER_DIGITS = 3
 URL_META = 'http://target.wustl.edu:7006'
@@ -9,12 +10,14 @@ TESTURL_META = URL_META
 TESTURL_SUBMIT = URL_SUBMIT
 # TESTURL_META = 'http://target.wustl.edu:8006'
 # TESTURL_SUBMIT = 'http://target.wustl.edu:8002'
+SheetIndex = collections.namedtuple("SheetIndex", ["schema_headers", "link_headers", "schema_header_set", "link_header_set", "link_name_set", "column_dicts", "column_names", "linkto_categories"])
+
 ALL_CATEGORIES = ["lab", "bioproject", "litter", "mouse", "diet", "treatment", "biosample", "assay", "reagent", "file"]
 # ALL_CATEGORIES = ["lab", "bioproject", "litter", "mouse", "diet", "treatment", "biosample", "library", "assay", "reagent", "file", "mergedFile", "experiment"]
 
 
 class MetaStructure:
-    def __init__(self, is_production=False, all_categories=ALL_CATEGORIES, schema_string='/schema/', relationship_string='/schema/relationships/', version_string='/api/version'):
+    def __init__(self, is_production=False, all_categories=ALL_CATEGORIES, schema_string='/schema/', relationship_string='/schema/relationships/', version_string='/api/version', http_transport=None, schema_cache=None, offline=False, meta_url=None, submit_url=None):
         """
         Set up metastructure.
 
@@ -23,6 +26,11 @@ class MetaStructure:
         :param: schema_string: - it is the the schema string part of the url.
         :param: relationship_string: - it is the relationship string part of the url.
         :param: version_string: it is the version string parl of the url
+        :param: http_transport - the transport.Transport obj shared with Poster. A new one is created if it is None.
+        :param: schema_cache - the schemacache.SchemaCache obj. If provided, the structure is only fetched when the version changes.
+        :param: offline - never contact the server, get the structure from schema_cache only.
+        :param: meta_url - use another metadata server instead of URL_META or TESTURL_META, e.g. a fakeserver.FakeServer.
+        :param: submit_url - use another submission server instead of URL_SUBMIT or TESTURL_SUBMIT.
         :return:
 
         :attributes: url - the meta_url
@@ -88,15 +96,49 @@ class MetaStructure:
         else:
             self.action_url_meta = TESTURL_META
             self.action_url_submit = TESTURL_SUBMIT
+        if meta_url is not None:
+            self.action_url_meta = meta_url
+        if submit_url is not None:
+            self.action_url_submit = submit_url
         self.url = self.action_url_meta
+        self.transport = http_transport if http_transport is not None else transport.Transport()
         self.category_to_sheet_name = self._set_category_to_sheet_name(all_categories)  # it is a dictionary
-        self.schema_dict = self._url_to_json(schema_string)
-        self.link_dict = self._url_to_json(relationship_string)
-        self.version = self._set_version(version_string)
+        if offline:
+            if schema_cache is None:
+                raise StructureError("offline mode needs a schema cache!")
+            cached = schema_cache.load(self.url, all_categories)
+            if cached is None:
+                raise StructureError("No cached database structure of %s, please run it once online." % self.url)
+        else:
+            version = self._set_version(version_string)  # a single request to revalidate the cache.
+            cached = schema_cache.load(self.url, all_categories, version) if schema_cache is not None else None
+            if cached is None:
+                cached = {"version": version,
+                          "schema_dict": self._url_to_json(schema_string),
+                          "link_dict": self._url_to_json(relationship_string)
+                          }
+                if schema_cache is not None:
+                    schema_cache.save(self.url, all_categories, version, cached["schema_dict"], cached["link_dict"])
+        self.schema_dict = collections.OrderedDict(cached["schema_dict"])
+        self.link_dict = collections.OrderedDict(cached["link_dict"])
+        self.version = cached["version"]
 
         # Add system accession to the schema dictionary:
         for category in self.schema_dict:
             self.schema_dict[category].insert(0, {"name": "accession", "text": "System Accession", "type": "text"})
+        self.sheet_index = {sheet_name: self._build_sheet_index(sheet_name) for sheet_name in self.schema_dict}
+
+    def __getstate__(self):
+        """Pickle for worker processes: without the transport, which can't be shared, and without the sheet index, which is rebuilt."""
+        state = self.__dict__.copy()
+        state.pop("transport", None)
+        state.pop("sheet_index", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.transport = None
+        self.sheet_index = {sheet_name: self._build_sheet_index(sheet_name) for sheet_name in self.schema_dict}
 
     # def start_metastructure(self, isproduction, all_categories, schema_string, relationship_string, version_string):
     #     # FIXME Move to separate file
@@ -165,13 +207,23 @@ class MetaStructure:
 
     def get_schema_column_headers(self, sheet_name):  # get a list of all column display names, including "System Accession"
         """Return a list of all column display names except relationship columns. Because of L123-125, "System Accession" is also in the list."""
-        schema = self.get_sheet_schema(sheet_name)
-        return [x["text"] for x in schema]
+        return list(self.sheet_index[sheet_name].schema_headers)  # a new list, so the caller can't change the index.
 
     def get_link_column_headers(self, sheet_name):  # get a list of all column display names
         """Return a list of all relationship column display names."""
-        link = self.get_sheet_link(sheet_name)
-        return [x["display_name"] for x in link["connections"]]
+        return list(self.sheet_index[sheet_name].link_headers)
+
+    def is_schema_column(self, sheet_name, column_header):
+        """If the column header is a column in schema (not a relationship column)."""
+        return column_header in self.sheet_index[sheet_name].schema_header_set
+
+    def is_link_column(self, sheet_name, column_header):
+        """If the column header is a relationship column."""
+        return column_header in self.sheet_index[sheet_name].link_header_set
+
+    def is_link_column_name(self, sheet_name, column_name):
+        """If the field name (column_name) in database is a relationship."""
+        return column_name in self.sheet_index[sheet_name].link_name_set
 
     def get_schema_column_names(self, sheet_name):  # get a list of all column names, including "accession"
         """Return a list of all column names except relationship columns. Because of L123-125, "accession" is also in the list."""
@@ -200,8 +252,10 @@ class MetaStructure:
 
     def get_column_name(self, sheet_name, column_header):
         """Get the field name (column_name) in database using column header in excel."""
-        column_schema = self.get_column_dict(sheet_name, column_header)
-        return column_schema["name"]
+        try:
+            return self.sheet_index[sheet_name].column_names[column_header]
+        except KeyError:
+            raise StructureError("Can not find column %s in worksheet %s" % (column_header, sheet_name))
 
     def is_column_required(self, sheet_name, column_header):
         """If the field name (column_name) in excel in required in the database."""
@@ -216,10 +270,9 @@ class MetaStructure:
         :param: column_header
         :return: another sheet_name the columna_header in sheet_name linked to.
         """
-        if column_header in self.get_link_column_headers(sheet_name):
-            link = self.get_sheet_link(sheet_name)
-            category = [x["to"] for x in link["connections"] if x["display_name"] == column_header][0]
-            return self.category_to_sheet_name[category]
+        linkto_categories = self.sheet_index[sheet_name].linkto_categories
+        if column_header in linkto_categories:
+            return self.category_to_sheet_name[linkto_categories[column_header]]
         else:
             raise StructureError("%s in %s is not a connection column" % (column_header, sheet_name))
 
@@ -228,7 +281,7 @@ class MetaStructure:
         new_dict = collections.OrderedDict()
         for category, sheet_name in self.category_to_sheet_name.items():
             json_url = self.url + string + category + '.json'
-            data = requests.get(json_url).json()["data"]  # data is a list for schema, but data is a dict for links. within links: data['connections'] is a list.
+            data = self.transport.get(json_url)["data"]  # data is a list for schema, but data is a dict for links. within links: data['connections'] is a list.
             new_dict[sheet_name] = data
         return new_dict
 
@@ -242,23 +295,45 @@ class MetaStructure:
     def _set_version(self, version_string):
         """ Giver a version string (part of the url), returns the latested database structure version."""
         full_url = self.url + version_string
-        return requests.get(full_url).json()
+        return self.transport.get(full_url)
 
     def get_column_dict(self, sheet_name, column_header):
         """
         Given a excel sheet name and a column displayname (column_header), returns the column schema in dict from json file.
         """
-        if column_header in self.get_schema_column_headers(sheet_name):
-            column_dict = [x for x in self.get_sheet_schema(sheet_name) if x["text"] == column_header][0]
+        try:
+            return self.sheet_index[sheet_name].column_dicts[column_header]
+        except KeyError:
+            raise StructureError("Can not find column %s in worksheet %s" % (column_header, sheet_name))
 
-        elif column_header in self.get_link_column_headers(sheet_name):
-            column_dict = [x for x in self.get_sheet_link(sheet_name)["connections"] if x["display_name"] == column_header][0]
-            column_dict["type"] = "text"
-            column_dict["required"] = False  # reqired relationships are not implemented yet, none of them are required in 3.0.5.
+    def _build_sheet_index(self, sheet_name):
+        """
+        Build the read only lookup tables of a sheet once the structure is loaded, so the get_column_* methods never scan the schema.
 
-        else:
-            raise StructureError("Can not find column %s in worksheet %s" % (column_header, sheet_name))
-        return column_dict
+        A schema column wins over a relationship column with the same header, the first column wins over the later ones with the same header.
+        """
+        schema = self.get_sheet_schema(sheet_name)
+        connections = self.get_sheet_link(sheet_name)["connections"]
+        column_dicts = dict()
+        for x in schema:
+            column_dicts.setdefault(x["text"], x)
+        linkto_categories = dict()
+        for x in connections:
+            # reqired relationships are not implemented yet, none of them are required in 3.0.5.
+            # Use a copy, so the "required" in link_dict is still there for the excel template.
+            column_dicts.setdefault(x["display_name"], dict(x, type="text", required=False))
+            linkto_categories.setdefault(x["display_name"], x["to"])
+        schema_headers = tuple(x["text"] for x in schema)
+        link_headers = tuple(x["display_name"] for x in connections)
+        return SheetIndex(schema_headers=schema_headers,
+                          link_headers=link_headers,
+                          schema_header_set=frozenset(schema_headers),
+                          link_header_set=frozenset(link_headers),
+                          link_name_set=frozenset(x["name"] for x in connections),
+                          column_dicts=types.MappingProxyType(column_dicts),
+                          column_names=types.MappingProxyType({k: v["name"] for k, v in column_dicts.items()}),
+                          linkto_categories=types.MappingProxyType(linkto_categories)
+                          )
 
     # def _get_column_info(self, sheet_name, column_header, info):
     #     """
@@ -284,6 +359,6 @@ class MetaStructure:
     #     return info
 
 
-class StructureError:
+class StructureError(Exception):
     """To capture error in metastructure"""
     pass
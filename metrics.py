@@ -0,0 +1,176 @@
+import os
+import re
+import json
+import math
+import time
+import threading
+import contextlib
+import collections
+import urllib.parse
+
+PROMETHEUS_PREFIX = "bulkupload"
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Metrics:
+    def __init__(self):
+        """
+        Wall time per phase and latency, size and status of every http request of a run.
+
+        One Metrics obj is shared by the transport.Transport and everything using it, it is safe to use from several threads.
+        Requests are grouped by endpoint: the method and the url path with accessions and tokens replaced, e.g. "POST /api/litters/<accession>/mouse/add".
+        """
+        self.phases = collections.OrderedDict()  # phase name -> {"seconds", "rows", "calls"}
+        self.requests = collections.OrderedDict()  # endpoint -> {"latencies": [seconds], "bytes_sent", "bytes_received", "status": Counter}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, rows=0):
+        """
+        Time a phase of the run with a with statement. A phase run several times (e.g. once per sheet) is added up.
+
+        :param: rows - the number of rows processed in the phase, use add_rows if it is only known at the end.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                phase = self._get_phase(name)
+                phase["seconds"] += seconds
+                phase["rows"] += rows
+                phase["calls"] += 1
+
+    def add_rows(self, name, rows):
+        with self._lock:
+            self._get_phase(name)["rows"] += rows
+
+    def record_request(self, method, url, seconds, bytes_sent, bytes_received, status):
+        """
+        Record one http request, every retry is recorded on its own.
+
+        :param: status - the http status code, or "error" if there was no response.
+        """
+        endpoint = get_endpoint(method, url)
+        with self._lock:
+            entry = self.requests.get(endpoint)
+            if entry is None:
+                entry = {"latencies": [], "bytes_sent": 0, "bytes_received": 0, "status": collections.Counter()}
+                self.requests[endpoint] = entry
+            entry["latencies"].append(seconds)
+            entry["bytes_sent"] += bytes_sent
+            entry["bytes_received"] += bytes_received
+            entry["status"][str(status)] += 1
+
+    def summary(self):
+        """Return a json serializable dict of all the phases and endpoints."""
+        with self._lock:
+            phases = collections.OrderedDict()
+            for name, phase in self.phases.items():
+                phases[name] = dict(phase, rows_per_second=phase["rows"] / phase["seconds"] if phase["rows"] and phase["seconds"] > 0 else None)
+            endpoints = collections.OrderedDict()
+            for endpoint, entry in self.requests.items():
+                latencies = sorted(entry["latencies"])
+                endpoints[endpoint] = {"count": len(latencies),
+                                       "seconds": sum(latencies),
+                                       "quantiles": {str(q): get_quantile(latencies, q) for q in QUANTILES},
+                                       "bytes_sent": entry["bytes_sent"],
+                                       "bytes_received": entry["bytes_received"],
+                                       "status": dict(entry["status"])
+                                       }
+        return {"phases": phases, "endpoints": endpoints}
+
+    def report(self):
+        """Return the summary as text, for the end of a run."""
+        summary = self.summary()
+        lines = ["%-28s %10s %10s %12s" % ("phase", "seconds", "rows", "rows/s")]
+        for name, phase in summary["phases"].items():
+            rate = "%12.1f" % phase["rows_per_second"] if phase["rows_per_second"] else "%12s" % "-"
+            lines.append("%-28s %10.3f %10d %s" % (name, phase["seconds"], phase["rows"], rate))
+        if summary["endpoints"]:
+            lines.append("")
+            lines.append("%-52s %7s %9s %9s %9s %11s %11s" % ("endpoint", "count", "p50 ms", "p95 ms", "p99 ms", "sent KB", "received KB"))
+            for endpoint, entry in summary["endpoints"].items():
+                quantiles = entry["quantiles"]
+                lines.append("%-52s %7d %9.1f %9.1f %9.1f %11.1f %11.1f" % (endpoint, entry["count"], quantiles["0.5"] * 1000, quantiles["0.95"] * 1000,
+                                                                              quantiles["0.99"] * 1000, entry["bytes_sent"] / 1024.0, entry["bytes_received"] / 1024.0))
+                errors = {k: v for k, v in entry["status"].items() if not k.startswith("2")}
+                if errors:
+                    lines.append("%-52s failed: %s" % ("", ", ".join("%s x %d" % x for x in sorted(errors.items()))))
+        return "\n".join(lines)
+
+    def output(self, profile=False, json_path=None, prometheus_path=None):
+        """Print the report and/or write it to files at the end of a run, as asked by the --profile, --metrics-json and --metrics-prom options."""
+        if profile:
+            print(self.report())
+        if json_path:
+            self.write_json(json_path)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path)
+
+    def write_json(self, path):
+        with open(path, "w") as json_file:
+            json.dump(self.summary(), json_file, indent=2)
+
+    def write_prometheus(self, path):
+        """Write the summary in the prometheus text format, for the node_exporter textfile collector. The file is replaced at once."""
+        summary = self.summary()
+        lines = ["# TYPE %s_phase_seconds gauge" % PROMETHEUS_PREFIX]
+        lines += ['%s_phase_seconds{phase="%s"} %f' % (PROMETHEUS_PREFIX, name, x["seconds"]) for name, x in summary["phases"].items()]
+        lines.append("# TYPE %s_phase_rows gauge" % PROMETHEUS_PREFIX)
+        lines += ['%s_phase_rows{phase="%s"} %d' % (PROMETHEUS_PREFIX, name, x["rows"]) for name, x in summary["phases"].items()]
+        lines.append("# TYPE %s_http_request_duration_seconds summary" % PROMETHEUS_PREFIX)
+        for endpoint, entry in summary["endpoints"].items():
+            label = _escape_label(endpoint)
+            for q in QUANTILES:
+                lines.append('%s_http_request_duration_seconds{endpoint="%s",quantile="%s"} %f' % (PROMETHEUS_PREFIX, label, q, entry["quantiles"][str(q)]))
+            lines.append('%s_http_request_duration_seconds_sum{endpoint="%s"} %f' % (PROMETHEUS_PREFIX, label, entry["seconds"]))
+            lines.append('%s_http_request_duration_seconds_count{endpoint="%s"} %d' % (PROMETHEUS_PREFIX, label, entry["count"]))
+        for direction in ("sent", "received"):
+            lines.append("# TYPE %s_http_bytes_%s_total counter" % (PROMETHEUS_PREFIX, direction))
+            lines += ['%s_http_bytes_%s_total{endpoint="%s"} %d' % (PROMETHEUS_PREFIX, direction, _escape_label(k), x["bytes_" + direction]) for k, x in summary["endpoints"].items()]
+        lines.append("# TYPE %s_http_responses_total counter" % PROMETHEUS_PREFIX)
+        for endpoint, entry in summary["endpoints"].items():
+            lines += ['%s_http_responses_total{endpoint="%s",status="%s"} %d' % (PROMETHEUS_PREFIX, _escape_label(endpoint), status, count) for status, count in sorted(entry["status"].items())]
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(temp_path, path)
+
+    def _get_phase(self, name):
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = {"seconds": 0.0, "rows": 0, "calls": 0}
+            self.phases[name] = phase
+        return phase
+
+
+def get_endpoint(method, url):
+    """
+    "POST", "http://host:7006/api/litters/TRGTLTR0001/mouse/add" -> "POST /api/litters/<accession>/mouse/add"
+
+    The host is dropped, so the same path on the production and the test server is one endpoint.
+    """
+    parts = urllib.parse.urlsplit(url).path.split("/")
+    if len(parts) > 3 and parts[1] == "api" and parts[2] == "usertoken":
+        parts[3] = "<token>"
+    elif len(parts) > 3 and parts[1] == "api":
+        parts[3] = "<accession>"
+    elif len(parts) > 2 and parts[1] == "schema":
+        parts[-1] = "<category>.json"
+    elif len(parts) > 3 and parts[-2] == "submission":  # the data submission api.
+        parts[-1] = "<submission_id>"
+    return method + " " + "/".join(parts)
+
+
+def get_quantile(sorted_values, quantile):
+    """Nearest rank quantile of a sorted list, 0 for an empty list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values), max(1, int(math.ceil(quantile * len(sorted_values))))) - 1
+    return sorted_values[index]
+
+
+def _escape_label(value):
+    return re.sub(r'(["\\])', r"\\\1", value)
@@ -0,0 +1,189 @@
+import io
+import logging
+import contextlib
+import collections
+import concurrent.futures
+
+import xlrd
+
+import sheetreader
+import validator
+import xlsxreader
+
+# The workbook and the reader of a worker process, set by _init_worker.
+_worker = dict()
+
+
+class ParallelReader:
+    def __init__(self, meta_structure, processes, chunk_rows=0, stream=False, all_errors=False):
+        """
+        Read and validate the worksheets of an excel file in worker processes.
+
+        Every worksheet, or every chunk_rows rows of a large worksheet, is a task. A worker opens the excel file itself,
+        reads its rows with SheetReader.read_sheet and sends back the SheetData without meta_structure (see SheetData.__getstate__).
+        The log messages of a worker are sent back too, and logged in the order of the worksheets and the rows,
+        so the output is the same as reading the worksheets one by one, no matter which worker finishes first.
+        :param: meta_structure - the MetaStructure obj, sent to every worker once.
+        :param: processes - the number of worker processes.
+        :param: chunk_rows - split worksheets with more data rows into chunks of chunk_rows rows. 0 means one task per worksheet.
+        With xlrd a worker loads a whole worksheet for its first chunk of it, and keeps it loaded until it gets a chunk of another worksheet.
+        With stream, the worksheet is parsed once by the main process and the workers only read and validate the chunks.
+        :param: stream - open the excel file with xlsxreader.StreamingBook instead of xlrd.
+        :param: all_errors - log the errors of every row, see SheetReader.read_sheet.
+        """
+        self.meta_structure = meta_structure
+        self.processes = max(1, processes)
+        self.chunk_rows = chunk_rows
+        self.stream = stream
+        self.all_errors = all_errors
+
+    def read_sheets(self, file_name, sheet_names):
+        """
+        Yield (sheet_name, sheet_data, validation) of the sheet_names in order, same as SheetReader.read_sheet on every worksheet.
+
+        A worksheet is yielded as soon as all its chunks are done, while the workers go on with the next ones.
+        With stream and chunk_rows, the worksheets are parsed once here with StreamingBook.iter_chunks, and the workers get the parsed chunks,
+        at most two per worker at a time, instead of every worker parsing the worksheet up to its own chunk.
+        """
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                                    initargs=(self.meta_structure, file_name, self.stream, self.all_errors, logging.getLogger().getEffectiveLevel())) as executor:
+            if self.stream and self.chunk_rows > 0:
+                workbook = xlsxreader.StreamingBook(file_name)
+                data_start_row = sheetreader.SheetReader(self.meta_structure).excel_data_start_row
+                for sheet_name in sheet_names:
+                    yield (sheet_name,) + self._merge(self._submit_chunks(executor, workbook, sheet_name, data_start_row))
+                workbook.release_resources()
+                return
+            futures = [(sheet_name, [executor.submit(_read_chunk, sheet_name, start_row, end_row, index == 0) for index, (start_row, end_row) in enumerate(chunks)])
+                       for sheet_name, chunks in self.get_tasks(file_name, sheet_names)]
+            for sheet_name, chunk_futures in futures:
+                yield (sheet_name,) + self._merge(x.result() for x in chunk_futures)
+
+    def _submit_chunks(self, executor, workbook, sheet_name, data_start_row):
+        """Parse a worksheet in chunks and send them to the workers, yield the results of the chunks in order."""
+        pending = collections.deque()
+        for index, sheet_obj in enumerate(workbook.iter_chunks(sheet_name, self.chunk_rows, data_start_row)):
+            pending.append(executor.submit(_read_parsed_chunk, sheet_obj, workbook.datemode, index == 0))
+            if len(pending) >= 2 * self.processes:  # parse ahead of the workers, but not the whole worksheet.
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def _merge(self, chunk_results):
+        """Log the messages of the chunks of a worksheet and return (sheet_data, validation) of all its chunks."""
+        sheet_data = None
+        validation = True
+        for chunk_data, chunk_validation, messages, output in chunk_results:
+            if not validation and not self.all_errors:  # the serial reader never reads past the first invalid row.
+                continue
+            if output:
+                print(output, end="")
+            for level, message in messages:
+                logging.log(level, message)
+            if sheet_data is None:
+                sheet_data = chunk_data
+            else:
+                sheet_data.all_records.extend(chunk_data.all_records)
+            validation = validation and chunk_validation
+        sheet_data.set_meta_structure(self.meta_structure)
+        return sheet_data, validation
+
+    def get_tasks(self, file_name, sheet_names):
+        """
+        Return a list of (sheet_name, [(start_row, end_row), ...]). None means from the first data row, or to the end of the worksheet.
+
+        The last chunk always reads to the end, so trailing empty rows counted in the <dimension> of a .xlsx are handled the same as reading the whole sheet.
+        """
+        data_start_row = sheetreader.SheetReader(self.meta_structure).excel_data_start_row
+        nrows = self._get_nrows(file_name, sheet_names) if self.chunk_rows > 0 else {}
+        tasks = []
+        for sheet_name in sheet_names:
+            end_row = nrows.get(sheet_name)
+            if end_row is None or end_row - data_start_row <= self.chunk_rows:
+                tasks.append((sheet_name, [(None, None)]))
+            else:
+                chunks = [(start, start + self.chunk_rows) for start in range(data_start_row, end_row, self.chunk_rows)]
+                chunks[-1] = (chunks[-1][0], None)
+                tasks.append((sheet_name, chunks))
+        return tasks
+
+    def _get_nrows(self, file_name, sheet_names):
+        if self.stream:
+            workbook = xlsxreader.StreamingBook(file_name)
+            nrows = {x: workbook.get_nrows(x) for x in sheet_names}
+        else:
+            workbook = xlrd.open_workbook(file_name, on_demand=True)
+            nrows = dict()
+            for sheet_name in sheet_names:
+                nrows[sheet_name] = workbook.sheet_by_name(sheet_name).nrows
+                workbook.unload_sheet(sheet_name)
+        workbook.release_resources()
+        return nrows
+
+
+class _MessageHandler(logging.Handler):
+    """Keep the log messages of a worker task, to be logged by the main process."""
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+def _init_worker(meta_structure, file_name, stream, all_errors, log_level):
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):  # messages only go back to the main process.
+        root_logger.removeHandler(handler)
+    root_logger.setLevel(log_level)
+    _worker["reader"] = sheetreader.SheetReader(meta_structure)
+    _worker["validator"] = validator.Validator(meta_structure)
+    _worker["stream"] = stream
+    _worker["all_errors"] = all_errors
+    if stream:
+        _worker["workbook"] = xlsxreader.StreamingBook(file_name)
+    else:
+        _worker["workbook"] = xlrd.open_workbook(file_name, on_demand=True)
+
+
+def _read_chunk(sheet_name, start_row, end_row, check_columns):
+    """Returns (sheet_data, validation, [(level, message)], printed text) of the rows [start_row, end_row) of a worksheet."""
+    workbook = _worker["workbook"]
+    with _capture() as (handler, output):
+        if _worker["stream"]:
+            sheet_obj = workbook.sheet_by_name(sheet_name)
+        else:
+            loaded_sheet = _worker.get("loaded_sheet")
+            if loaded_sheet is not None and loaded_sheet != sheet_name:
+                workbook.unload_sheet(loaded_sheet)  # keep one worksheet in memory, the later chunks of a worksheet go to the same workers.
+            sheet_obj = workbook.sheet_by_name(sheet_name)
+            _worker["loaded_sheet"] = sheet_name
+        sheet_data, validation = _read_sheet_obj(sheet_obj, workbook.datemode, start_row, end_row, check_columns)
+    return sheet_data, validation, handler.messages, output.getvalue()
+
+
+def _read_parsed_chunk(sheet_obj, datemode, check_columns):
+    """Same as _read_chunk, for a chunk from StreamingBook.iter_chunks parsed by the main process."""
+    with _capture() as (handler, output):
+        sheet_data, validation = _read_sheet_obj(sheet_obj, datemode, sheet_obj.start_rowx, None, check_columns)
+    return sheet_data, validation, handler.messages, output.getvalue()
+
+
+def _read_sheet_obj(sheet_obj, datemode, start_row, end_row, check_columns):
+    if check_columns:
+        _worker["validator"].verify_column_names(sheet_obj)
+    return _worker["reader"].read_sheet(sheet_obj, datemode, start_row, end_row, _worker["all_errors"])
+
+
+@contextlib.contextmanager
+def _capture():
+    """Keep the log messages and the printed text of a task, to be sent back to the main process."""
+    handler = _MessageHandler()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(handler)
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            yield handler, output
+    finally:
+        root_logger.removeHandler(handler)
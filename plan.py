@@ -0,0 +1,487 @@
+import sys
+import json
+import logging
+import argparse
+import collections
+
+import metastructure
+import poster
+import bookdata
+import sheetdata
+import rowdata
+import submitter
+import snapshot
+import updateplanner
+import linkwriter
+import transport
+import schemacache
+import journal
+import metrics
+import submission
+
+PLAN_VERSION = 1
+
+# What apply does with a row.
+CREATE = "create"
+UPDATE = "update"
+UNCHANGED = "unchanged"  # only its relationships are updated.
+SKIP = "skip"
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Show what a submission will create, update, link and unlink, then apply exactly that.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    plan_parser = subparsers.add_parser("plan", help="Compare the excel file with the database and save the plan to a json file, nothing is posted.\n")
+    plan_parser.add_argument(
+        '--excel',
+        '-x',
+        action="store",
+        dest="excel",
+        required=True,
+        help="The excel used for bulk upload. Required.\n",
+    )
+    plan_parser.add_argument(
+        '--output',
+        '-o',
+        action="store",
+        dest="output",
+        help="The plan file. default is the excel file name + '.plan.json'.\n",
+    )
+    plan_parser.add_argument(
+        '--update',
+        '-u',
+        action="store_true",
+        dest="isupdate",
+        help="Plan an update of the records with system accessions, same as '--update' of submission.py. It needs a cypher key.\n"
+    )
+    plan_parser.add_argument(
+        '--changed-fields-only',
+        action="store_true",
+        dest="changed_fields_only",
+        help="With the '--update' flag, post only the fields different from the database.\n"
+    )
+    plan_parser.add_argument(
+        '--notest',
+        '-n',
+        action="store_true",
+        dest="isproduction",
+        help="Plan against the production database instead of the test database.\n",
+    )
+    plan_parser.add_argument(
+        '--stream',
+        '-s',
+        action="store_true",
+        dest="stream",
+        help="Read the .xlsx file one worksheet at a time, see submission.py.\n"
+    )
+    plan_parser.add_argument(
+        '--all-errors',
+        '-a',
+        action="store_true",
+        dest="all_errors",
+        help="Check every row and accession of the excel file and report all the errors at once.\n"
+    )
+    plan_parser.add_argument(
+        '--processes',
+        '-p',
+        action="store",
+        dest="processes",
+        type=int,
+        default=1,
+        help="The number of processes reading and validating the worksheets at the same time. default is 1.\n"
+    )
+    plan_parser.add_argument(
+        '--chunk-rows',
+        action="store",
+        dest="chunk_rows",
+        type=int,
+        default=0,
+        help="With --processes, split worksheets with more rows into chunks of this many rows. default is 0.\n"
+    )
+
+    apply_parser = subparsers.add_parser("apply", help="Post exactly the records and relationships of a plan file.\n")
+    apply_parser.add_argument(
+        'plan',
+        action="store",
+        help="The plan file saved by the plan command.\n",
+    )
+    apply_parser.add_argument(
+        '--threads',
+        '-t',
+        action="store",
+        dest="threads",
+        type=int,
+        default=1,
+        help="The max number of records posted to the database at the same time. default is 1.\n"
+    )
+    apply_parser.add_argument(
+        '--resume',
+        '-r',
+        action="store_true",
+        dest="resume",
+        help="Resume an apply stopped by a crash or a lost connection, see submission.py.\n"
+    )
+    apply_parser.add_argument(
+        '--journal',
+        action="store",
+        dest="journal",
+        help="The journal file of the apply. default is the plan file name + '.journal'.\n"
+    )
+
+    for command_parser in (plan_parser, apply_parser):
+        command_parser.add_argument(
+            '--tokenkey',
+            '-k',
+            action="store",
+            dest="token",
+            required=True,
+            help="User's API key. Required.\n",
+        )
+        command_parser.add_argument(
+            '--cypherkey',
+            '-c',
+            action="store",
+            dest="cypher",
+            default='',
+            help="Cypher query API key. The existing records are fetched with a few cypher queries. \
+            With apply, the records are fetched again to make sure they did not change since the plan.\n",
+        )
+        command_parser.add_argument(
+            '--pool-size',
+            action="store",
+            dest="pool_size",
+            type=int,
+            default=10,
+            help="The max number of keep-alive connections to the database. default is 10.\n"
+        )
+        command_parser.add_argument(
+            '--retries',
+            action="store",
+            dest="retries",
+            type=int,
+            default=3,
+            help="How many times a failed request is retried. default is 3.\n"
+        )
+        command_parser.add_argument(
+            '--server',
+            action="store",
+            dest="server",
+            help="For testing only. Send all the requests to another server, e.g. one started by fakeserver.py.\n"
+        )
+        command_parser.add_argument(
+            '--debug',
+            '-d',
+            action="store_true",
+            dest="debug",
+            help="debug or not. with the flag the script will run as debug mode.\n"
+        )
+        command_parser.add_argument(
+            '--profile',
+            action="store_true",
+            dest="profile",
+            help="Print the time spent in every step, and the count and latency of every kind of request at the end.\n"
+        )
+    return parser.parse_args()
+
+
+class Plan:
+    def __init__(self, isupdate, is_production, changed_fields_only=False):
+        """
+        The records to create or update and the relationships to add or remove for a workbook, worked out before anything is posted.
+
+        Every row is a dict with its action (CREATE, UPDATE, UNCHANGED or SKIP), its fields and relationships, and for updates
+        the record in the database it was compared with. The existing records are looked up by system accession in a snapshot.Snapshot
+        and the linked records by user accession in the accession index of the book, so a plan takes a few bulk reads instead of a test submission.
+        :param: isupdate - the run mode, same as Poster.
+        :param: is_production - plan against the production database.
+        :param: changed_fields_only - post only the changed fields of the updated rows.
+        """
+        self.isupdate = isupdate
+        self.is_production = is_production
+        self.changed_fields_only = changed_fields_only
+        self.rows = []  # a list of {"sheet_name", "row", "action", "reason", "schema", "relationships", "fields", "existing"}
+        self.edges = []  # a list of linkwriter.Edge, records to create are named by user accession.
+
+    def add_book(self, book_data, db_poster, record_snapshot=None):
+        """
+        Plan all the rows of a validated and duplication checked book_data, in the order of the sheets and the rows.
+
+        :param: record_snapshot - a loaded snapshot.Snapshot obj, required in update mode.
+        """
+        update_planner = None
+        if self.isupdate:
+            if record_snapshot is None:
+                raise PlanError("Planning an update needs the existing records, please provide a cypher key.")
+            update_planner = updateplanner.UpdatePlanner(book_data.meta_structure, record_snapshot, self.changed_fields_only).plan_book(book_data)
+        for sheet_name, sheet_data in book_data.data.items():
+            for row, record in enumerate(sheet_data.all_records):
+                existing_record = None
+                fields = []
+                if not self.isupdate:
+                    action = CREATE if record.schema["accession"] == "" else SKIP
+                    reason = "" if action == CREATE else "already in the database"
+                else:
+                    reason, fields = update_planner.plans[(sheet_name, row)]
+                    action = {updateplanner.CHANGED: UPDATE, updateplanner.UNCHANGED: UNCHANGED}.get(reason, SKIP)
+                    if action == SKIP:
+                        logging.warning("record %s %s in %s is %s, it is skipped." % (record.schema["accession"], record.schema["user_accession"], sheet_name, reason))
+                    else:
+                        existing_record = record_snapshot.get(sheet_name, record.schema["accession"])
+                self.rows.append({"sheet_name": sheet_name,
+                                  "row": row,
+                                  "action": action,
+                                  "reason": reason,
+                                  "schema": dict(record.schema),
+                                  "relationships": record.relationships,
+                                  "fields": fields,
+                                  "existing": None if existing_record is None else {"schema": existing_record.schema, "relationships": existing_record.relationships}
+                                  })
+                if action != SKIP:
+                    self.edges.extend(self._get_edges(book_data, db_poster, record, action, existing_record))
+
+    def _get_edges(self, book_data, db_poster, record, action, existing_record):
+        """The relationships to add or remove, on a copy of the record with the linked user accessions resolved where the system accession is known."""
+        link_record = rowdata.RowData(record.sheet_name, record.meta_structure)
+        link_record.schema = {"accession": record.schema["accession"] or record.schema["user_accession"]}
+        for column_name, linkto in record.relationships.items():
+            link_record.relationships[column_name] = {linkto_category: [book_data.resolve(linkto_category, x) or x for x in accession_list]
+                                                      for linkto_category, accession_list in linkto.items()}
+        link_record.submission("submitted" if action == CREATE else "updated")
+        return db_poster.get_link_changes(link_record, existing_record)
+
+    def get_counts(self):
+        counts = collections.Counter(x["action"] for x in self.rows)
+        for edge in self.edges:
+            counts["link" if edge.is_add else "unlink"] += 1
+        return counts
+
+    def print_plan(self):
+        """Print every action of the plan and the counts, e.g. "+ create Mouse TRGTUSR0001"."""
+        for x in self.rows:
+            schema = x["schema"]
+            if x["action"] == CREATE:
+                print("+ create %s %s" % (x["sheet_name"], schema["user_accession"]))
+            elif x["action"] == UPDATE:
+                print("~ update %s %s %s (%s)" % (x["sheet_name"], schema["accession"], schema["user_accession"], ", ".join(x["fields"])))
+        for edge in self.edges:
+            print("%s %s %s %s -> %s %s" % ("+ link" if edge.is_add else "- unlink", edge.sheet_name, edge.system_accession, edge.connection_name, edge.linkto_category, edge.linkto_accession))
+        counts = self.get_counts()
+        print("Plan: %d to create, %d to update, %d unchanged, %d skipped, %d relationships to add, %d to remove."
+              % (counts[CREATE], counts[UPDATE], counts[UNCHANGED], counts[SKIP], counts["link"], counts["unlink"]))
+
+    def save(self, path):
+        with open(path, "w") as plan_file:
+            json.dump({"version": PLAN_VERSION,
+                       "update": self.isupdate,
+                       "is_production": self.is_production,
+                       "changed_fields_only": self.changed_fields_only,
+                       "counts": self.get_counts(),
+                       "rows": self.rows,
+                       "edges": [list(x) for x in self.edges]
+                       }, plan_file, indent=1)
+
+    def get_submission(self, meta_structure, db_poster):
+        """
+        Return (book_data, record_snapshot, update_planner) to run the plan with Submitter.submit_book.
+
+        The records are made from the plan, not from the excel file. The existing records are the ones in the plan,
+        so the relationships are compared with the same state as the plan. Skipped rows which would be posted by Poster are left out.
+        """
+        book_data = bookdata.BookData(meta_structure)
+        record_snapshot = snapshot.Snapshot(db_poster)
+        update_planner = updateplanner.UpdatePlanner(meta_structure, record_snapshot, self.changed_fields_only)
+        sheets = collections.OrderedDict()
+        for x in self.rows:
+            if self.isupdate and x["action"] == SKIP and x["schema"]["accession"] != "":  # not in the database.
+                continue
+            sheet_name = x["sheet_name"]
+            sheet_data = sheets.get(sheet_name)
+            if sheet_data is None:
+                sheet_data = sheets[sheet_name] = sheetdata.SheetData(sheet_name, meta_structure)
+            record = sheet_data.new_row()
+            record.schema = dict(x["schema"])
+            record.relationships = x["relationships"]
+            row = len(sheet_data.all_records)
+            sheet_data.add_record(record)
+            if x["existing"] is not None:
+                record_snapshot.add(self._get_existing_record(x, meta_structure))
+            if x["action"] == UPDATE:
+                update_planner.set_plan(sheet_name, row, updateplanner.CHANGED, x["fields"])
+            elif x["action"] == UNCHANGED:
+                update_planner.set_plan(sheet_name, row, updateplanner.UNCHANGED, [])
+        for sheet_data in sheets.values():
+            book_data.add_sheet(sheet_data)
+        if not self.isupdate:
+            return book_data, None, None
+        return book_data, record_snapshot, update_planner
+
+    def _get_existing_record(self, plan_row, meta_structure):
+        existing_record = rowdata.RowData(plan_row["sheet_name"], meta_structure)
+        existing_record.schema = plan_row["existing"]["schema"]
+        existing_record.relationships = plan_row["existing"]["relationships"]
+        return existing_record
+
+    def find_changes(self, meta_structure, db_poster):
+        """
+        Return a list of messages about the database changes since the plan was made, an empty list if the plan still holds.
+
+        Records to update are fetched again and compared with the ones in the plan, this needs a cypher key.
+        In the production database, the user accessions of the records to create must still be new.
+        """
+        messages = []
+        if self.is_production:
+            for sheet_name in collections.OrderedDict.fromkeys(x["sheet_name"] for x in self.rows if x["action"] == CREATE):
+                existing = set(x["user_accession"] for x in db_poster.fetch_user_accession(sheet_name))
+                for x in self.rows:
+                    if x["action"] == CREATE and x["sheet_name"] == sheet_name and x["schema"]["user_accession"] in existing:
+                        messages.append("%s in %s has been created since the plan." % (x["schema"]["user_accession"], sheet_name))
+        planned = [x for x in self.rows if x["existing"] is not None]
+        if planned and not db_poster.has_cypher:
+            logging.warning("No cypher key, the records to update are not checked for changes since the plan.")
+            return messages
+        fresh_snapshot = snapshot.Snapshot(db_poster)
+        for sheet_name in collections.OrderedDict.fromkeys(x["sheet_name"] for x in planned):
+            fresh_snapshot.load(sheet_name, [x["schema"]["accession"] for x in planned if x["sheet_name"] == sheet_name])
+        data_types = updateplanner.UpdatePlanner(meta_structure, fresh_snapshot)
+        for x in planned:
+            sheet_name = x["sheet_name"]
+            accession = x["schema"]["accession"]
+            fresh_record = fresh_snapshot.get(sheet_name, accession)
+            if fresh_record is None:
+                messages.append("%s in %s has been deleted since the plan." % (accession, sheet_name))
+                continue
+            field_types = data_types.get_data_types(sheet_name)
+            planned_schema = x["existing"]["schema"]
+            fields = set(planned_schema) | set(fresh_record.schema)
+            if any(updateplanner.normalize(planned_schema.get(k), field_types.get(k)) != updateplanner.normalize(fresh_record.schema.get(k), field_types.get(k)) for k in fields):
+                messages.append("%s in %s has been changed since the plan." % (accession, sheet_name))
+            elif _sorted_links(x["existing"]["relationships"]) != _sorted_links(fresh_record.relationships):
+                messages.append("The relationships of %s in %s have been changed since the plan." % (accession, sheet_name))
+        return messages
+
+
+def _sorted_links(relationships):
+    return {column_name: {linkto_category: sorted(x for x in accession_list if x != "") for linkto_category, accession_list in linkto.items()}
+            for column_name, linkto in relationships.items()}
+
+
+def load_plan(path):
+    """Return the Plan saved in path."""
+    with open(path) as plan_file:
+        saved = json.load(plan_file)
+    if saved.get("version") != PLAN_VERSION:
+        raise PlanError("%s is not a plan file of this version." % path)
+    saved_plan = Plan(saved["update"], saved["is_production"], saved["changed_fields_only"])
+    saved_plan.rows = saved["rows"]
+    saved_plan.edges = [linkwriter.Edge(*x) for x in saved["edges"]]
+    return saved_plan
+
+
+class PlanError(Exception):
+    """Errors making, loading or applying a plan"""
+    pass
+
+
+def connect(args, is_production, is_update, run_metrics):
+    """Return (meta_structure, db_poster), exits if the database can not be reached."""
+    http_transport = transport.Transport(pool_maxsize=max(args.pool_size, getattr(args, "threads", 1)), retries=args.retries, run_metrics=run_metrics)
+    try:
+        with run_metrics.phase("load_structure"):
+            meta_structure = metastructure.MetaStructure(is_production, http_transport=http_transport, schema_cache=schemacache.SchemaCache(), meta_url=args.server, submit_url=args.server)
+    except (metastructure.StructureError, transport.TransportError) as structure_error:
+        sys.exit("Unable to get the database structure: %s" % structure_error)
+    try:
+        cypher_url = args.server + poster.CYPHER_PATH if args.server else None
+        db_poster = poster.Poster(args.token, args.cypher, is_update, is_production, meta_structure, cypher_url)
+    except transport.TransportError as transport_error:
+        sys.exit("Unable to verify the API key: %s" % transport_error)
+    return meta_structure, db_poster
+
+
+def make_plan(args, run_metrics):
+    meta_structure, db_poster = connect(args, args.isproduction, args.isupdate, run_metrics)
+    if args.isupdate and not db_poster.has_cypher:
+        sys.exit("Planning an update needs the existing records, please provide a cypher key.")
+    book_data, validation = submission.read_book(args, meta_structure, db_poster, run_metrics)
+    if not validation:
+        sys.exit("Please fix the errors in the excel file first.")
+    print("successfully validated all the data in the excel file!")
+    record_snapshot = None
+    if args.isupdate:
+        record_snapshot = snapshot.Snapshot(db_poster)
+        try:
+            with run_metrics.phase("prefetch_records"):
+                record_snapshot.load_book(book_data)
+        except transport.TransportError as transport_error:
+            sys.exit("Unable to fetch the existing records: %s" % transport_error)
+    new_plan = Plan(args.isupdate, args.isproduction, args.changed_fields_only)
+    try:
+        with run_metrics.phase("plan"):
+            new_plan.add_book(book_data, db_poster, record_snapshot)
+    except transport.TransportError as transport_error:
+        sys.exit("Unable to fetch the existing records: %s" % transport_error)
+    new_plan.print_plan()
+    output = args.output or args.excel + ".plan.json"
+    new_plan.save(output)
+    print("The plan is saved to %s, run it with: python3 plan.py apply %s -k <API key>" % (output, output))
+
+
+def apply_plan(args, run_metrics):
+    try:
+        saved_plan = load_plan(args.plan)
+    except (OSError, ValueError, KeyError, PlanError) as plan_error:
+        sys.exit("Unable to load the plan %s: %s" % (args.plan, plan_error))
+    meta_structure, db_poster = connect(args, saved_plan.is_production, saved_plan.isupdate, run_metrics)
+    submission_journal = journal.Journal(args.journal or args.plan + ".journal")
+    if submission_journal.exists():
+        if not args.resume:
+            sys.exit("Journal %s of an unfinished apply exists, please use --resume to continue it, or delete it to start again." % submission_journal.path)
+        submission_journal.load()
+    else:  # a resumed apply changed the database itself.
+        try:
+            with run_metrics.phase("check_plan"):
+                changes = saved_plan.find_changes(meta_structure, db_poster)
+        except transport.TransportError as transport_error:
+            sys.exit("Unable to check the plan against the database: %s" % transport_error)
+        if changes:
+            for message in changes:
+                logging.error(message)
+            sys.exit("The database has been changed since the plan, please make a new plan.")
+    counts = saved_plan.get_counts()
+    print("Applying the plan: %d to create, %d to update, %d relationships to add, %d to remove." % (counts[CREATE], counts[UPDATE], counts["link"], counts["unlink"]))
+    book_data, record_snapshot, update_planner = saved_plan.get_submission(meta_structure, db_poster)
+    submission_journal.open()
+    record_submitter = submitter.Submitter(db_poster, meta_structure, args.threads, submission_journal, saved_plan.changed_fields_only)
+    try:
+        record_submitter.submit_book(book_data, record_snapshot, update_planner)
+        record_submitter.save_submission(book_data)
+    except journal.JournalError as journal_error:
+        submission_journal.close()
+        sys.exit(journal_error)
+    failures = db_poster.report_failures()
+    if failures:
+        submission_journal.close()
+        logging.error("%d post requests failed, please fix them and apply the plan again with --resume!" % failures)
+    else:
+        submission_journal.remove()
+
+
+def main():
+    args = get_args()
+    if args.debug:
+        logging.getLogger().setLevel(logging.DEBUG)
+    else:
+        logging.getLogger().setLevel(logging.INFO)
+        logging.getLogger("requests").setLevel(logging.WARNING)
+    run_metrics = metrics.Metrics()
+    if args.command == "plan":
+        make_plan(args, run_metrics)
+    else:
+        apply_plan(args, run_metrics)
+    run_metrics.output(args.profile)
+
+
+if __name__ == "__main__":
+    main()
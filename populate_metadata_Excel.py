@@ -14,6 +14,9 @@ import argparse
 import metastructure
 import sheetreader
 import poster
+import transport
+import schemacache
+import metrics
 
 
 def get_args():
@@ -74,6 +77,32 @@ def get_args():
         dest="csv",
         help="write the data in seperated csv files.\n",
     )
+    parser.add_argument(
+        '--offline',
+        '-o',
+        action="store_true",
+        dest="offline",
+        help="Use the database structure saved by the last run, without any connection to the database. \
+        Only works for the empty excel template.\n",
+    )
+    parser.add_argument(
+        '--profile',
+        action="store_true",
+        dest="profile",
+        help="Print the time spent in every step, and the count and latency of every kind of request at the end.\n",
+    )
+    parser.add_argument(
+        '--metrics-json',
+        action="store",
+        dest="metrics_json",
+        help="Write the timings and request metrics to this json file at the end.\n",
+    )
+    parser.add_argument(
+        '--metrics-prom',
+        action="store",
+        dest="metrics_prom",
+        help="Write the timings and request metrics to this file in the prometheus text format at the end.\n",
+    )
     return parser.parse_args()
 
 
@@ -81,11 +110,17 @@ def main():
     args = get_args()
     logging.getLogger().setLevel(logging.INFO)
     is_production = args.is_production or args.notest
+    if args.offline and (args.submission or args.user):
+        sys.exit("--offline only works for the empty excel template!")
 
+    run_metrics = metrics.Metrics()
     try:
-        meta_structure = metastructure.MetaStructure(is_production)
+        with run_metrics.phase("load_structure"):
+            meta_structure = metastructure.MetaStructure(is_production, http_transport=transport.Transport(run_metrics=run_metrics), schema_cache=schemacache.SchemaCache(), offline=args.offline)
     except metastructure.StructureError as structure_error:
         sys.exit(structure_error)
+    except transport.TransportError as transport_error:
+        sys.exit(transport_error)
 
     # meta_structure = submission_oo.MetaStructure.start_metastructure(is_production, ALL_CATEGORIES, SCHEMA_STRING, RELATIONSHIP_STRING, VERSION_STRING)
     version_dict = meta_structure.version
@@ -105,8 +140,9 @@ def main():
         workbook = xlsxwriter.Workbook('TaRGET_metadata_sub_' + submission + '_V' + version + '.xlsx')  # The submission should be extracted, replace url
         reader.write_book_header(workbook)
         book_data = db_poster.fetch_submission(submission)
-        reader.write_book(workbook, book_data)
-        workbook.close()
+        with run_metrics.phase("write_excel", sum(len(x.all_records) for x in book_data.data.values())):
+            reader.write_book(workbook, book_data)
+            workbook.close()
     elif args.user:
         user = args.user
         workbook = xlsxwriter.Workbook('TaRGET_metadata_sub_' + user + '-V' + version + '.xlsx')  # The submission should be extracted, replace url
@@ -115,12 +151,14 @@ def main():
         #     cypher_json = json.load(file)
         # book_data = db_poster.read_cypher(cypher_json, 'Assay')
         book_data = db_poster.fetch_user_all(user)
-        reader.write_book(workbook, book_data)
-        workbook.close()
+        with run_metrics.phase("write_excel", sum(len(x.all_records) for x in book_data.data.values())):
+            reader.write_book(workbook, book_data)
+            workbook.close()
     else:
         workbook = xlsxwriter.Workbook('TaRGET_metadata_V' + version + '.xlsx')
         reader.write_book_header(workbook)
         workbook.close()
+    run_metrics.output(args.profile, args.metrics_json, args.metrics_prom)
 
 
 if __name__ == "__main__":
@@ -1,27 +1,43 @@
-import sys
 import json
-import requests
 import logging
+import transport
 import bookdata
 import sheetdata
 import rowdata
+import linkwriter
 
 TIMEOUT = 60
-PROD_URL = "http://10.20.127.31:6474/db/data/cypher"
-DEV_URL = "http://10.20.127.31:8474/db/data/cypher"
+CYPHER_PATH = "/db/data/cypher"
+PROD_URL = "http://10.20.127.31:6474" + CYPHER_PATH
+DEV_URL = "http://10.20.127.31:8474" + CYPHER_PATH
 DATA_SUBMIT_URL = "https://5dum6c4ytb.execute-api.us-east-1.amazonaws.com/dev"
 
 
 class Poster:
-    def __init__(self, token, cypher, isupdate, is_production, meta_structure):
+    def __init__(self, token, cypher, isupdate, is_production, meta_structure, cypher_url=None):
+        """
+        Post and fetch records of the database, using the urls of meta_structure.
+
+        :param: cypher_url - use another cypher endpoint instead of PROD_URL or DEV_URL, e.g. a fakeserver.FakeServer.
+        """
         self.token = token
         self.token_key = 'bearer ' + token
         self.neo4j_key = 'Basic ' + cypher
+        self.has_cypher = cypher != ''
         self.isupdate = isupdate
         self.is_production = is_production
         self.meta_structure = meta_structure
+        self.transport = meta_structure.transport  # share the keep-alive connections with meta_structure.
+        self.metrics = self.transport.metrics
+        self.failed_records = []  # records failed to post, a list of (sheet_name, accession, user_accession, error).
+        self.failed_links = []  # links failed to post, a list of (sheet_name, system_accession, linkto_accession_list, error).
         self.meta_url = self.meta_structure.action_url_meta
         self.submit_url = self.meta_structure.action_url_submit
+        if cypher_url is not None:
+            self.cypher_url = cypher_url
+        else:
+            self.cypher_url = PROD_URL if is_production else DEV_URL
+        self.record_decoder = rowdata.RecordDecoder(meta_structure)
         self.token_header = {"Authorization": self.token_key}
         self.cypher_header = {'accept': "application/json, text/plain, */*",
                               'x-stream': "true",
@@ -34,7 +50,7 @@ class Poster:
     def set_username(self):
         ''' Set user name based on the token key. However, an error would occur if the token key is neo4j token'''
         token_url = self.submit_url + '/api/usertoken/' + self.token
-        return requests.get(token_url, timeout=TIMEOUT).json()["username"]
+        return self.transport.get(token_url, timeout=TIMEOUT)["username"]
 
     def get_sheet_info(self, sheet_name):
         meta_url = self.meta_url
@@ -45,39 +61,96 @@ class Poster:
     def fetch_record(self, sheet_name, system_accession):
         meta_url, category, categories = self.get_sheet_info(sheet_name)
         get_url = meta_url + '/api/' + categories + '/' + system_accession
-        main_obj = requests.get(get_url, timeout=TIMEOUT).json()["mainObj"]
+        main_obj = self.transport.get(get_url, timeout=TIMEOUT)["mainObj"]
         record = rowdata.RowData(sheet_name, self.meta_structure)
         record.schema = main_obj[category]
         record.relationships = main_obj["added"]
         return record
 
+    def fetch_records(self, sheet_name, system_accessions):
+        """
+        Fetch the properties and relationships of many records of a sheet with a single cypher query, instead of one fetch_record each.
+
+        :return: a list of RowData of the accessions found, decoded the same as fetch_user_all. Missing accessions are left out.
+        """
+        meta_structure = self.meta_structure
+        statement = "MATCH (n) WHERE {category} IN labels(n) AND n.accession IN {accessions} " \
+                    "OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} " \
+                    "RETURN n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added"
+        post_body = {"query": statement,
+                     "params": {"category": meta_structure.get_category(sheet_name),
+                                "accessions": list(system_accessions),
+                                "schema_categories": list(meta_structure.category_to_sheet_name.keys())
+                                },
+                     "includeStats": "true"
+                     }
+        response = self._post(self.cypher_url, headers=self.cypher_header, data=json.dumps(post_body))
+        return [self.record_decoder.decode(sheet_name, node["data"], connections) for node, connections in response['data'] if node is not None]
+
     def fetch_all(self, sheet_name):
         meta_url, category, categories = self.get_sheet_info(sheet_name)
         user_name = self.user_name
         get_url = self.meta_url + '/api/' + categories
-        response = requests.get(get_url, timeout=TIMEOUT).json()
+        response = self.transport.get(get_url, timeout=TIMEOUT)
         full_list = response[categories]  # returns a list of existing records.
         return [x for x in full_list if x['user'] == user_name]
 
-    def fetch_all_accession(self, sheet_name):
+    def fetch_all_accession(self, sheet_name, user=None):
         """
         Using cypher query to query a list of {system_accession:value, user_accession:value, user:value} for a given sheet.
         Gonna replace the method fetch_all.
+
+        :param: user - only query the records of the user if it is provided, the filter runs on the database.
         """
-        statement = "MATCH(sheet:{sheet_name}) WITH collect({system_accession:sheet.accession,user_accession:sheet.user_accession,user:sheet.user}) AS all_accession RETURN all_accession"
-        if self.is_production:
-            post_url = PROD_URL
+        category = self.meta_structure.get_category(sheet_name)
+        if user is None:
+            statement = "MATCH (n) WHERE {category} IN labels(n) RETURN n.accession, n.user_accession, n.user"
         else:
-            post_url = DEV_URL
+            statement = "MATCH (n) WHERE {category} IN labels(n) AND n.user={name} RETURN n.accession, n.user_accession, n.user"
+        post_body = {"query": statement,
+                     "params": {"category": category,
+                                "name": user
+                                },
+                     "includeStats": "true"
+                     }
+
+        response = self._post(self.cypher_url, headers=self.cypher_header, data=json.dumps(post_body))
+        return [{"system_accession": x[0], "user_accession": x[1], "user": x[2]} for x in response['data']]
+
+    def fetch_accession_changes(self, sheet_name, date_modified=None, accession=None):
+        """
+        Same as fetch_all_accession of all the users, plus n.date_modified, but only the records changed since a high-water mark.
 
+        A record is returned if it was modified at or after date_modified, or if its system accession comes after accession (longer, or the same length and greater),
+        so records without a modification time are still found once they are created. Without both, all the records are returned.
+        :return: a list of {system_accession, user_accession, user, date_modified}.
+        """
+        category = self.meta_structure.get_category(sheet_name)
+        if date_modified is None and accession is None:
+            statement = "MATCH (n) WHERE {category} IN labels(n) RETURN n.accession, n.user_accession, n.user, n.date_modified"
+        else:
+            statement = "MATCH (n) WHERE {category} IN labels(n) AND (n.date_modified >= {date_modified} " \
+                        "OR size(n.accession) > size({accession}) OR (size(n.accession) = size({accession}) AND n.accession > {accession})) " \
+                        "RETURN n.accession, n.user_accession, n.user, n.date_modified"
         post_body = {"query": statement,
-                     "params": {"sheet_name": sheet_name
+                     "params": {"category": category,
+                                "date_modified": date_modified or "",
+                                "accession": accession or ""
                                 },
                      "includeStats": "true"
                      }
+        response = self._post(self.cypher_url, headers=self.cypher_header, data=json.dumps(post_body))
+        return [{"system_accession": x[0], "user_accession": x[1], "user": x[2], "date_modified": x[3]} for x in response['data']]
 
-        response = self._post(post_url, headers=self.cypher_header, data=json.dumps(post_body))
-        return response['data']['row']
+    def fetch_user_accession(self, sheet_name):
+        """
+        Return a list of {accession:value, user_accession:value} of all the records of the user in a sheet.
+
+        With a cypher key, only the user's accessions are queried; otherwise all the records are fetched with fetch_all.
+        """
+        if self.has_cypher:
+            return [{"accession": x["system_accession"], "user_accession": x["user_accession"]} for x in self.fetch_all_accession(sheet_name, self.user_name)]
+        return self.fetch_all(sheet_name)
 
     def read_cypher(self, json, sheet_name):
         """
@@ -88,128 +161,76 @@ class Poster:
         sheet_data = sheetdata.SheetData(sheet_name, meta_structure)
         book_data.add_sheet(sheet_data)
         for data in json['data']:
-            record = rowdata.RowData(sheet_name, meta_structure)
-            record.schema = data["row"][0]
-            # initiate empty record relationship strcuture:
-            for column_header in meta_structure.get_link_column_headers(sheet_name):
-                # do link stuff
-                column_name = meta_structure.get_column_name(sheet_name, column_header)
-                sheetlinkto = meta_structure.get_linkto(sheet_name, column_header)
-                categorylinkto = meta_structure.get_category(sheetlinkto)
-                if column_name in record.relationships:
-                    record.relationships[column_name][categorylinkto] = []
-                else:
-                    record.relationships[column_name] = {categorylinkto: []}
-            for connection in data["row"][1]:
-                record.relationships[connection['connection']][connection['to'][0]].append(connection['accession'])  # may change r, to m to more meaningful variable names.
+            record = self.record_decoder.decode(sheet_name, data["row"][0], data["row"][1])
             sheet_data.add_record(record)
         return book_data
 
     def fetch_user_all(self, user):
         """
         send cypher query, get the json string, and convert to book_data. Download all records for a specific user.
+
+        All the categories are fetched with a single query, rows are split into sheets by the labels of the node.
         """
-        meta_structure = self.meta_structure
         # statement = "OPTIONAL MATCH (n)-[r]->(m) WHERE n.user={name} AND {tab} IN labels(n) RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added ORDER BY n.user_accession"
         # no_relation_statment = "OPTIONAL MATCH (n) WHERE n.user={name} AND {tab} IN labels(n) AND NOT (n)-->() RETURN distinct n as schema, [] as added ORDER BY n.user_accession"
         # statement = "OPTIONAL MATCH (n)-[r]->(m) WHERE {tab} IN labels(n) RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added ORDER BY n.accession"
         # no_relation_statment = "OPTIONAL MATCH (n) WHERE {tab} IN labels(n) AND NOT (n)-->() RETURN distinct n as schema, [] as added ORDER BY n.accession"
         if user == "all":
-            single_statement = "MATCH (n) WHERE {tab} IN labels(n) OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added ORDER BY toInteger(substring(n.accession, 8))"
+            statement = "MATCH (n) WHERE any(tab IN labels(n) WHERE tab IN {schema_categories}) " \
+                        "OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} " \
+                        "RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added, labels(n) as tabs " \
+                        "ORDER BY toInteger(substring(n.accession, 8))"
         else:
-            single_statement = "MATCH (n) WHERE n.user={name} AND {tab} IN labels(n) OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added ORDER BY n.user_accession"
-        if self.is_production:
-            post_url = PROD_URL
-        else:
-            post_url = DEV_URL
-
-        book_data = bookdata.BookData(meta_structure)
-        schema_category_list = list(meta_structure.category_to_sheet_name.keys())
-        for category, sheet_name in meta_structure.category_to_sheet_name.items():
-            sheet_data = sheetdata.SheetData(sheet_name, meta_structure)
-            book_data.add_sheet(sheet_data)
-            logging.info("Fetching %s" % sheet_name)
-            post_body = {"query": single_statement,
-                         "params": {"name": user,
-                                    "tab": category,
-                                    "schema_categories": schema_category_list
-                                    },
-                         "includeStats": "true"
-                         }
-            response = self._post(post_url, headers=self.cypher_header, data=json.dumps(post_body))
-
-            # import ipdb; ipdb.set_trace()
-            for data in response['data']:
-                if data[0] is not None:
-                    record = rowdata.RowData(sheet_name, meta_structure)
-                    record.schema = data[0]["data"]
-                    # initiate empty record relationship strcuture:
-                    for column_header in meta_structure.get_link_column_headers(sheet_name):
-                        # do link stuff
-                        column_name = meta_structure.get_column_name(sheet_name, column_header)
-                        sheetlinkto = meta_structure.get_linkto(sheet_name, column_header)
-                        categorylinkto = meta_structure.get_category(sheetlinkto)
-                        if column_name in record.relationships:
-                            record.relationships[column_name][categorylinkto] = []
-                        else:
-                            record.relationships[column_name] = {categorylinkto: []}
-                    for connection in data[1]:
-                        if not connection['connection'] == 'na' and connection['connection'] in meta_structure.get_link_column_names(sheet_name):
-                            record.relationships[connection['connection']][connection['to'][0]].append(connection['accession'])  # may change r, to m to more meaningful variable names.
-                    sheet_data.add_record(record)
-        return book_data
+            statement = "MATCH (n) WHERE n.user={name} AND any(tab IN labels(n) WHERE tab IN {schema_categories}) " \
+                        "OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} " \
+                        "RETURN distinct n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added, labels(n) as tabs " \
+                        "ORDER BY n.user_accession"
+        return self._fetch_book(statement, {"name": user})
 
     def fetch_submission(self, submission):
         """
         returns a workbook per submission using cypher
+
+        The [*0..5] traversal runs once for all the categories, rows are split into sheets by the labels of the node.
         """
+        statement = "MATCH (f:file)-[*0..5]->(n) WHERE f.submission_id={submission} " \
+                    "WITH DISTINCT n WHERE any(tab IN labels(n) WHERE tab IN {schema_categories}) " \
+                    "OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories} " \
+                    "RETURN n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added, labels(n) as tabs " \
+                    "ORDER BY n.user_accession"
+        return self._fetch_book(statement, {"submission": submission})
+
+    def _fetch_book(self, statement, params):
+        """
+        Post a single cypher statement returning (schema, added, tabs) rows for all the categories, returns a book_data with one sheet per category.
 
+        A node is added to every sheet matching one of its labels, in the order of the returned rows.
+        The sheets are sheetdata.ColumnarSheetData, and every row of the response is dropped once it is copied into the columns, to export the whole database in less memory.
+        """
         meta_structure = self.meta_structure
-        single_statement = "MATCH (f:file)-[*0..5]->(n) WHERE f.submission_id={submission} AND {tab} IN labels(n) " \
-                           "WITH DISTINCT n " \
-                           "OPTIONAL MATCH (n)-[r]->(m) WHERE labels(m) IN {schema_categories}" \
-                           "RETURN n as schema, collect({connection:coalesce(type(r),'na'),to:coalesce(labels(m),'na'),accession:coalesce(m.accession,'na')}) as added " \
-                           "ORDER BY n.user_accession"
-        if self.is_production:
-            post_url = PROD_URL
-        else:
-            post_url = DEV_URL
-
         book_data = bookdata.BookData(meta_structure)
-        schema_category_list = list(meta_structure.category_to_sheet_name.keys())
         for category, sheet_name in meta_structure.category_to_sheet_name.items():
-            sheet_data = sheetdata.SheetData(sheet_name, meta_structure)
-            book_data.add_sheet(sheet_data)
-            # print category
-            logging.info("Fetching %s" % sheet_name)
-            post_body = {"query": single_statement,
-                         "params": {"submission": submission,
-                                    "tab": category,
-                                    "schema_categories": schema_category_list
-                                    },
-                         "includeStats": "true"
-                         }
-            response = self._post(post_url, headers=self.cypher_header, data=json.dumps(post_body))
-
-            # import ipdb; ipdb.set_trace()
-            for data in response['data']:
-                if data[0] is not None:
-                    record = rowdata.RowData(sheet_name, meta_structure)
-                    record.schema = data[0]["data"]
-                    # initiate empty record relationship strcuture:
-                    for column_header in meta_structure.get_link_column_headers(sheet_name):
-                        # do link stuff
-                        column_name = meta_structure.get_column_name(sheet_name, column_header)
-                        sheetlinkto = meta_structure.get_linkto(sheet_name, column_header)
-                        categorylinkto = meta_structure.get_category(sheetlinkto)
-                        if column_name in record.relationships:
-                            record.relationships[column_name][categorylinkto] = []
-                        else:
-                            record.relationships[column_name] = {categorylinkto: []}
-                    for connection in data[1]:
-                        if not connection['connection'] == 'na' and connection['connection'] in meta_structure.get_link_column_names(sheet_name):
-                            record.relationships[connection['connection']][connection['to'][0]].append(connection['accession'])  # may change r, to m to more meaningful variable names.
-                    sheet_data.add_record(record)
+            book_data.add_sheet(sheetdata.ColumnarSheetData(sheet_name, meta_structure))
+        params = dict(params, schema_categories=list(meta_structure.category_to_sheet_name.keys()))
+        post_body = {"query": statement,
+                     "params": params,
+                     "includeStats": "true"
+                     }
+        logging.info("Fetching %s" % ", ".join(book_data.data.keys()))
+        with self.metrics.phase("cypher_export"):
+            response = self._post(self.cypher_url, headers=self.cypher_header, data=json.dumps(post_body))
+        self.metrics.add_rows("cypher_export", len(response['data']))
+
+        rows = response['data']
+        for row_index, data in enumerate(rows):
+            rows[row_index] = None
+            node, connections, tabs = data
+            if node is None:
+                continue
+            sheet_names = [meta_structure.category_to_sheet_name[x] for x in tabs if x in meta_structure.category_to_sheet_name]
+            for sheet_name in sheet_names:  # the columns keep their own copy of the values, no need to copy the node.
+                record = self.record_decoder.decode(sheet_name, node["data"], connections)
+                book_data.data[sheet_name].add_record(record)
         return book_data
 
     def fetch_submission_dep(self, submission):
@@ -219,8 +240,7 @@ class Poster:
 
         meta_structure = self.meta_structure
         book_data = bookdata.BookData(meta_structure)
-        entries_string = submission["details"]
-        whole_data = json.loads(entries_string.replace("'", "\""))  # Gets a list of all accessions created for that object category
+        whole_data = self.get_submission_details(submission)
         for sheet_name in meta_structure.schema_dict.keys():
             sheet_data = sheetdata.SheetData(sheet_name, meta_structure)
             book_data.add_sheet(sheet_data)
@@ -237,6 +257,11 @@ class Poster:
                     sheet_data.add_record(record_row)
         return book_data
 
+    def get_submission_details(self, submission):
+        """Return {category: [accessions]} of a saved submission."""
+        entries_string = submission["details"]
+        return json.loads(entries_string.replace("'", "\""))  # Gets a list of all accessions created for that object category
+
     def fetch_file_info(self, submission_id):
         '''
         From data submission experiment design fetch useful infomation, return a book_data to be filled in an excel.
@@ -249,8 +274,8 @@ class Poster:
         url2 = DATA_SUBMIT_URL + '/submission/' + submission_id
 
         # Collecting attributes from schema
-        all_files = requests.get(url1, timeout=TIMEOUT).json()['body']
-        submission_json = requests.get(url2, timeout=TIMEOUT).json()['body'][0]
+        all_files = self.transport.get(url1, timeout=TIMEOUT)['body']
+        submission_json = self.transport.get(url2, timeout=TIMEOUT)['body'][0]
         # files = [x for x in all_files if x['submission'] == submission_id]
         dataphase = submission_json['data_phase'] if "data_phase" in submission_json else 'pilot'
         read_type = submission_json['read_type']
@@ -276,7 +301,7 @@ class Poster:
             sheet_data.add_record(record)
         return book_data
 
-    def submit_record(self, row_data):
+    def submit_record(self, row_data, fields=None):
         """
         The row_data is validated, but update, submit, test, is_production are processed the same until now.
         submit or update record row_data to database. if it is not is_production, replace accession with random string and submit.
@@ -294,6 +319,7 @@ class Poster:
                     submit request
             else
                 skip
+        :param: fields - for an update, post only these fields and the user accession. None posts all the fields.
         """
         isupdate = self.isupdate
         is_production = self.is_production
@@ -317,7 +343,16 @@ class Poster:
         if valid:
             post_body = row_data.schema
             accession = row_data.remove("accession")  # it is essentially a dict pop.
-            response = self._post(post_url, headers=self.token_header, data=post_body)
+            if isupdate and fields is not None:
+                post_body = {k: v for k, v in post_body.items() if k in fields or k == "user_accession"}
+            try:
+                response = self._post(post_url, headers=self.token_header, data=post_body, idempotent=isupdate)  # an update can be posted again, a new record can not.
+            except transport.TransportError as transport_error:
+                row_data.schema["accession"] = accession
+                row_data.submission("failed")
+                self.failed_records.append((sheet_name, accession, user_accession, str(transport_error)))
+                logging.error("post request of %s %s in %s failed!" % (accession, user_accession, sheet_name))
+                return
 
             # save the submission:
             if response["statusCode"] == 200:
@@ -334,15 +369,23 @@ class Poster:
                     row_data.submission("updated")
                     logging.info("successfully updated record %s %s in %s." % (accession, user_accession, sheet_name))
             else:
+                row_data.schema["accession"] = accession
+                row_data.submission("failed")
+                self.failed_records.append((sheet_name, accession, user_accession, response["message"]))
                 logging.error("post request of %s %s in %s failed!" % (accession, user_accession, sheet_name))
                 logging.error(response["message"])
 
     def link_record(self, row_data):
         sheet_name = row_data.sheet_name
         system_accession = row_data.schema["accession"]
-        if row_data.submission() == "updated":
+        if row_data.submission() in ("updated", "unchanged"):
             # fetch existing record:
-            existing_record = self.fetch_record(sheet_name, system_accession)
+            try:
+                existing_record = self.fetch_record(sheet_name, system_accession)
+            except transport.TransportError as transport_error:
+                self.failed_links.append((sheet_name, system_accession, [], str(transport_error)))
+                logging.error("Unable to fetch existing record %s in %s, skip its relationships!" % (system_accession, sheet_name))
+                return
             self.update_link(existing_record, row_data)
         if row_data.submission() == "submitted":
             self.submit_link(row_data)
@@ -351,30 +394,13 @@ class Poster:
         """
         Update the link if the link is different between existing_record and row_data.
         """
-        sheet_name = row_data.sheet_name
-        system_accession = row_data.schema["accession"]
-        for column_name in row_data.relationships:
-            for linkto_category in row_data.relationships[column_name]:
-                new_accession_set = set(row_data.relationships[column_name][linkto_category])
-                try:
-                    existing_accession_set = set(existing_record.relationships[column_name][linkto_category][0])
-                except:
-                    print("Unable to get existing relationships of records %s in %s!" % (system_accession, sheet_name))
-                # only change accession difference.
-                to_add = list(new_accession_set - existing_accession_set)
-                to_remove = list(existing_accession_set - new_accession_set)
-                if to_add == [] and to_remove == []:
-                    print("No change to relationship of records %s in %s!" % (system_accession, sheet_name))
-                self.link_change(sheet_name, system_accession, linkto_category, to_remove, column_name, is_add=False)
-                self.link_change(sheet_name, system_accession, linkto_category, to_add, column_name, is_add=True)
+        edges = self.get_link_changes(row_data, existing_record)
+        if edges == []:
+            logging.info("No change to relationship of records %s in %s!" % (row_data.schema["accession"], row_data.sheet_name))
+        linkwriter.LinkWriter(self).write(edges)
 
     def submit_link(self, row_data):
-        sheet_name = row_data.sheet_name
-        system_accession = row_data.schema["accession"]
-        for column_name in row_data.relationships:
-            for linkto_category in row_data.relationships[column_name]:
-                accession_list = row_data.relationships[column_name][linkto_category]
-                self.link_change(sheet_name, system_accession, linkto_category, accession_list, column_name, is_add=True)
+        linkwriter.LinkWriter(self).write(self.get_link_changes(row_data))
 
     def link_change(self, sheet_name, system_accession, linkto_category, linkto_accession_list, connection_name, is_add):
         """
@@ -386,30 +412,86 @@ class Poster:
 
         if len(linkto_accession_list) > 0 and linkto_accession_list != ['']:  # skip empty accessions.
             if is_add:
-                direction = "add"
+                self.post_link(sheet_name, system_accession, linkto_category, connection_name, linkto_accession_list, is_add)
             else:
-                direction = "remove"
-            meta_url, category, categories = self.get_sheet_info(sheet_name)
-            linkurl = meta_url + '/api/' + categories + '/' + system_accession + '/' + linkto_category + '/' + direction  # direction should be add or remove
-            # link_body = {"connectionAcsn": linkto_accession_list, "connectionName": connection_name}
-            if direction == "remove":  # temp fix for single accession removal.
-                for single_accession in linkto_accession_list:  # temp fix for single accession removal.
-                    link_body = {"connectionAcsn": single_accession, "connectionName": connection_name}  # temp fix for single accession removal.
-            else:  # temp fix for single accession removal.
-                link_body = {"connectionAcsn": linkto_accession_list, "connectionName": connection_name}  # temp fix for single accession removal.
+                for single_accession in linkto_accession_list:  # the remove api only takes a single accession.
+                    self.post_link(sheet_name, system_accession, linkto_category, connection_name, single_accession, is_add)
 
-            response = self._post(linkurl, headers=self.token_header, data=json.dumps(link_body))
+    def get_link_changes(self, row_data, existing_record=None):
+        """
+        Return a list of linkwriter.Edge, the relationships to add or remove for a submitted, updated or unchanged record.
 
-            if response["statusCode"] == 200:
-                if is_add:
-                    logging.info("successfully connected %s in %s to %s!" % (system_accession, sheet_name, linkto_accession_list))
+        For an updated or unchanged record, only the difference from existing_record is returned. The existing record is fetched if it is not provided.
+        Empty accessions and links to the record itself are skipped.
+        """
+        sheet_name = row_data.sheet_name
+        system_accession = row_data.schema["accession"]
+        submission = row_data.submission()
+        if submission == "unchanged":  # the fields are the same as in the database, the relationships may not.
+            submission = "updated"
+        if submission == "updated":
+            if existing_record is None:
+                existing_record = self.fetch_record(sheet_name, system_accession)
+        elif submission != "submitted":
+            return []
+        edges = []
+        for column_name in row_data.relationships:
+            for linkto_category in row_data.relationships[column_name]:
+                accession_list = row_data.relationships[column_name][linkto_category]
+                if submission == "updated":
+                    existing_accession_list = self._get_existing_links(existing_record, column_name, linkto_category)
+                    # only change accession difference.
+                    to_add = [x for x in accession_list if x not in existing_accession_list]
+                    to_remove = [x for x in existing_accession_list if x not in accession_list]
                 else:
-                    logging.info("successfully removed relationship from %s in %s to %s!" % (system_accession, sheet_name, linkto_accession_list))
+                    to_add = accession_list
+                    to_remove = []
+                for is_add, accessions in ((False, to_remove), (True, to_add)):
+                    for accession in accessions:
+                        if accession != "" and accession != system_accession:
+                            edges.append(linkwriter.Edge(sheet_name, system_accession, linkto_category, column_name, accession, is_add))
+        return edges
+
+    def _get_existing_links(self, existing_record, column_name, linkto_category):
+        """fetch_record wraps every accession list in another list ({column_name: {category: [[accessions]]}}), fetch_records does not."""
+        try:
+            accession_list = existing_record.relationships[column_name][linkto_category]
+            if len(accession_list) > 0 and isinstance(accession_list[0], list):
+                accession_list = accession_list[0]
+            return list(accession_list)
+        except (KeyError, IndexError, TypeError):
+            logging.warning("Unable to get existing relationships of records %s in %s!" % (existing_record.schema.get("accession"), existing_record.sheet_name))
+            return []
+
+    def post_link(self, sheet_name, system_accession, linkto_category, connection_name, linkto_accession, is_add):
+        """
+        Post a single add or remove link request, returns True if it is successful.
+
+        :param: linkto_accession - a list of accessions to add, or a single accession to remove.
+        """
+        direction = "add" if is_add else "remove"
+        meta_url, category, categories = self.get_sheet_info(sheet_name)
+        linkurl = meta_url + '/api/' + categories + '/' + system_accession + '/' + linkto_category + '/' + direction  # direction should be add or remove
+        link_body = {"connectionAcsn": linkto_accession, "connectionName": connection_name}
+        try:
+            response = self._post(linkurl, headers=self.token_header, data=json.dumps(link_body))
+        except transport.TransportError as transport_error:
+            response = {"statusCode": None, "message": str(transport_error)}
+
+        if response["statusCode"] == 200:
+            if is_add:
+                logging.info("successfully connected %s in %s to %s!" % (system_accession, sheet_name, linkto_accession))
             else:
-                logging.error("failed to connect %s in %s to %s!" % (system_accession, sheet_name, linkto_accession_list))
-                logging.error(response["message"])
+                logging.info("successfully removed relationship from %s in %s to %s!" % (system_accession, sheet_name, linkto_accession))
+            return True
+        else:
+            self.failed_links.append((sheet_name, system_accession, linkto_accession, response["message"]))
+            logging.error("failed to connect %s in %s to %s!" % (system_accession, sheet_name, linkto_accession))
+            logging.error(response["message"])
+            return False
 
     def save_submission(self, book_data):
+        """Save the accessions of submitted or updated records as a submission, returns True if it is saved."""
         isupdate = self.isupdate
         submission_log = dict()
         for sheet_name, sheet_data in book_data.data.items():
@@ -424,28 +506,30 @@ class Poster:
         saved_submission_url = self.submit_url + "/api/submission"
         if bool(submission_log):  # Only save not empty submissions, and also save update submissions.
             submission_body = {"details": json.dumps(submission_log), "update": isupdate}
-            submitted_response = self._post(saved_submission_url, headers=self.token_header, data=submission_body)
+            try:
+                submitted_response = self._post(saved_submission_url, headers=self.token_header, data=submission_body, idempotent=False)
+            except transport.TransportError as transport_error:
+                submitted_response = {"statusCode": None, "message": str(transport_error)}
 
             if submitted_response["statusCode"] == 201:
                 logging.info("Submission has been successfully saved as %s!" % submitted_response["submission_id"])
+                return True
             else:
                 logging.error("Fail to save submission!")
+        return False
 
-    def _post(self, url, headers, data, timeout=TIMEOUT):
-        try:
-            r = requests.post(url, headers=headers, data=data, timeout=timeout)
-            r.raise_for_status()
-        except requests.exceptions.HTTPError as errh:
-            logging.error(r.content)
-            sys.exit("Http Error: %s" % errh)
-        except requests.exceptions.ConnectionError as errc:
-            logging.error(r.content)
-            sys.exit("Error Connecting %s:" % errc)
-        except requests.exceptions.Timeout as errt:
-            logging.error(r.content)
-            sys.exit("Timeout Error: %s" % errt)
-        except requests.exceptions.RequestException as err:
-            logging.error(r.content)
-            sys.exit(err)
-        response = r.json()
-        return response
+    def report_failures(self):
+        """Log all the failed record and link post requests, returns the number of failures."""
+        for sheet_name, accession, user_accession, error in self.failed_records:
+            logging.error("failed to post record %s %s in %s: %s" % (accession, user_accession, sheet_name, error))
+        for sheet_name, system_accession, linkto_accession_list, error in self.failed_links:
+            logging.error("failed to link %s in %s to %s: %s" % (system_accession, sheet_name, linkto_accession_list, error))
+        return len(self.failed_records) + len(self.failed_links)
+
+    def _post(self, url, headers, data, timeout=TIMEOUT, idempotent=True):
+        """
+        Post the data and return the json response. Raise transport.TransportError if it still fails after retries.
+
+        :param: idempotent - False if posting it twice makes two records, then it is not retried once it may have reached the server.
+        """
+        return self.transport.post(url, headers=headers, data=data, timeout=timeout, idempotent=idempotent)
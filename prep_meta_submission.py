@@ -12,6 +12,8 @@ import argparse
 import metastructure
 import sheetreader
 import poster
+import transport
+import schemacache
 
 
 def get_args():
@@ -35,9 +37,11 @@ def main():
     logging.getLogger().setLevel(logging.INFO)
 
     try:
-        meta_structure = metastructure.MetaStructure(is_production)
+        meta_structure = metastructure.MetaStructure(is_production, schema_cache=schemacache.SchemaCache())
     except metastructure.StructureError as structure_error:
         sys.exit(structure_error)
+    except transport.TransportError as transport_error:
+        sys.exit(transport_error)
 
     # meta_structure = submission_oo.MetaStructure.start_metastructure(is_production, ALL_CATEGORIES, SCHEMA_STRING, RELATIONSHIP_STRING, VERSION_STRING)
     version_dict = meta_structure.version
@@ -1,4 +1,5 @@
 import uuid  # used to generate unique user accesion if it is not provided.
+import collections.abc
 
 
 class RowData:
@@ -8,12 +9,22 @@ class RowData:
         self.schema = dict()
         self.relationships = dict()
 
+    def __getstate__(self):
+        """Pickle without meta_structure, see SheetData.set_meta_structure."""
+        state = self.__dict__.copy()
+        state.pop("meta_structure", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.meta_structure = None
+
     def add(self, column_header, value):
         """Add or replace value in column. Convert "NA" in link columns to "". """
         sheet_name = self.sheet_name
         meta_structure = self.meta_structure
         column_name = meta_structure.get_column_name(sheet_name, column_header)
-        if column_header in meta_structure.get_link_column_headers(sheet_name):
+        if meta_structure.is_link_column(sheet_name, column_header):
             # do link stuff
             if value == "NA":
                 value = ""
@@ -24,7 +35,7 @@ class RowData:
                 self.relationships[column_name][categorylinkto] = accession_list
             else:
                 self.relationships[column_name] = {categorylinkto: accession_list}
-        elif column_header in meta_structure.get_schema_column_headers(sheet_name):
+        elif meta_structure.is_schema_column(sheet_name, column_header):
             self.schema[column_name] = value
         else:
             raise RowError("unknown column %s in %s!" % (column_header, sheet_name))
@@ -74,6 +85,136 @@ class RowData:
         self.schema["user_accession"] = new_user_accession
 
 
+class RecordView:
+    """
+    A row of a sheetdata.ColumnarSheetData, with the same attributes and methods as RowData.
+
+    .schema and .relationships are views of the columns, a change made through them is a change of the sheet.
+    The old accession and the submission are kept in the sheet too, so every view of the same row shares them.
+    """
+    __slots__ = ("sheet_data", "row")
+
+    def __init__(self, sheet_data, row):
+        self.sheet_data = sheet_data
+        self.row = row
+
+    @property
+    def sheet_name(self):
+        return self.sheet_data.name
+
+    @property
+    def meta_structure(self):
+        return self.sheet_data.meta_structure
+
+    @property
+    def schema(self):
+        return SchemaView(self.sheet_data, self.row)
+
+    @property
+    def relationships(self):
+        return self.sheet_data.get_relationships(self.row)
+
+    def old_accession(self, old_accession=""):
+        """Same as RowData.old_accession."""
+        if old_accession == "":
+            return self.sheet_data.old_accessions.get(self.row, "")
+        self.sheet_data.old_accessions[self.row] = old_accession
+
+    def submission(self, submission=""):
+        """Same as RowData.submission."""
+        if submission == "":
+            return self.sheet_data.submissions.get(self.row, "")
+        self.sheet_data.submissions[self.row] = submission
+
+    remove = RowData.remove
+    replace_accession = RowData.replace_accession
+
+
+class SchemaView(collections.abc.MutableMapping):
+    """The schema dict of a RecordView."""
+    __slots__ = ("sheet_data", "row")
+
+    def __init__(self, sheet_data, row):
+        self.sheet_data = sheet_data
+        self.row = row
+
+    def __getitem__(self, column_name):
+        return self.sheet_data.get_value(self.row, column_name)
+
+    def __setitem__(self, column_name, value):
+        self.sheet_data.set_value(self.row, column_name, value)
+
+    def __delitem__(self, column_name):
+        self.sheet_data.delete_value(self.row, column_name)
+
+    def __iter__(self):
+        return iter(self.sheet_data.get_column_names(self.row))
+
+    def __len__(self):
+        return len(self.sheet_data.get_column_names(self.row))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class LinkList(list):
+    """The accessions of a relationship of a RecordView. Replacing an accession (accession_list[index] = value) changes the sheet."""
+    __slots__ = ("link_column", "row")
+
+    def __init__(self, link_column, row):
+        list.__init__(self, link_column.get(row))
+        self.link_column = link_column
+        self.row = row
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self.link_column.set(self.row, self)
+
+
+class RecordDecoder:
+    def __init__(self, meta_structure):
+        """
+        Turn the node properties and relationships returned by cypher into RowData objects.
+
+        The empty relationship structure of a sheet is worked out once and copied for every row.
+        """
+        self.meta_structure = meta_structure
+        self._templates = dict()  # sheet_name -> a tuple of (column_name, (linkto categories)).
+
+    def get_template(self, sheet_name):
+        """Return the empty relationship structure of a sheet, as a tuple of (column_name, (categorylinkto, ...))."""
+        template = self._templates.get(sheet_name)
+        if template is None:
+            meta_structure = self.meta_structure
+            columns = dict()
+            for column_header in meta_structure.get_link_column_headers(sheet_name):
+                column_name = meta_structure.get_column_name(sheet_name, column_header)
+                sheetlinkto = meta_structure.get_linkto(sheet_name, column_header)
+                categorylinkto = meta_structure.get_category(sheetlinkto)
+                categories = columns.setdefault(column_name, [])
+                if categorylinkto not in categories:
+                    categories.append(categorylinkto)
+            template = tuple((column_name, tuple(categories)) for column_name, categories in columns.items())
+            self._templates[sheet_name] = template
+        return template
+
+    def decode(self, sheet_name, schema, connections):
+        """
+        :param: schema - the node properties.
+        :param: connections - a list of {connection, to, accession}. Connections not in the sheet (including "na") are skipped.
+        :return: a RowData obj.
+        """
+        record = RowData(sheet_name, self.meta_structure)
+        record.schema = schema
+        relationships = {column_name: {x: [] for x in categories} for column_name, categories in self.get_template(sheet_name)}
+        for connection in connections:
+            linkto = relationships.get(connection['connection'])
+            if linkto is not None:
+                linkto.setdefault(connection['to'][0], []).append(connection['accession'])
+        record.relationships = relationships
+        return record
+
+
 class RowError:
     """Errors process row data in excel file"""
     pass
@@ -0,0 +1,61 @@
+import os
+import json
+import hashlib
+import logging
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "TargetBulkUpload")
+
+
+class SchemaCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        """
+        A local copy of schema_dict, link_dict and version of MetaStructure, one json file per server url.
+
+        :param: cache_dir - the directory to keep the json files.
+        """
+        self.cache_dir = cache_dir
+
+    def get_path(self, url):
+        """Return the path of the cache file for a server url."""
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, "schema_" + name + ".json")
+
+    def load(self, url, all_categories, version=None):
+        """
+        Return the cached {"version", "schema_dict", "link_dict"} of the server url, or None if it is not usable.
+
+        :param: url - the meta_url of the server.
+        :param: all_categories - the categories the cache must cover.
+        :param: version - the current version from the server. The cache is only used if it was saved with the same version. With None, any version is accepted (offline mode).
+        """
+        path = self.get_path(url)
+        try:
+            with open(path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, ValueError) as error:
+            logging.debug("Unable to read schema cache %s: %s" % (path, error))
+            return None
+        if cached.get("url") != url or cached.get("categories") != list(all_categories):
+            return None
+        if version is not None and cached.get("version") != version:
+            logging.info("Database structure changed, refresh the schema cache.")
+            return None
+        return cached
+
+    def save(self, url, all_categories, version, schema_dict, link_dict):
+        """Write the structure of a server to the cache. Save it before any local change to schema_dict."""
+        path = self.get_path(url)
+        cached = {"url": url,
+                  "categories": list(all_categories),
+                  "version": version,
+                  "schema_dict": schema_dict,
+                  "link_dict": link_dict
+                  }
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as cache_file:
+                json.dump(cached, cache_file)
+            os.replace(temp_path, path)  # never leave a half written cache.
+        except (IOError, OSError) as error:
+            logging.warning("Unable to write schema cache %s: %s" % (path, error))
@@ -1,3 +1,7 @@
+import sys
+import array
+import collections.abc
+
 import rowdata
 
 
@@ -11,9 +15,259 @@ class SheetData:
         # eg.
         # http://biopython.org/DIST/docs/api/Bio.Align-pysrc.html#MultipleSeqAlignment
 
+    def __getstate__(self):
+        """Pickle without meta_structure, so a sheet read in a worker process is small. Call set_meta_structure after unpickling."""
+        state = self.__dict__.copy()
+        state.pop("meta_structure", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.meta_structure = None
+
+    def set_meta_structure(self, meta_structure):
+        """Attach meta_structure to the sheet and all its records."""
+        self.meta_structure = meta_structure
+        for record in self.all_records:
+            record.meta_structure = meta_structure
+
     def add_record(self, row_data):
         self.all_records.append(row_data)
 
     def new_row(self):
         row_data = rowdata.RowData(self.name, self.meta_structure)
         return row_data
+
+
+class _Missing:
+    """The value of a column in the rows without it. Pickled by name, so it is still the same obj after unpickling."""
+    def __reduce__(self):
+        return "MISSING"
+
+    def __repr__(self):
+        return "MISSING"
+
+
+MISSING = _Missing()
+INTERNED_COLUMNS = frozenset(["accession", "user_accession", "user"])  # repeated across rows and relationships, one str obj each.
+TYPED_COLUMNS = {int: "q", float: "d"}
+
+
+class ColumnarSheetData:
+    def __init__(self, sheet_name, meta_structure):
+        """
+        Same as SheetData, but the records are kept column by column instead of one RowData per row, for the large books downloaded by populate_metadata_Excel.py.
+
+        A schema column is an array.array while all its values are int (or all float), otherwise a list with MISSING for the rows without the column.
+        Accessions and relationships are interned strings. The relationships of every (column_name, category) are one flat list of accessions with the offsets of every row.
+        all_records returns rowdata.RecordView objs, the .schema and .relationships of a view read and write the columns.
+        """
+        self.name = sheet_name
+        self.meta_structure = meta_structure
+        self.row_count = 0
+        self.columns = dict()  # column_name -> array.array or list.
+        self.links = dict()  # (column_name, category) -> LinkColumn.
+        self.old_accessions = dict()  # row -> the user accession replaced by RecordView.replace_accession.
+        self.submissions = dict()  # row -> the submission of the row, see RowData.submission.
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("meta_structure", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.meta_structure = None
+
+    def set_meta_structure(self, meta_structure):
+        self.meta_structure = meta_structure
+
+    @property
+    def all_records(self):
+        return RecordList(self)
+
+    def new_row(self):
+        return rowdata.RowData(self.name, self.meta_structure)
+
+    def add_record(self, row_data):
+        """Copy the schema and relationships of a RowData into the columns, row_data is not kept."""
+        self.add_row(row_data.schema, row_data.relationships)
+
+    def add_row(self, schema, relationships):
+        row = self.row_count
+        columns = self.columns
+        for column_name in columns:
+            if column_name not in schema:
+                self._append(column_name, MISSING)
+        for column_name, value in schema.items():
+            if column_name not in columns:
+                typecode = TYPED_COLUMNS.get(type(value)) if row == 0 else None
+                columns[column_name] = array.array(typecode) if typecode else [MISSING] * row
+            self._append(column_name, value)
+        links = self.links
+        present = set()
+        for column_name, linkto in relationships.items():
+            for category, accession_list in linkto.items():
+                key = (column_name, category)
+                link = links.get(key)
+                if link is None:
+                    link = LinkColumn(row)
+                    links[key] = link
+                link.append(accession_list)
+                present.add(key)
+        if len(present) < len(links):
+            for key, link in links.items():
+                if key not in present:
+                    link.append_missing()
+        self.row_count = row + 1
+
+    def get_value(self, row, column_name):
+        """Raises KeyError if the row does not have the column, same as RowData.schema[column_name]."""
+        column = self.columns.get(column_name)
+        if column is None:
+            raise KeyError(column_name)
+        value = column[row]
+        if value is MISSING:
+            raise KeyError(column_name)
+        return value
+
+    def set_value(self, row, column_name, value):
+        column = self.columns.get(column_name)
+        if column is None:
+            column = [MISSING] * self.row_count
+            self.columns[column_name] = column
+        elif isinstance(column, array.array):
+            if TYPED_COLUMNS.get(type(value)) == column.typecode:
+                try:
+                    column[row] = value
+                    return
+                except OverflowError:
+                    pass
+            column = self._to_list(column_name)
+        column[row] = self._intern(column_name, value)
+
+    def delete_value(self, row, column_name):
+        self.get_value(row, column_name)  # raises KeyError if it is not there.
+        column = self.columns[column_name]
+        if isinstance(column, array.array):
+            column = self._to_list(column_name)
+        column[row] = MISSING
+
+    def get_column_names(self, row):
+        """The schema columns of a row, in the order they were first seen in the sheet."""
+        return [column_name for column_name, column in self.columns.items() if column[row] is not MISSING]
+
+    def get_relationships(self, row):
+        """Returns {column_name: {category: [accessions]}} of a row, same as RowData.relationships. Changing an accession in the lists changes the sheet."""
+        relationships = dict()
+        for (column_name, category), link in self.links.items():
+            if row not in link.missing:
+                relationships.setdefault(column_name, dict())[category] = rowdata.LinkList(link, row)
+        return relationships
+
+    def _append(self, column_name, value):
+        column = self.columns[column_name]
+        if isinstance(column, array.array):
+            if TYPED_COLUMNS.get(type(value)) == column.typecode:
+                try:
+                    column.append(value)
+                    return
+                except OverflowError:
+                    pass
+            column = self._to_list(column_name)
+        column.append(self._intern(column_name, value))
+
+    def _to_list(self, column_name):
+        column = list(self.columns[column_name])
+        self.columns[column_name] = column
+        return column
+
+    def _intern(self, column_name, value):
+        if column_name in INTERNED_COLUMNS and type(value) is str:
+            return sys.intern(value)
+        return value
+
+
+class LinkColumn:
+    """
+    The accessions of one (column_name, category) relationship of every row, the accessions of row i are values[offsets[i]:offsets[i + 1]].
+
+    The rows changed by set are kept in changed instead, their part of values is out of date until the next rebuild.
+    """
+    __slots__ = ("offsets", "values", "missing", "changed")
+
+    def __init__(self, rows=0):
+        self.offsets = array.array("q", [0] * (rows + 1))
+        self.values = []
+        self.missing = set(range(rows))  # rows without the relationship at all, not even an empty list.
+        self.changed = dict()  # row -> the accessions set since the last rebuild.
+
+    def append(self, accession_list):
+        self.values.extend(sys.intern(x) if type(x) is str else x for x in accession_list)
+        self.offsets.append(len(self.values))
+
+    def append_missing(self):
+        self.missing.add(len(self.offsets) - 1)
+        self.offsets.append(len(self.values))
+
+    def get(self, row):
+        accession_list = self.changed.get(row)
+        if accession_list is not None:
+            return list(accession_list)
+        return self.values[self.offsets[row]:self.offsets[row + 1]]
+
+    def set(self, row, accession_list):
+        """
+        Replace the accessions of a row, without moving the offsets of the following rows.
+
+        Once a quarter of the rows are changed, values and offsets are rebuilt in one pass, so changing every row of a sheet is linear.
+        """
+        self.changed[row] = [sys.intern(x) if type(x) is str else x for x in accession_list]
+        self.missing.discard(row)
+        if len(self.changed) * 4 >= len(self.offsets):
+            self.rebuild()
+
+    def rebuild(self):
+        """Copy the changed rows into values and offsets."""
+        if not self.changed:
+            return
+        changed = self.changed
+        old_values, old_offsets = self.values, self.offsets
+        values = []
+        offsets = array.array("q", [0])
+        for row in range(len(old_offsets) - 1):
+            accession_list = changed.get(row)
+            if accession_list is None:
+                values.extend(old_values[old_offsets[row]:old_offsets[row + 1]])
+            else:
+                values.extend(accession_list)
+            offsets.append(len(values))
+        self.values = values
+        self.offsets = offsets
+        self.changed = dict()
+
+
+class RecordList(collections.abc.Sequence):
+    """ColumnarSheetData.all_records, a RecordView is made for a row only when it is asked for."""
+    __slots__ = ("sheet_data",)
+
+    def __init__(self, sheet_data):
+        self.sheet_data = sheet_data
+
+    def __len__(self):
+        return self.sheet_data.row_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(len(self)))]
+        count = self.sheet_data.row_count
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError("record index out of range")
+        return rowdata.RecordView(self.sheet_data, index)
+
+    def __iter__(self):
+        sheet_data = self.sheet_data
+        for row in range(sheet_data.row_count):
+            yield rowdata.RecordView(sheet_data, row)
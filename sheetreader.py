@@ -21,52 +21,84 @@ class SheetReader:  # Of cause, the Reader can write, too.
         :return: a list of all column headers in the worksheet
         """
         excel_header_row = self.excel_header_row
-        return [str(sheet_obj.cell(excel_header_row, col_index).value).rstrip() for col_index in range(sheet_obj.ncols)]  # start from row number 1 to skip header
+        return [str(value).rstrip() for value in sheet_obj.row_values(excel_header_row)]  # start from row number 1 to skip header
 
-    def read_sheet(self, sheet_obj, datemode):  # read excel file. I need to test this function.
+    def read_sheet(self, sheet_obj, datemode, start_row=None, end_row=None, all_errors=False):  # read excel file. I need to test this function.
         """
+        Read the sheet column by column: validate the values and cell types of a whole column in one call with
+        Validator.get_column_batch_audit, then build the rows from the validated columns.
+
         :param: sheet_obj - The xlrd sheet object.
         :param: datemode - The workbook.datemode got from xlrd workbook class.
+        :param: start_row, end_row - only read the rows in [start_row, end_row), to read a large sheet in chunks. Default is all the data rows.
+        :param: all_errors - log the errors of every row, instead of stopping at the first invalid row. Invalid rows are never added.
+        Every message starts with the row number in excel (from 1), and the column header for the errors of a cell.
         returns a fully validated SheetData object.
         """
-        schema_headers = self.meta_structure.get_schema_column_headers(sheet_obj.name)
-        link_headers = self.meta_structure.get_link_column_headers(sheet_obj.name)
+        sheet_name = sheet_obj.name
+        meta_structure = self.meta_structure
         column_headers = self.get_sheet_headers(sheet_obj)
-        sheet_data = sheetdata.SheetData(sheet_obj.name, self.meta_structure)
-        data_validator = validator.Validator(self.meta_structure)
+        sheet_data = sheetdata.SheetData(sheet_name, meta_structure)
+        data_validator = validator.Validator(meta_structure)
+        start_row = self.excel_data_start_row if start_row is None else start_row
+        end_row = sheet_obj.nrows if end_row is None else end_row
+        columns = []  # a list of (column_header, validated values) of the database columns.
+        row_problems = dict()  # row offset -> [(logging level, message)], in the order of the columns.
+        for col_index, column_header in enumerate(column_headers):
+            if meta_structure.is_schema_column(sheet_name, column_header) or meta_structure.is_link_column(sheet_name, column_header):
+                column_audit = data_validator.get_column_batch_audit(sheet_name, column_header)
+                values, problems = column_audit(sheet_obj.col_values(col_index, start_row, end_row), sheet_obj.col_types(col_index, start_row, end_row), datemode)
+                columns.append((column_header, values))
+                for row_offset, level, message in problems:
+                    row_problems.setdefault(row_offset, []).append((level, "Row %d, column %s: %s" % (start_row + row_offset + 1, column_header, message)))
+
         validation = True
-        for row_index in range(self.excel_data_start_row, sheet_obj.nrows):
+        for row_offset in range(max(end_row - start_row, 0)):
             row_data = sheet_data.new_row()
-            for col_index in range(sheet_obj.ncols):
-                column_header = column_headers[col_index]
-                if column_header in schema_headers or column_header in link_headers:
-                    # column_name = SheetData.get_column_name(column_header)
-                    # data_type = SheetData.get_data_type(column_header)
-                    # islink = SheetData.islink(column_header)
-                    cell_obj = sheet_obj.cell(row_index, col_index)  # the cell obj from xlrd
-                    try:
-                        value = data_validator.cell_value_audit(sheet_data.name, column_header, cell_obj, datemode)
-                    except validator.ValidatorError as validator_error:
-                        logging.error(validator_error)
-                        validation = False
-                    except TypeError as type_error:
-                        logging.error(type_error)
-                        validation = False
-                    row_data.add(column_header, value)
+            row_validation = True
+            for level, message in row_problems.get(row_offset, ()):
+                logging.log(level, message)
+                if level >= logging.ERROR:
+                    row_validation = False
+            for column_header, values in columns:
+                row_data.add(column_header, values[row_offset])
 
             try:
                 data_validator.row_value_audit(row_data)
             except validator.ValidatorError as validator_error:
-                logging.error(validator_error)
-                validation = False
+                logging.error("Row %d: %s" % (start_row + row_offset + 1, validator_error))
+                row_validation = False
             except TypeError as type_error:
-                logging.error(type_error)
+                logging.error("Row %d: %s" % (start_row + row_offset + 1, type_error))
+                row_validation = False
+            if not row_validation:
                 validation = False
-            if not validation:
+                if all_errors:
+                    continue
                 break
             sheet_data.add_record(row_data)
         return sheet_data, validation
 
+    def read_chunks(self, sheet_chunks, datemode, all_errors=False):
+        """
+        Read the chunks of one worksheet from xlsxreader.StreamingBook.iter_chunks, same as read_sheet on the whole worksheet.
+
+        :param: sheet_chunks - an iterable of the StreamingSheet chunks, parsed as they are asked for.
+        returns (sheet_data, validation) of all the chunks.
+        """
+        sheet_data = None
+        validation = True
+        for sheet_obj in sheet_chunks:
+            chunk_data, chunk_validation = self.read_sheet(sheet_obj, datemode, sheet_obj.start_rowx, all_errors=all_errors)
+            if sheet_data is None:
+                sheet_data = chunk_data
+            else:
+                sheet_data.all_records.extend(chunk_data.all_records)
+            validation = validation and chunk_validation
+            if not validation and not all_errors:  # read_sheet never reads past the first invalid row.
+                break
+        return sheet_data, validation
+
     def write_book_header(self, workbook, csv_ready=False):
         excel_header_row = self.excel_header_row
         if excel_header_row < 1 and csv_ready:
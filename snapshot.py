@@ -0,0 +1,47 @@
+import logging
+
+BATCH_SIZE = 1000  # accessions per cypher query.
+
+
+class Snapshot:
+    def __init__(self, db_poster, batch_size=BATCH_SIZE):
+        """
+        The current properties and relationships of the existing records of a workbook, fetched before they are updated.
+
+        Records are fetched with Poster.fetch_records, one cypher query per sheet and batch_size accessions, instead of one Poster.fetch_record per record.
+        Used by linkwriter.LinkWriter to find the relationships to add or remove for the updated records.
+        :param: db_poster - the Poster obj, with a cypher key.
+        :param: batch_size - the max number of accessions in one query.
+        """
+        self.db_poster = db_poster
+        self.batch_size = max(1, batch_size)
+        self.records = dict()  # (sheet_name, system_accession) -> RowData
+
+    def load(self, sheet_name, system_accessions):
+        """Fetch the records of system_accessions in sheet_name, the ones already loaded are skipped. Returns the number of records found."""
+        accessions = list(dict.fromkeys(x for x in system_accessions if x != "" and (sheet_name, x) not in self.records))
+        found = 0
+        for start in range(0, len(accessions), self.batch_size):
+            for record in self.db_poster.fetch_records(sheet_name, accessions[start:start + self.batch_size]):
+                self.records[(sheet_name, record.schema["accession"])] = record
+                found += 1
+        if found < len(accessions):
+            logging.warning("%d of %d records in %s are not in the database." % (len(accessions) - found, len(accessions), sheet_name))
+        return found
+
+    def load_book(self, book_data):
+        """Fetch all the records with a system accession in book_data, the ones to be updated."""
+        for sheet_name, sheet_data in book_data.data.items():
+            self.load(sheet_name, [x.schema.get("accession", "") for x in sheet_data.all_records])
+        return self
+
+    def add(self, record):
+        """Add a RowData of an existing record without fetching it, e.g. the one saved by plan.Plan."""
+        self.records[(record.sheet_name, record.schema["accession"])] = record
+
+    def get(self, sheet_name, system_accession):
+        """Return the RowData of the record before the update, None if it was not fetched."""
+        return self.records.get((sheet_name, system_accession))
+
+    def __len__(self):
+        return len(self.records)
@@ -1,8 +1,12 @@
+import os
 import sys
 import xlrd
 import json
 import argparse
+import itertools
 import logging
+import zipfile
+import tempfile
 import unittest
 
 import metastructure
@@ -10,6 +14,23 @@ import sheetreader
 import poster
 import validator
 import bookdata
+import submitter
+import transport
+import schemacache
+import xlsxreader
+import journal
+import fakeserver
+import metrics
+import parallelreader
+import accessionindex
+import accessionmirror
+import rowdata
+import sheetdata
+import linkgraph
+import linkwriter
+import snapshot
+import updateplanner
+import plan
 
 
 def get_args():
@@ -54,8 +75,16 @@ def get_args():
         '-k',
         action="store",
         dest="token",
-        required=True,
-        help="User's API key. Required.\n",
+        default='',
+        help="User's API key. Required, except with --offline.\n",
+    )
+    parser.add_argument(
+        '--cypherkey',
+        '-c',
+        action="store",
+        dest="cypher",
+        default='',
+        help="Cypher query API key. Optional. With it, only your own accessions are queried during the duplication check.\n",
     )
     parser.add_argument(
         '--update',
@@ -70,6 +99,13 @@ def get_args():
         system accession (only update filled columns). it will complain with an error if no matching system \
         accession is found in the database.\n"
     )
+    parser.add_argument(
+        '--changed-fields-only',
+        action="store_true",
+        dest="changed_fields_only",
+        help="With the '--update' flag and a cypher key, post only the fields different from the database. \
+        Without it, all the fields of a changed record are posted. Records without any change are never posted.\n"
+    )
     parser.add_argument(
         '--debug',
         '-d',
@@ -77,10 +113,251 @@ def get_args():
         dest="debug",
         help="debug or not. with the flag the script will run as debug mode.\n"
     )
+    parser.add_argument(
+        '--threads',
+        '-t',
+        action="store",
+        dest="threads",
+        type=int,
+        default=1,
+        help="The max number of records posted to the database at the same time with the --notest flag. default is 1.\n"
+    )
+    parser.add_argument(
+        '--pool-size',
+        action="store",
+        dest="pool_size",
+        type=int,
+        default=10,
+        help="The max number of keep-alive connections to the database. It is never smaller than --threads. default is 10.\n"
+    )
+    parser.add_argument(
+        '--retries',
+        action="store",
+        dest="retries",
+        type=int,
+        default=3,
+        help="How many times a failed request is retried before the record is reported as failed. default is 3.\n"
+    )
+    parser.add_argument(
+        '--stream',
+        '-s',
+        action="store_true",
+        dest="stream",
+        help="Read the .xlsx file one worksheet at a time, instead of loading the whole excel file into memory. \
+        Use it for very large excel files.\n"
+    )
+    parser.add_argument(
+        '--all-errors',
+        '-a',
+        action="store_true",
+        dest="all_errors",
+        help="Check every row and accession of the excel file and report all the errors at once, instead of stopping at the first invalid row or accession of a worksheet.\n"
+    )
+    parser.add_argument(
+        '--processes',
+        '-p',
+        action="store",
+        dest="processes",
+        type=int,
+        default=1,
+        help="The number of processes reading and validating the worksheets at the same time. default is 1.\n"
+    )
+    parser.add_argument(
+        '--chunk-rows',
+        action="store",
+        dest="chunk_rows",
+        type=int,
+        default=0,
+        help="With --processes, split worksheets with more rows into chunks of this many rows, read at the same time. \
+        With --stream, the rows of a worksheet are also parsed this many at a time (%d if it is 0). \
+        default is 0, one process per worksheet.\n" % xlsxreader.CHUNK_ROWS
+    )
+    parser.add_argument(
+        '--offline',
+        action="store_true",
+        dest="offline",
+        help="Validate the excel file without contacting any server, with the database structure cached by an earlier run. \
+        The accessions and relationships are checked within the excel file, and against the accessions cached by --refresh-accessions if there are any. \
+        Nothing is submitted.\n"
+    )
+    parser.add_argument(
+        '--refresh-accessions',
+        action="store_true",
+        dest="refresh_accessions",
+        help="Download the accessions of all the records in the database for --offline validation. It needs a cypher key.\n"
+    )
+    parser.add_argument(
+        '--mirror',
+        '-m',
+        action="store_true",
+        dest="mirror",
+        help="Keep a local copy of the accessions of all the records in the database, and check the accessions against it instead of downloading them every time. \
+        Only the records changed since the last run are downloaded, it needs a cypher key. With --offline, the local copy is used without any download.\n"
+    )
+    parser.add_argument(
+        '--server',
+        action="store",
+        dest="server",
+        help="For testing only. Send all the requests to another server instead of the TaRGET databases, \
+        e.g. http://127.0.0.1:8000 started by fakeserver.py.\n"
+    )
+    parser.add_argument(
+        '--resume',
+        '-r',
+        action="store_true",
+        dest="resume",
+        help="Resume a submission stopped by a crash or a lost connection with the --notest flag. Records and \
+        relationships already posted, as logged in the journal file, are not posted again.\n"
+    )
+    parser.add_argument(
+        '--journal',
+        action="store",
+        dest="journal",
+        help="The journal file logging every finished post request with the --notest flag. default is the excel file name + '.journal'. \
+        It is deleted once the submission is successfully done.\n"
+    )
+    parser.add_argument(
+        '--profile',
+        action="store_true",
+        dest="profile",
+        help="Print the time spent in every step, and the count and latency of every kind of request at the end.\n"
+    )
+    parser.add_argument(
+        '--metrics-json',
+        action="store",
+        dest="metrics_json",
+        help="Write the timings and request metrics to this json file at the end.\n"
+    )
+    parser.add_argument(
+        '--metrics-prom',
+        action="store",
+        dest="metrics_prom",
+        help="Write the timings and request metrics to this file in the prometheus text format at the end, e.g. for the node_exporter textfile collector.\n"
+    )
 
     return parser.parse_args()
 
 
+def read_sheets(args, meta_structure, workbook, sheet_names, run_metrics):
+    """
+    Yield (sheet_name, sheet_data, validation) of every worksheet in sheet_names, in order.
+
+    With --processes, the worksheets are read and validated by parallelreader.ParallelReader, otherwise one by one here.
+    """
+    if args.processes > 1:
+        parallel_reader = parallelreader.ParallelReader(meta_structure, args.processes, args.chunk_rows, args.stream, args.all_errors)
+        results = parallel_reader.read_sheets(args.excel, sheet_names)
+        while True:
+            with run_metrics.phase("read_sheet"):  # the time waiting for the workers.
+                result = next(results, None)
+            if result is None:
+                return
+            run_metrics.add_rows("read_sheet", len(result[1].all_records))
+            yield result
+    reader = sheetreader.SheetReader(meta_structure)
+    for sheet_name in sheet_names:
+        if args.stream:  # parsed a chunk at a time while reading, the first chunk here.
+            sheet_chunks = workbook.iter_chunks(sheet_name, args.chunk_rows or xlsxreader.CHUNK_ROWS, reader.excel_data_start_row)
+            with run_metrics.phase("parse_sheet"):
+                sheet_obj = next(sheet_chunks)
+        else:
+            with run_metrics.phase("parse_sheet"):
+                sheet_obj = workbook.sheet_by_name(sheet_name)
+        validator.Validator(meta_structure).verify_column_names(sheet_obj)
+        with run_metrics.phase("read_sheet"):
+            if args.stream:
+                sheet_data, row_validation = reader.read_chunks(itertools.chain([sheet_obj], sheet_chunks), workbook.datemode, args.all_errors)
+            else:
+                sheet_data, row_validation = reader.read_sheet(sheet_obj, workbook.datemode, all_errors=args.all_errors)
+        run_metrics.add_rows("read_sheet", len(sheet_data.all_records))
+        yield sheet_name, sheet_data, row_validation
+
+
+def read_book(args, meta_structure, db_poster, run_metrics):
+    """
+    Read and validate all the worksheets of args.excel, and check their accessions against the database.
+
+    :param: db_poster - the Poster obj, or an accessionindex.AccessionIndex obj offline. With None, the accessions are only checked within the worksheets.
+    :return: (book_data, validation) - validation is False if any worksheet has an error.
+    """
+    with run_metrics.phase("open_excel"):
+        if args.stream:
+            workbook = xlsxreader.StreamingBook(args.excel)  # worksheets are parsed one by one in the loop below.
+        else:
+            workbook = xlrd.open_workbook(args.excel, on_demand=args.processes > 1)  # the worker processes load the worksheets themselves.
+    book_data = bookdata.BookData(meta_structure)
+    sheet_names = [x for x in workbook.sheet_names() if x in meta_structure.schema_dict.keys()]  # skip "Instructions" and "Lists"
+    validation = True
+    for sheet_name, sheet_data, row_validation in read_sheets(args, meta_structure, workbook, sheet_names, run_metrics):
+        data_validator = validator.Validator(meta_structure)
+        if not row_validation:
+            validation = False
+        try:
+            with run_metrics.phase("duplication_check", len(sheet_data.all_records)):
+                if db_poster is None:
+                    data_validator.local_duplication_check(sheet_data, args.all_errors)
+                else:
+                    data_validator.duplication_check(db_poster, sheet_data, args.all_errors)
+            book_data.add_sheet(sheet_data)
+        except validator.ValidatorError as validator_error:
+            logging.error(validator_error)
+            validation = False
+        except TypeError as type_error:
+            logging.error(type_error)
+            validation = False
+        except transport.TransportError as transport_error:
+            logging.error("Unable to fetch existing records in %s: %s" % (sheet_name, transport_error))
+            validation = False
+    return book_data, validation
+
+
+def validate_offline(args, run_metrics):
+    """
+    Validate the excel file with the cached database structure and accessions only, nothing is sent to any server.
+
+    The cells, rows and accession rules are checked as usual, the accessions are checked with the cached accessionindex.AccessionIndex,
+    or the accessionmirror.AccessionMirror with --mirror, instead of the database. Every relationship must point to a record in the excel file or in the cache.
+    :return: True if the excel file is valid.
+    """
+    try:
+        meta_structure = metastructure.MetaStructure(args.isproduction, schema_cache=schemacache.SchemaCache(), offline=True, meta_url=args.server, submit_url=args.server)
+    except metastructure.StructureError as structure_error:
+        sys.exit(structure_error)
+    if args.mirror:
+        accession_index = accessionmirror.AccessionMirror(meta_structure)
+        if accession_index.is_empty():
+            logging.warning("The accession mirror %s is empty, the accessions are only checked within the excel file. \
+Run it once online with a cypher key and --mirror to check them against the database too." % accession_index.path)
+            accession_index = None
+    else:
+        accession_index = accessionindex.AccessionIndex(meta_structure)
+        if not accession_index.load():
+            logging.warning("No cached accessions of %s, the accessions are only checked within the excel file. \
+Run it once online with a cypher key and --refresh-accessions to check them against the database too." % meta_structure.url)
+            accession_index = None
+    book_data, validation = read_book(args, meta_structure, accession_index, run_metrics)
+    with run_metrics.phase("link_check"):
+        if not validator.Validator(meta_structure).link_check(book_data, accession_index):
+            validation = False
+    return validation
+
+
+def open_mirror(meta_structure, db_poster, run_metrics):
+    """Return the accessionmirror.AccessionMirror synced with the database, or None if it can't be synced, then the accessions are downloaded as usual."""
+    if not db_poster.has_cypher:
+        logging.warning("The accession mirror needs a cypher key, the accessions are downloaded as usual.")
+        return None
+    accession_mirror = accessionmirror.AccessionMirror(meta_structure)
+    try:
+        with run_metrics.phase("sync_mirror"):
+            run_metrics.add_rows("sync_mirror", accession_mirror.sync(db_poster))
+    except transport.TransportError as transport_error:
+        logging.warning("Unable to sync the accession mirror, the accessions are downloaded as usual: %s" % transport_error)
+        accession_mirror.close()
+        return None
+    return accession_mirror
+
+
 def main():
     args = get_args()
     if args.debug:
@@ -89,73 +366,88 @@ def main():
         logging.getLogger().setLevel(logging.INFO)  # using INFO as default output information level.
         logging.getLogger("requests").setLevel(logging.WARNING)
 
+    run_metrics = metrics.Metrics()
+    if args.offline:
+        if validate_offline(args, run_metrics):
+            print("successfully validated all the data in the excel file offline! Nothing is submitted.")
+        run_metrics.output(args.profile, args.metrics_json, args.metrics_prom)
+        return
+
     if not args.token:
         logging.error("please provide a user API key!")
         sys.exit("please provide a user API key!")  # make token argument mandatory.
 
     is_production = args.isproduction
     is_update = args.isupdate
+    http_transport = transport.Transport(pool_maxsize=max(args.pool_size, args.threads), retries=args.retries, run_metrics=run_metrics)
     try:
-        meta_structure = metastructure.MetaStructure(is_production)
+        with run_metrics.phase("load_structure"):
+            meta_structure = metastructure.MetaStructure(is_production, http_transport=http_transport, schema_cache=schemacache.SchemaCache(), meta_url=args.server, submit_url=args.server)
     except metastructure.StructureError as structure_error:
         logging.error(structure_error)
+    except transport.TransportError as transport_error:
+        sys.exit("Unable to get the database structure: %s" % transport_error)
     # meta_structure.isupdate(args.isupdate)
     # meta_structure.isproduction(args.isproduction)
     # These options no longer saved in meta_structure
 
-    reader = sheetreader.SheetReader(meta_structure)
-    db_poster = poster.Poster(args.token, '', is_update, is_production, meta_structure)
-
-    workbook = xlrd.open_workbook(args.excel)
-    book_data = bookdata.BookData(meta_structure)
-    sheet_names = workbook.sheet_names()
-    validation = True
-    for sheet_name in sheet_names:
-        if sheet_name not in meta_structure.schema_dict.keys():  # skip "Instructions" and "Lists"
-            continue
-        sheet_obj = workbook.sheet_by_name(sheet_name)
-        data_validator = validator.Validator(meta_structure)
+    try:
+        cypher_url = args.server + poster.CYPHER_PATH if args.server else None
+        db_poster = poster.Poster(args.token, args.cypher, is_update, is_production, meta_structure, cypher_url)
+    except transport.TransportError as transport_error:
+        sys.exit("Unable to verify the API key: %s" % transport_error)
 
-        data_validator.verify_column_names(sheet_obj)
-        sheet_data, row_validation = reader.read_sheet(sheet_obj, workbook.datemode)
-        if not row_validation:
-            validation = False
+    if args.refresh_accessions:
+        if not db_poster.has_cypher:
+            sys.exit("Please provide a cypher key to download the accessions.")
         try:
-            data_validator.duplication_check(db_poster, sheet_data)
-            book_data.add_sheet(sheet_data)
-        except validator.ValidatorError as validator_error:
-            logging.error(validator_error)
-            validation = False
-        except TypeError as type_error:
-            logging.error(type_error)
-            validation = False
-        # Now upload all the records on sheet_data:
+            with run_metrics.phase("refresh_accessions"):
+                accessionindex.AccessionIndex(meta_structure).refresh(db_poster)
+        except transport.TransportError as transport_error:
+            logging.error("Unable to download the accessions: %s" % transport_error)
+    accession_mirror = open_mirror(meta_structure, db_poster, run_metrics) if args.mirror else None
+    book_data, validation = read_book(args, meta_structure, db_poster if accession_mirror is None else accession_mirror, run_metrics)
+    book_data.accession_mirror = accession_mirror
     if validation:
         print("successfully validated all the data in the excel file!")
         if is_production:
             print("Please read the following log information to make sure your submission is successful!")
-            for sheet_name, sheet_data in book_data.data.items():
-                for record in sheet_data.all_records:
-                    db_poster.submit_record(record)  # submit/update the record, track which record has been submitted or updated, and assign system accession to the submitted record.
-            book_data.swipe_accession()
-            for sheet_name, sheet_data in book_data.data.items():
-                for record in sheet_data.all_records:
-                    db_poster.link_record(record)  # submit/update the record link.
-            db_poster.save_submission(book_data)
+            submission_journal = journal.Journal(args.journal or args.excel + ".journal")
+            if submission_journal.exists():
+                if not args.resume:
+                    sys.exit("Journal %s of an unfinished submission exists, please use --resume to continue it, or delete it to start again." % submission_journal.path)
+                submission_journal.load()
+            submission_journal.open()
+            record_submitter = submitter.Submitter(db_poster, meta_structure, args.threads, submission_journal, args.changed_fields_only)
+            try:
+                record_submitter.submit_book(book_data)
+                record_submitter.save_submission(book_data)
+            except journal.JournalError as journal_error:
+                submission_journal.close()
+                sys.exit(journal_error)
+            failures = db_poster.report_failures()
+            if failures:
+                submission_journal.close()
+                logging.error("%d post requests failed, please fix them and submit the excel file again with --resume!" % failures)
+            else:
+                submission_journal.remove()
+    run_metrics.output(args.profile, args.metrics_json, args.metrics_prom)
 
 
 class SubmissionTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         print("setUpClass runs before ALL tests")
-        meta_structure = metastructure.MetaStructure()
+        cls.server = fakeserver.FakeServer().start()  # no connection to the TaRGET databases in tests.
+        meta_structure = metastructure.MetaStructure(meta_url=cls.server.url, submit_url=cls.server.url)
         # meta_structure.isupdate(args.isupdate)
         # meta_structure.isproduction(args.isproduction)
         # These options no longer saved in meta_structure
 
+        cls.validator = validator.Validator(meta_structure)
         cls.reader = sheetreader.SheetReader(meta_structure)
 
-        cls.test_book = xlrd.open_workbook("test/test_sheet.xlsx")
+        cls.test_book = xlsxreader.StreamingBook("test/test_sheet.xlsx")
         # cls.test_book = BookData(meta_structure)
 
     def setUp(self):
@@ -163,8 +455,8 @@ class SubmissionTest(unittest.TestCase):
 
     def test_read_sheet(self):
         sheet_obj = self.test_book.sheet_by_name("Litter")
-        self.reader.verify_column_names(sheet_obj)
-        sheet_data = self.reader.read_sheet(sheet_obj, self.test_book.datemode)
+        self.validator.verify_column_names(sheet_obj)
+        sheet_data, validation = self.reader.read_sheet(sheet_obj, self.test_book.datemode, all_errors=True)  # the invalid rows are skipped.
         test_sheet_list = []
         for record_object in sheet_data.all_records:
             record_dict = record_object.__dict__
@@ -174,6 +466,53 @@ class SubmissionTest(unittest.TestCase):
             expected_sheet_list = json.load(data_file)
             self.assertEqual(expected_sheet_list, test_sheet_list)
 
+    def test_read_iso_dates(self):
+        """The same records from the dates of the file as ISO 8601 date cells (t="d") instead of text."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_book = self.get_iso_date_book(temp_dir, "2016-09-21T00:00:00")
+            sheet_obj = test_book.sheet_by_name("Litter")
+            self.assertEqual(xlsxreader.XL_CELL_DATE, sheet_obj.cell(4, 9).ctype)
+            sheet_data, validation = self.reader.read_sheet(sheet_obj, test_book.datemode, all_errors=True)
+            test_book.release_resources()
+        with open('test/sheet_reader.json') as data_file:
+            expected_sheet_list = json.load(data_file)
+        self.assertEqual([x["schema"]["date_born"] for x in expected_sheet_list], [x.schema["date_born"] for x in sheet_data.all_records])
+
+    def test_read_invalid_iso_dates(self):
+        """A date cell which is not ISO 8601 is read as text, and the rows are invalid."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            test_book = self.get_iso_date_book(temp_dir, "21/09/2016")
+            sheet_obj = test_book.sheet_by_name("Litter")
+            self.assertEqual((xlsxreader.XL_CELL_TEXT, "21/09/2016"), tuple(sheet_obj.cell(4, 9)))
+            sheet_data, validation = self.reader.read_sheet(sheet_obj, test_book.datemode, all_errors=True)
+            test_book.release_resources()
+        self.assertFalse(validation)
+
+    def test_read_chunks(self):
+        """Reading a worksheet in chunks of any size gives the same records as reading it at once."""
+        sheet_obj = self.test_book.sheet_by_name("Litter")
+        sheet_data, validation = self.reader.read_sheet(sheet_obj, self.test_book.datemode, all_errors=True)
+        expected = [x.__dict__ for x in sheet_data.all_records]
+        for chunk_rows in (1, 2, None):
+            sheet_chunks = list(self.test_book.iter_chunks("Litter", chunk_rows, self.reader.excel_data_start_row))
+            self.assertEqual(sheet_obj.row_values(1), sheet_chunks[-1].row_values(1))
+            chunk_data, chunk_validation = self.reader.read_chunks(sheet_chunks, self.test_book.datemode, all_errors=True)
+            self.assertEqual((expected, validation), ([x.__dict__ for x in chunk_data.all_records], chunk_validation))
+        sheet_chunks = list(self.test_book.iter_chunks("Litter", 1, self.reader.excel_data_start_row))
+        self.assertEqual(list(range(self.reader.excel_data_start_row, sheet_obj.nrows)), [x.start_rowx for x in sheet_chunks])
+
+    def get_iso_date_book(self, temp_dir, date_text):
+        """A copy of the test file with the dates of two litters as ISO 8601 date cells (t="d")."""
+        file_name = os.path.join(temp_dir, "iso_dates.xlsx")
+        with zipfile.ZipFile("test/test_sheet.xlsx") as source, zipfile.ZipFile(file_name, "w") as target:
+            for item in source.infolist():
+                data = source.read(item)
+                if item.filename == "xl/worksheets/sheet3.xml":  # Litter
+                    for cell_ref in ("J5", "J6"):
+                        data = data.replace(b'<c r="%s" t="s"><v>23</v></c>' % cell_ref.encode(), b'<c r="%s" t="d"><v>%s</v></c>' % (cell_ref.encode(), date_text.encode()))
+                target.writestr(item, data)
+        return xlsxreader.StreamingBook(file_name)
+
     # def test_duplication_check(self):
     #     pass
     #     # self.assertEqual(result, expected)
@@ -184,6 +523,605 @@ class SubmissionTest(unittest.TestCase):
     @classmethod
     def tearDownClass(cls):
         print("tearDownClass runs after ALL tests")
+        cls.server.stop()
+
+
+def make_test_book(meta_structure):
+    """
+    A small book for the tests, the same as read from an excel file: a bioproject, two litters and three mice.
+
+    Litter USRLTR0001 and its sire USRMUS0001 link to each other, USRMUS0003 is fed a diet already in the database.
+    """
+    rows = [("Bioproject", {"user_accession": "USRBPR0001", "project_name": "test", "description": "NA"}, {"part_of": {"lab": [""]}}),
+            ("Litter", {"user_accession": "USRLTR0001", "litter_size_total": 8.0, "litter_number": 1.0, "date_born": "2016-09-21", "comments": "NA"},
+             {"part_of": {"bioproject": ["USRBPR0001"]}, "sire": {"mouse": ["USRMUS0001"]}, "dam": {"mouse": [""]}}),
+            ("Litter", {"user_accession": "USRLTR0002", "litter_size_total": 7.0, "litter_number": 2.0, "date_born": "2016-09-22", "comments": "NA"},
+             {"part_of": {"bioproject": ["USRBPR0001"]}, "sire": {"mouse": ["USRMUS0002"]}, "dam": {"mouse": [""]}}),
+            ("Mouse", {"user_accession": "USRMUS0001", "sex": "male", "fasted": "No", "fasted_hours": 0, "comments": "NA"},
+             {"part_of": {"litter": ["USRLTR0001"]}, "treated_with": {"treatment": [""]}, "fed": {"diet": [""]}}),
+            ("Mouse", {"user_accession": "USRMUS0002", "sex": "male", "fasted": "No", "fasted_hours": 0, "comments": "NA"},
+             {"part_of": {"litter": ["USRLTR0001"]}, "treated_with": {"treatment": [""]}, "fed": {"diet": [""]}}),
+            ("Mouse", {"user_accession": "USRMUS0003", "sex": "female", "fasted": "Yes", "fasted_hours": 12, "comments": "NA"},
+             {"part_of": {"litter": ["USRLTR0002"]}, "treated_with": {"treatment": [""]}, "fed": {"diet": ["TRGTDIE9999"]}})]
+    book_data = bookdata.BookData(meta_structure)
+    sheets = dict()
+    for sheet_name, schema, relationships in rows:
+        sheet_data = sheets.get(sheet_name)
+        if sheet_data is None:
+            sheet_data = sheets[sheet_name] = sheetdata.SheetData(sheet_name, meta_structure)
+        record = sheet_data.new_row()
+        record.schema = dict(schema, accession="")
+        record.relationships = json.loads(json.dumps(relationships))  # every book gets its own lists, the submission resolves them in place.
+        sheet_data.add_record(record)
+    for sheet_data in sheets.values():
+        book_data.add_sheet(sheet_data)
+    return book_data
+
+
+class FakeServerTest(unittest.TestCase):
+    """Base of the tests against a fakeserver.FakeServer, a new one for every test."""
+    def setUp(self):
+        self.server = fakeserver.FakeServer().start()
+        self.meta_structure = metastructure.MetaStructure(meta_url=self.server.url, submit_url=self.server.url)
+        self.db_poster = self.get_poster(False)
+        self.temp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+        self.server.stop()
+
+    def get_poster(self, isupdate):
+        return poster.Poster("token", "key", isupdate, True, self.meta_structure, self.server.cypher_url)
+
+    def submit(self, book_data, db_poster=None, record_journal=None):
+        record_submitter = submitter.Submitter(db_poster or self.db_poster, self.meta_structure, 2, record_journal)
+        results = record_submitter.submit_book(book_data)
+        record_submitter.save_submission(book_data)
+        return results
+
+    def get_accessions(self, book_data):
+        """{user accession: system accession} of all the records in book_data."""
+        return {x.schema["user_accession"]: x.schema["accession"] for sheet_data in book_data.data.values() for x in sheet_data.all_records}
+
+
+class TransportTest(FakeServerTest):
+    def setUp(self):
+        super().setUp()
+        self.meta_structure.transport.backoff = 0.01
+        self.record = make_test_book(self.meta_structure).data["Bioproject"].all_records[0]
+
+    def test_create_not_retried(self):
+        self.server.error_rate, self.server.error_status = 1, 500  # the server may have created the record.
+        self.db_poster.submit_record(self.record)
+        self.assertEqual(1, self.server.stats["error"])
+        self.assertEqual(1, len(self.db_poster.failed_records))
+        self.assertEqual("", self.record.schema["accession"])
+
+    def test_create_retried(self):
+        self.server.error_rate, self.server.error_status = 1, 503  # the server did not process the request.
+        self.db_poster.submit_record(self.record)
+        self.assertEqual(1 + self.meta_structure.transport.retries, self.server.stats["error"])
+        self.assertEqual(1, len(self.db_poster.failed_records))
+
+    def test_get_retried(self):
+        self.server.error_rate, self.server.error_status = 1, 500
+        with self.assertRaises(transport.TransportError):
+            self.db_poster.fetch_all("Bioproject")
+        self.assertEqual(1 + self.meta_structure.transport.retries, self.server.stats["error"])
+
+
+class SchemaCacheTest(FakeServerTest):
+    def test_cache(self):
+        schema_cache = schemacache.SchemaCache(self.temp_dir.name)
+        self.server.reset_stats()
+        metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache)
+        self.assertEqual(len(metastructure.ALL_CATEGORIES), self.server.stats["GET /schema"])
+
+        self.server.reset_stats()
+        cached_structure = metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache)
+        self.assertEqual(0, self.server.stats["GET /schema"])
+        self.assertEqual(1, self.server.stats["GET /api/version"])
+        self.assertEqual(self.meta_structure.schema_dict, cached_structure.schema_dict)
+        self.assertEqual(self.meta_structure.link_dict, cached_structure.link_dict)
+
+        path = schema_cache.get_path(self.server.url)
+        with open(path) as cache_file:
+            cached = json.load(cache_file)
+        with open(path, "w") as cache_file:
+            json.dump(dict(cached, version="an older version"), cache_file)
+        self.server.reset_stats()
+        metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache)
+        self.assertEqual(len(metastructure.ALL_CATEGORIES), self.server.stats["GET /schema"])
+
+    def test_offline(self):
+        schema_cache = schemacache.SchemaCache(self.temp_dir.name)
+        with self.assertRaises(metastructure.StructureError):
+            metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache, offline=True)
+        metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache)
+        self.server.reset_stats()
+        offline_structure = metastructure.MetaStructure(meta_url=self.server.url, schema_cache=schema_cache, offline=True)
+        self.assertEqual(0, sum(self.server.stats.values()))
+        self.assertEqual(self.meta_structure.schema_dict, offline_structure.schema_dict)
+
+
+class MetaStructureTest(FakeServerTest):
+    def test_column_index(self):
+        headers = self.meta_structure.get_all_column_headers("Litter")
+        self.assertIsInstance(headers, list)
+        self.assertEqual(["System Accession", "User accession"], headers[:2])
+        self.assertEqual(["Bioproject", "Sire", "Dam"], self.meta_structure.get_link_column_headers("Litter"))
+        self.assertEqual(headers, self.meta_structure.get_schema_column_headers("Litter") + self.meta_structure.get_link_column_headers("Litter"))
+        self.meta_structure.get_schema_column_headers("Litter").append("Extra")  # a copy, the index is not changed.
+        self.assertEqual(headers, self.meta_structure.get_all_column_headers("Litter"))
+
+        self.assertEqual("sire", self.meta_structure.get_column_name("Litter", "Sire"))
+        self.assertEqual("Mouse", self.meta_structure.get_linkto("Litter", "Sire"))
+        self.assertTrue(self.meta_structure.is_link_column("Litter", "Sire"))
+        self.assertFalse(self.meta_structure.is_schema_column("Litter", "Sire"))
+        self.assertEqual("number", self.meta_structure.get_data_type("Litter", "Litter number"))
+        with self.assertRaises(metastructure.StructureError):
+            self.meta_structure.get_column_name("Litter", "Extra")
+        with self.assertRaises(metastructure.StructureError):
+            self.meta_structure.get_linkto("Litter", "Litter number")
+
+
+class LinkWriterTest(FakeServerTest):
+    def test_collect(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        records = [x for sheet_data in book_data.data.values() for x in sheet_data.all_records]
+        edges = linkwriter.LinkWriter(self.db_poster, 2).collect(records + records)
+        self.assertEqual(len(set(edges)), len(edges))
+        self.assertEqual(8, len(edges))  # the empty accessions are skipped.
+        self.assertTrue(all(x.is_add and x.linkto_accession not in ("", x.system_accession) for x in edges))
+
+    def test_write(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        accessions = self.get_accessions(book_data)
+        litter, mice = accessions["USRLTR0002"], [accessions["USRMUS0001"], accessions["USRMUS0002"]]
+        edges = [linkwriter.Edge("Litter", litter, "mouse", "dam", x, True) for x in mice]
+        self.server.reset_stats()
+        link_writer = linkwriter.LinkWriter(self.db_poster, 2)
+        self.assertEqual({x: True for x in edges}, link_writer.write(edges + edges[:1]))
+        self.assertEqual(1, self.server.stats["POST link add"])  # the additions to the same record and connection in one request.
+        self.assertEqual(mice, self.server.get_node("litter", litter)["added"]["dam"]["mouse"])
+
+        edges = [x._replace(is_add=False) for x in edges]
+        self.assertEqual({x: True for x in edges}, link_writer.write(edges))
+        self.assertEqual(2, self.server.stats["POST link remove"])  # the api removes one accession at a time.
+        self.assertEqual([], self.server.get_node("litter", litter)["added"]["dam"]["mouse"])
+
+
+class ExportTest(FakeServerTest):
+    def test_fetch_user_all(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        accessions = self.get_accessions(book_data)
+        self.server.reset_stats()
+        exported_book = self.db_poster.fetch_user_all(self.server.user_name)
+        self.assertEqual(1, self.server.stats["POST cypher"])  # all the categories in one query.
+        self.assertEqual(list(self.meta_structure.schema_dict), list(exported_book.data))
+        self.assertEqual({"Bioproject": 1, "Litter": 2, "Mouse": 3}, {k: len(v.all_records) for k, v in exported_book.data.items() if len(v.all_records)})
+        litters = exported_book.data["Litter"].all_records
+        self.assertEqual(["USRLTR0001", "USRLTR0002"], [x.schema["user_accession"] for x in litters])  # in the order of the query.
+        self.assertEqual({"mouse": [accessions["USRMUS0001"]]}, litters[0].relationships["sire"])
+        self.assertEqual({"mouse": []}, litters[0].relationships["dam"])
+
+
+class RecordDecoderTest(FakeServerTest):
+    def test_decode(self):
+        decoder = rowdata.RecordDecoder(self.meta_structure)
+        self.assertEqual((("part_of", ("bioproject",)), ("sire", ("mouse",)), ("dam", ("mouse",))), decoder.get_template("Litter"))
+        connections = [{"connection": "sire", "to": ["mouse"], "accession": "TRGTMUS0001"},
+                       {"connection": "sire", "to": ["mouse"], "accession": "TRGTMUS0002"},
+                       {"connection": "derived_from", "to": ["mouse"], "accession": "TRGTMUS0003"},  # not a connection of Litter.
+                       {"connection": "na", "to": "na", "accession": "na"}]
+        record = decoder.decode("Litter", {"accession": "TRGTLTR0001"}, connections)
+        self.assertEqual("Litter", record.sheet_name)
+        self.assertEqual({"accession": "TRGTLTR0001"}, record.schema)
+        self.assertEqual({"part_of": {"bioproject": []}, "sire": {"mouse": ["TRGTMUS0001", "TRGTMUS0002"]}, "dam": {"mouse": []}}, record.relationships)
+        other_record = decoder.decode("Litter", {"accession": "TRGTLTR0002"}, [])
+        self.assertEqual([], other_record.relationships["sire"]["mouse"])  # every row gets its own lists.
+
+
+class MetricsTest(FakeServerTest):
+    def test_get_endpoint(self):
+        self.assertEqual("POST /api/litters/<accession>/mouse/add", metrics.get_endpoint("POST", "http://127.0.0.1:7006/api/litters/TRGTLTR0001/mouse/add"))
+        self.assertEqual("GET /api/usertoken/<token>", metrics.get_endpoint("GET", "https://host/api/usertoken/secret"))
+        self.assertEqual("GET /schema/<category>.json", metrics.get_endpoint("GET", "http://host/schema/litter.json"))
+        self.assertEqual(2, metrics.get_quantile([1, 2, 3, 4], 0.5))
+        self.assertEqual(4, metrics.get_quantile([1, 2, 3, 4], 0.99))
+
+    def test_requests(self):
+        run_metrics = self.meta_structure.transport.metrics
+        for sheet_name in ("Litter", "Mouse"):
+            with run_metrics.phase("read_sheet", 2):
+                pass
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        summary = run_metrics.summary()
+        self.assertEqual({"seconds", "rows", "calls", "rows_per_second"}, set(summary["phases"]["read_sheet"]))
+        self.assertEqual((4, 2), (summary["phases"]["read_sheet"]["rows"], summary["phases"]["read_sheet"]["calls"]))
+        endpoint = summary["endpoints"]["POST /api/mice"]
+        self.assertEqual((3, {"200": 3}), (endpoint["count"], endpoint["status"]))
+        self.assertGreater(endpoint["bytes_sent"], 0)
+        self.assertEqual(self.server.stats["POST link add"], sum(x["count"] for k, x in summary["endpoints"].items() if k.endswith("/add")))
+
+        path = os.path.join(self.temp_dir.name, "metrics.prom")
+        run_metrics.output(json_path=path + ".json", prometheus_path=path)
+        with open(path + ".json") as json_file:
+            self.assertEqual(json.loads(json.dumps(summary)), json.load(json_file))
+        with open(path) as prometheus_file:
+            self.assertIn('bulkupload_http_responses_total{endpoint="POST /api/mice",status="200"} 3', prometheus_file.read().splitlines())
+
+
+class ConcurrencyTest(FakeServerTest):
+    def test_requests_in_flight(self):
+        """The records of a wave and the relationships are posted at the same time by the threads of Submitter and LinkWriter."""
+        self.server.latency = 0.05
+        self.server.reset_stats()
+        results = self.submit(make_test_book(self.meta_structure))
+        self.assertTrue(all(results.values()))
+        self.assertEqual(2, self.server.max_in_flight)
+
+
+class ParallelReaderTest(FakeServerTest):
+    def test_read_sheets(self):
+        """The worksheets read by the workers, whole or in chunks, are the same as read one by one."""
+        reader = sheetreader.SheetReader(self.meta_structure)
+        workbook = xlsxreader.StreamingBook("test/test_sheet.xlsx")
+        sheet_names = [x for x in workbook.sheet_names() if x in self.meta_structure.schema_dict]
+        for all_errors in (True, False):
+            expected = []
+            for sheet_name in sheet_names:
+                sheet_data, validation = reader.read_sheet(workbook.sheet_by_name(sheet_name), workbook.datemode, all_errors=all_errors)
+                expected.append((sheet_name, self.get_records(sheet_data), validation))
+            for chunk_rows in (0, 1, 2):
+                parallel_reader = parallelreader.ParallelReader(self.meta_structure, 2, chunk_rows, stream=True, all_errors=all_errors)
+                results = [(sheet_name, self.get_records(sheet_data), validation) for sheet_name, sheet_data, validation in parallel_reader.read_sheets("test/test_sheet.xlsx", sheet_names)]
+                self.assertEqual(expected, results)
+        workbook.release_resources()
+        self.assertEqual([("Litter", 0, False), ("Reagent", 0, True)], [(x[0], len(x[1]), x[2]) for x in expected])  # stopped at the first litter, which is invalid.
+
+    def get_records(self, sheet_data):
+        self.assertIs(self.meta_structure, sheet_data.meta_structure)
+        return [{k: v for k, v in x.__dict__.items() if k != "meta_structure"} for x in sheet_data.all_records]
+
+
+class ValidatorTest(FakeServerTest):
+    def test_column_batch_audit(self):
+        """One call validates the whole column and collects every error."""
+        column_audit = validator.Validator(self.meta_structure).get_column_batch_audit("Litter", "Litter number")
+        values, problems = column_audit([1.234, "abc", "NA", "x", True], [xlsxreader.XL_CELL_NUMBER, xlsxreader.XL_CELL_TEXT, xlsxreader.XL_CELL_TEXT, xlsxreader.XL_CELL_TEXT, xlsxreader.XL_CELL_BOOLEAN], 0)
+        self.assertEqual([1.23, "abc", -1, "x", "TRUE"], values)
+        self.assertEqual([(1, logging.ERROR), (2, logging.DEBUG), (3, logging.ERROR)], [x[:2] for x in problems])
+        self.assertEqual("please use number for Litter number in Litter", str(problems[0][2]))
+
+        column_audit = validator.Validator(self.meta_structure).get_column_batch_audit("Mouse", "Sex")
+        values, problems = column_audit(["male", "other", ""], [xlsxreader.XL_CELL_TEXT] * 3, 0)
+        self.assertEqual(["male", "other", ""], values)  # an invalid cell keeps its value.
+        self.assertEqual([1, 2], [x[0] for x in problems])
+
+    def test_read_sheet_errors(self):
+        """With all_errors, every invalid cell is logged with its row in excel and its column."""
+        sheet_obj = xlsxreader.StreamingSheet("Litter")
+        column_headers = self.meta_structure.get_all_column_headers("Litter")
+        rows = [{"User accession": "USRLTR0001", "Litter number": 1.0},
+                {"User accession": "USRLTR0002", "Litter number": "abc", "Date born": "NA"},
+                {"User accession": "USRLTR0003", "Litter number": "x", "Litter size (total)": "y"},
+                {"User accession": "wrong"}]
+        for col_index, column_header in enumerate(column_headers):
+            sheet_obj.put_cell(1, col_index, xlsxreader.XL_CELL_TEXT, column_header)
+            for row_index, row in enumerate(rows, 2):
+                value = row.get(column_header, "NA")
+                sheet_obj.put_cell(row_index, col_index, xlsxreader.XL_CELL_NUMBER if isinstance(value, float) else xlsxreader.XL_CELL_TEXT, value)
+        reader = sheetreader.SheetReader(self.meta_structure)
+        with self.assertLogs(level=logging.ERROR) as logs:
+            sheet_data, validation = reader.read_sheet(sheet_obj, 0, start_row=3, all_errors=True)
+        self.assertFalse(validation)
+        self.assertEqual(0, len(sheet_data.all_records))
+        self.assertEqual(["ERROR:root:Row 4, column Litter number: please use number for Litter number in Litter",
+                          "ERROR:root:Row 5, column Litter size (total): please use number for Litter size (total) in Litter",
+                          "ERROR:root:Row 5, column Litter number: please use number for Litter number in Litter"],
+                         logs.output[:3])
+        self.assertTrue(logs.output[3].startswith("ERROR:root:Row 6: Either user accession or system accession wrong"))
+
+
+class ColumnarSheetDataTest(FakeServerTest):
+    def get_sheet(self, rows):
+        sheet_data = sheetdata.ColumnarSheetData("Mouse", self.meta_structure)
+        for row in range(rows):
+            sheet_data.add_row({"accession": "TRGTMUS%04d" % row, "user_accession": "USRMUS%04d" % row}, {"part_of": {"litter": ["USRLTR%04d" % row]}})
+        return sheet_data
+
+    def test_set_links(self):
+        sheet_data = self.get_sheet(1000)
+        link = sheet_data.links[("part_of", "litter")]
+        for row, record in enumerate(sheet_data.all_records):
+            accession_list = record.relationships["part_of"]["litter"]
+            accession_list[0] = "TRGTLTR%04d" % row  # the way the submission resolves the user accessions.
+            self.assertLess(len(link.changed) * 4, len(link.offsets))  # rebuilt once in a while, not for every row.
+        sheet_data.all_records[3].relationships["part_of"]["litter"].append("TRGTLTR9999")  # not written through.
+        link.set(5, ["TRGTLTR0005", "TRGTLTR0006"])
+        self.assertEqual(["TRGTLTR0003"], sheet_data.all_records[3].relationships["part_of"]["litter"])
+        self.assertEqual(["TRGTLTR0005", "TRGTLTR0006"], sheet_data.all_records[5].relationships["part_of"]["litter"])
+        link.rebuild()
+        self.assertEqual({}, link.changed)
+        self.assertEqual(["TRGTLTR%04d" % x for x in range(1000)], link.values[:6] + link.values[7:])  # row 5 has two accessions.
+        self.assertEqual(["TRGTLTR0005", "TRGTLTR0006"], link.get(5))
+        self.assertEqual(["TRGTLTR0999"], link.get(999))
+
+    def test_record_state(self):
+        sheet_data = self.get_sheet(3)
+        sheet_data.all_records[1].submission("submitted")
+        sheet_data.all_records[2].replace_accession("USRMUS9999")
+        self.assertEqual(["", "submitted", ""], [x.submission() for x in sheet_data.all_records])  # new views of the same rows.
+        self.assertEqual("USRMUS0002", sheet_data.all_records[2].old_accession())
+        self.assertEqual("USRMUS9999", sheet_data.all_records[2].schema["user_accession"])
+        self.assertEqual("", sheet_data.all_records[0].old_accession())
+
+
+class AccessionIndexTest(FakeServerTest):
+    def test_resolve(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        accessions = self.get_accessions(book_data)
+        litter = book_data.data["Litter"].all_records[0]
+        self.assertEqual([accessions["USRBPR0001"]], litter.relationships["part_of"]["bioproject"])
+        self.assertEqual([accessions["USRMUS0001"]], litter.relationships["sire"]["mouse"])
+        self.assertEqual(["TRGTDIE9999"], book_data.data["Mouse"].all_records[2].relationships["fed"]["diet"])  # not in the book, kept as it is.
+        self.assertEqual([], self.db_poster.failed_links)
+
+    def test_failed_record(self):
+        self.db_poster.submit_record(make_test_book(self.meta_structure).data["Bioproject"].all_records[0])
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)  # the bioproject is rejected, its user accession already exists.
+        self.assertEqual(1, len(self.db_poster.failed_records))
+        failed_links = [(sheet_name, linkto_accession) for sheet_name, system_accession, linkto_accession, error in self.db_poster.failed_links]
+        self.assertEqual([("Litter", ["USRBPR0001"])] * 2, failed_links)
+        self.assertEqual(3, self.db_poster.report_failures())
+
+
+class JournalTest(FakeServerTest):
+    def test_resume(self):
+        path = os.path.join(self.temp_dir.name, "test.journal")
+        record_journal = journal.Journal(path)
+        record_journal.open()
+        crashed_book = make_test_book(self.meta_structure)
+        crashed_book.data = {"Bioproject": crashed_book.data["Bioproject"]}  # the run crashed after the first sheet,
+        self.submit(crashed_book, record_journal=record_journal)
+        record_journal.close()
+        with open(path, "a") as journal_file:
+            journal_file.write('{"type": "record", "sheet_na')  # in the middle of a line.
+
+        record_journal = journal.Journal(path)
+        record_journal.load()
+        self.assertEqual([("Bioproject", 0)], list(record_journal.records))
+        self.assertTrue(record_journal.submission_saved)
+        record_journal.open()
+        self.server.reset_stats()
+        book_data = make_test_book(self.meta_structure)
+        results = self.submit(book_data, record_journal=record_journal)
+        record_journal.close()
+        self.assertEqual(5, self.server.stats["POST /api/<categories>"])
+        self.assertEqual(0, self.server.stats["POST /api/submission"])
+        self.assertTrue(all(results.values()))
+        self.assertEqual(1, self.server.count("bioproject"))
+        self.assertEqual(self.get_accessions(crashed_book)["USRBPR0001"], self.get_accessions(book_data)["USRBPR0001"])
+
+        resumed_journal = journal.Journal(path)
+        resumed_journal.load()
+        self.assertEqual(6, len(resumed_journal.records))
+        self.assertEqual(len(results), len(resumed_journal.links))
+        with self.assertRaises(journal.JournalError):
+            resumed_journal.get_record("Mouse", 0, "USRMUS0002")
+
+
+class DuplicationCheckTest(FakeServerTest):
+    def test_all_errors(self):
+        sheet_data = make_test_book(self.meta_structure).data["Mouse"]
+        sheet_data.all_records[1].schema["user_accession"] = "USRMUS0001"
+        sheet_data.all_records[2].schema["accession"] = "TRGTMUS9999"
+        sheet_data.all_records[2].schema["user_accession"] = ""
+        data_validator = validator.Validator(self.meta_structure)
+        with self.assertRaisesRegex(validator.ValidatorError, "USRMUS0001"):
+            data_validator.duplication_check(self.db_poster, sheet_data)
+        with self.assertLogs(level="ERROR") as logs, self.assertRaisesRegex(validator.ValidatorError, "2 accession errors in Mouse"):
+            data_validator.duplication_check(self.db_poster, sheet_data, all_errors=True)
+        self.assertEqual(2, len(logs.output))
+        with self.assertRaisesRegex(validator.ValidatorError, "1 accession errors in Mouse"):
+            data_validator.local_duplication_check(sheet_data, all_errors=True)
+
+
+class LinkGraphTest(FakeServerTest):
+    def test_waves(self):
+        graph = linkgraph.LinkGraph(make_test_book(self.meta_structure))
+        self.assertEqual([("Bioproject", 0), ("Litter", 0), ("Litter", 1), ("Mouse", 0), ("Mouse", 1), ("Mouse", 2)], [x[:2] for x in graph.records])
+        self.assertEqual([[0], [1, 3], [4], [2], [5]], graph.get_waves())
+        self.assertEqual([[1, 3]], [sorted(x) for x in graph.get_cycles()])
+        self.assertEqual(1, graph.external_links)
+        self.assertEqual([], graph.self_links)
+
+    def test_self_links(self):
+        book_data = make_test_book(self.meta_structure)
+        book_data.data["Mouse"].all_records[2].relationships["sibling"] = {"mouse": ["USRMUS0003"]}
+        graph = linkgraph.LinkGraph(book_data)
+        self.assertEqual([(5, "sibling", "mouse", "USRMUS0003")], graph.self_links)
+        self.assertEqual([[0], [1, 3], [4], [2], [5]], graph.get_waves())
+
+    def test_submit_cycle(self):
+        book_data = make_test_book(self.meta_structure)
+        results = self.submit(book_data)
+        self.assertTrue(all(results.values()))
+        accessions = self.get_accessions(book_data)
+        litter = self.server.get_node("litter", accessions["USRLTR0001"])
+        mouse = self.server.get_node("mouse", accessions["USRMUS0001"])
+        self.assertEqual([accessions["USRMUS0001"]], litter["added"]["sire"]["mouse"])
+        self.assertEqual([accessions["USRLTR0001"]], mouse["added"]["part_of"]["litter"])
+
+
+class SnapshotTest(FakeServerTest):
+    def test_load(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        accessions = self.get_accessions(book_data)
+        mice = [accessions[x] for x in ("USRMUS0001", "USRMUS0002", "USRMUS0003")]
+        record_snapshot = snapshot.Snapshot(self.get_poster(True))
+        self.server.reset_stats()
+        with self.assertLogs(level="WARNING") as logs:
+            self.assertEqual(3, record_snapshot.load("Mouse", mice + ["TRGTMUS9999"]))
+        self.assertEqual(1, self.server.stats["POST cypher"])
+        self.assertIn("1 of 4 records in Mouse are not in the database.", logs.output[0])
+        self.assertIsNone(record_snapshot.get("Mouse", "TRGTMUS9999"))
+        mouse = record_snapshot.get("Mouse", accessions["USRMUS0003"])
+        self.assertEqual("USRMUS0003", mouse.schema["user_accession"])
+        self.assertEqual(["TRGTDIE9999"], mouse.relationships["fed"]["diet"])
+
+        self.server.reset_stats()
+        self.assertEqual(0, record_snapshot.load("Mouse", mice))  # already loaded.
+        self.assertEqual(0, self.server.stats["POST cypher"])
+
+
+class UpdatePlannerTest(FakeServerTest):
+    def test_normalize(self):
+        self.assertEqual(updateplanner.normalize(1, "number"), updateplanner.normalize("1.00", "number"))
+        self.assertEqual("NA", updateplanner.normalize("NA", "textnumber"))
+        self.assertNotEqual(updateplanner.normalize("007", "text"), updateplanner.normalize("7", "text"))
+        self.assertEqual("2016-09-21", updateplanner.normalize("2016-09-21T00:00:00.000Z", "date"))
+        self.assertEqual("", updateplanner.normalize(None, "text"))
+        self.assertEqual("a b", updateplanner.normalize(" a b ", "text"))
+        self.assertEqual("TRUE", updateplanner.normalize(True, "text"))
+
+    def test_compare(self):
+        book_data = make_test_book(self.meta_structure)
+        litters = book_data.data["Litter"].all_records
+        existing_records = snapshot.Snapshot(self.db_poster)
+        for accession, record in zip(["TRGTLTR0001", "TRGTLTR0002"], litters):
+            record.schema["accession"] = accession
+            existing_record = rowdata.RowData("Litter", self.meta_structure)
+            existing_record.schema = dict(record.schema, litter_size_total=str(record.schema["litter_size_total"]) + "0", date_born=record.schema["date_born"] + "T00:00:00Z")
+            existing_records.add(existing_record)
+        litters[1].schema["comments"] = "changed"
+        book_data.data["Mouse"].all_records[0].schema["accession"] = "TRGTMUS0001"
+        planner = updateplanner.UpdatePlanner(self.meta_structure, existing_records, changed_fields_only=True).plan_book(book_data)
+        self.assertEqual((updateplanner.UNCHANGED, []), planner.compare(litters[0]))
+        self.assertEqual((updateplanner.CHANGED, ["comments"]), planner.compare(litters[1]))
+        self.assertEqual(updateplanner.NOT_FOUND, planner.plans[("Mouse", 0)][0])
+        self.assertEqual(updateplanner.NO_ACCESSION, planner.plans[("Mouse", 1)][0])
+        self.assertTrue(planner.is_unchanged("Litter", 0))
+        self.assertFalse(planner.is_unchanged("Litter", 1))
+        self.assertEqual(["comments"], planner.get_fields("Litter", 1))
+        self.assertIsNone(planner.get_fields("Mouse", 0))
+
+
+class PlanTest(FakeServerTest):
+    def test_apply(self):
+        path = os.path.join(self.temp_dir.name, "test.plan.json")
+        new_plan = plan.Plan(False, True)
+        new_plan.add_book(make_test_book(self.meta_structure), self.db_poster)
+        new_plan.save(path)
+        self.assertEqual(0, self.server.stats["POST /api/<categories>"])
+
+        saved_plan = plan.load_plan(path)
+        self.assertEqual(new_plan.get_counts(), saved_plan.get_counts())
+        self.assertEqual(6, saved_plan.get_counts()[plan.CREATE])
+        self.assertEqual([], saved_plan.find_changes(self.meta_structure, self.db_poster))
+        book_data, record_snapshot, update_planner = saved_plan.get_submission(self.meta_structure, self.db_poster)
+        results = self.submit(book_data)
+        self.assertTrue(all(results.values()))
+        self.assertEqual(saved_plan.get_counts()["link"], len(results))
+        self.assertEqual([1, 2, 3], [self.server.count(x) for x in ("bioproject", "litter", "mouse")])
+
+    def test_stale_plan(self):
+        accessions = self.get_accessions(self.get_submitted_book())
+        db_poster = self.get_poster(True)
+        book_data = make_test_book(self.meta_structure)
+        for sheet_data in book_data.data.values():
+            for record in sheet_data.all_records:
+                record.schema["accession"] = accessions[record.schema["user_accession"]]
+                book_data.index_record(record)
+        book_data.data["Litter"].all_records[1].schema["comments"] = "changed"
+        new_plan = plan.Plan(True, True)
+        new_plan.add_book(book_data, db_poster, snapshot.Snapshot(db_poster).load_book(book_data))
+        counts = new_plan.get_counts()
+        self.assertEqual((1, 5, 0), (counts[plan.UPDATE], counts[plan.UNCHANGED], counts["link"] + counts["unlink"]))
+        self.assertEqual([], new_plan.find_changes(self.meta_structure, db_poster))
+
+        self.server.get_node("litter", accessions["USRLTR0001"])["schema"]["comments"] = "changed by someone else"
+        self.assertEqual(["%s in Litter has been changed since the plan." % accessions["USRLTR0001"]], new_plan.find_changes(self.meta_structure, db_poster))
+
+    def get_submitted_book(self):
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        return book_data
+
+
+class OfflineValidationTest(FakeServerTest):
+    def test_validate(self):
+        submitted_book = make_test_book(self.meta_structure)
+        self.submit(submitted_book)
+        accessions = self.get_accessions(submitted_book)
+        accession_index = accessionindex.AccessionIndex(self.meta_structure, self.temp_dir.name)
+        self.server.reset_stats()
+        accession_index.refresh(self.db_poster)
+        self.assertEqual(len(self.meta_structure.schema_dict), self.server.stats["POST cypher"])
+
+        cached_index = accessionindex.AccessionIndex(self.meta_structure, self.temp_dir.name)
+        self.server.reset_stats()
+        self.assertTrue(cached_index.load())
+        book_data = make_test_book(self.meta_structure)
+        mouse_sheet = book_data.data["Mouse"]
+        check = validator.Validator(self.meta_structure)
+        check.duplication_check(cached_index, mouse_sheet)
+        self.assertEqual([accessions["USRMUS000%d" % x] for x in (1, 2, 3)], [x.schema["accession"] for x in mouse_sheet.all_records])
+
+        self.assertFalse(check.link_check(book_data, cached_index))  # TRGTDIE9999 is not in the database.
+        self.assertTrue(check.link_check(book_data))  # only the accession rules without the index.
+        fed = mouse_sheet.all_records[2].relationships["fed"]["diet"]
+        fed[0] = ""
+        self.assertTrue(check.link_check(book_data, cached_index))
+        part_of = mouse_sheet.all_records[2].relationships["part_of"]["litter"]
+        part_of[0] = accessions["USRLTR0001"]  # a system accession in the database.
+        self.assertTrue(check.link_check(book_data, cached_index))
+        part_of[0] = "USRLTR0009"  # not one of the user's records.
+        self.assertFalse(check.link_check(book_data, cached_index))
+        self.assertEqual(0, sum(self.server.stats.values()))
+
+
+class AccessionMirrorTest(FakeServerTest):
+    def setUp(self):
+        super().setUp()
+        self.server.stop()
+        self.server = fakeserver.FakeServer(records=3, foreign_records=2).start()
+        self.meta_structure = metastructure.MetaStructure(meta_url=self.server.url, submit_url=self.server.url)
+        self.db_poster = self.get_poster(False)
+
+    def test_sync(self):
+        mirror = accessionmirror.AccessionMirror(self.meta_structure, self.temp_dir.name)
+        self.assertTrue(mirror.is_empty())
+        sheet_count = len(self.meta_structure.schema_dict)
+        self.assertEqual(sheet_count * 5, mirror.sync(self.db_poster))
+        self.assertLess(mirror.sync(self.db_poster), sheet_count * 5)  # only the records modified at the last sync time.
+
+        book_data = make_test_book(self.meta_structure)
+        self.submit(book_data)
+        accessions = self.get_accessions(book_data)
+        renamed = self.server.get_node("mouse", accessions["USRMUS0003"])
+        renamed["schema"]["user_accession"] = "USRMUS0004"
+        renamed["modified"] = fakeserver._now()
+        self.assertLess(mirror.sync(self.db_poster), sheet_count * 5)
+        self.assertEqual(accessions["USRMUS0001"], mirror.get_system_accession("mouse", "USRMUS0001"))
+        self.assertEqual(accessions["USRMUS0003"], mirror.get_system_accession("mouse", "USRMUS0004"))
+        self.assertFalse(mirror.has_user_accession("mouse", "USRMUS0003"))
+        self.assertEqual(6, len(mirror.fetch_user_accession("Mouse")))
+
+        full_mirror = accessionmirror.AccessionMirror(self.meta_structure, os.path.join(self.temp_dir.name, "full"))
+        full_mirror.sync(self.db_poster)
+        statement = "SELECT category, system_accession, user_accession, user FROM accessions ORDER BY category, system_accession"
+        self.assertEqual(full_mirror._query(statement), mirror._query(statement))
+        full_mirror.close()
+        mirror.close()
 
 
 if __name__ == "__main__":
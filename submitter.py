@@ -0,0 +1,144 @@
+import logging
+import functools
+import concurrent.futures
+
+import linkgraph
+import linkwriter
+import snapshot
+import transport
+import updateplanner
+
+
+class Submitter:
+    def __init__(self, db_poster, meta_structure, workers=1, record_journal=None, changed_fields_only=False):
+        """
+        Submit all the records of a book_data to the database with a bounded thread pool.
+
+        :param: db_poster - the Poster obj used to post records and links.
+        :param: meta_structure - the MetaStructure obj.
+        :param: workers - the max number of post requests in flight. 1 means one record after another.
+        :param: record_journal - an opened journal.Journal obj. Requests already in the journal are skipped, new ones are added to it.
+        :param: changed_fields_only - in update mode, post only the changed fields of a record, see updateplanner.UpdatePlanner.
+        """
+        self.db_poster = db_poster
+        self.meta_structure = meta_structure
+        self.workers = max(1, workers)
+        self.journal = record_journal
+        self.metrics = db_poster.metrics
+        self.changed_fields_only = changed_fields_only
+        self.planner = None
+
+    def submit_book(self, book_data, record_snapshot=None, update_planner=None):
+        """
+        Submit or update all the records in book_data wave by wave, and link the records of a wave as soon as it is submitted.
+
+        The waves come from linkgraph.LinkGraph: a record only links to records in the earlier waves or in its own cycle,
+        so all the linked records have their system accessions by then. The user accessions in the relationships are resolved with the accession index of book_data.
+        In update mode with a snapshot, records the same as in the database are not posted, only their relationships are updated.
+        :param: record_snapshot - a snapshot.Snapshot obj of the records to be updated. It is loaded by load_snapshot if it is not provided.
+        :param: update_planner - an updateplanner.UpdatePlanner obj with the plans of all the rows. It is made from the snapshot if it is not provided.
+        :return: a dict, linkwriter.Edge -> True if the relationship was successfully written.
+        """
+        with self.metrics.phase("link_graph"):
+            graph = linkgraph.LinkGraph(book_data)
+            waves = graph.get_waves()
+        graph.log_problems()
+        if record_snapshot is None:
+            record_snapshot = self.load_snapshot(book_data)
+        if update_planner is not None:
+            self.planner = update_planner
+        elif record_snapshot is not None:
+            with self.metrics.phase("plan_update"):
+                self.planner = updateplanner.UpdatePlanner(self.meta_structure, record_snapshot, self.changed_fields_only).plan_book(book_data)
+        if self.planner is not None:
+            self.planner.log_summary()
+        link_writer = linkwriter.LinkWriter(self.db_poster, self.workers, self.journal, record_snapshot)
+        results = dict()
+        for wave in waves:
+            rows = [graph.records[x] for x in wave]
+            with self.metrics.phase("submit_records", len(rows)):
+                self.run(functools.partial(self._submit_row, book_data), rows)
+            records = [record for sheet_name, row, record in rows]
+            with self.metrics.phase("collect_links", len(records)):
+                for record in records:
+                    self._report_unresolved(record, book_data.resolve_links(record))
+                edges = link_writer.collect(records)
+            with self.metrics.phase("write_links", len(edges)):
+                results.update(link_writer.write(edges))
+        return results
+
+    def load_snapshot(self, book_data):
+        """
+        In update mode, fetch the existing relationships of all the records to be updated in a few cypher queries, see snapshot.Snapshot.
+
+        Returns None without a cypher key or if the queries fail, then the records are fetched one by one while linking.
+        """
+        db_poster = self.db_poster
+        if not db_poster.isupdate:
+            return None
+        if not db_poster.has_cypher:
+            logging.info("No cypher key, the existing relationships of updated records are fetched one record at a time.")
+            return None
+        record_snapshot = snapshot.Snapshot(db_poster)
+        try:
+            with self.metrics.phase("prefetch_records"):
+                record_snapshot.load_book(book_data)
+        except transport.TransportError as transport_error:
+            logging.warning("Unable to prefetch the existing records, fetch them one by one: %s" % transport_error)
+            return None
+        self.metrics.add_rows("prefetch_records", len(record_snapshot))
+        return record_snapshot
+
+    def save_submission(self, book_data):
+        """Save the submission, unless the journal says it is already saved."""
+        if self.journal is not None and self.journal.submission_saved:
+            logging.info("Submission has already been saved, skip it.")
+            return
+        with self.metrics.phase("save_submission"):
+            saved = self.db_poster.save_submission(book_data)
+        if saved and self.journal is not None:
+            self.journal.log_submission()
+
+    def _submit_row(self, book_data, row_tuple):
+        """Submit/update the record, track which record has been submitted or updated, and assign system accession to the submitted record."""
+        sheet_name, row, record = row_tuple
+        user_accession = record.schema["user_accession"]
+        if self.journal is not None:
+            entry = self.journal.get_record(sheet_name, row, user_accession)
+            if entry is not None:  # done by the crashed run, restore it.
+                record.schema["accession"] = entry["accession"]
+                record.submission(entry["submission"])
+                logging.info("record %s in %s has been %s as %s, skip it." % (user_accession, sheet_name, entry["submission"], entry["accession"]))
+                book_data.index_record(record)
+                return
+        if self.planner is not None and self.planner.is_unchanged(sheet_name, row):
+            record.submission("unchanged")
+            logging.info("record %s %s in %s is the same as in the database, skip it." % (record.schema["accession"], user_accession, sheet_name))
+            book_data.index_record(record)
+            return
+        fields = self.planner.get_fields(sheet_name, row) if self.planner is not None else None
+        self.db_poster.submit_record(record, fields)
+        book_data.index_record(record)
+        if self.journal is not None and record.submission() in ("submitted", "updated"):
+            self.journal.log_record(sheet_name, row, user_accession, record)
+
+    def _report_unresolved(self, record, unresolved):
+        """Add the links of a record to records without a system accession to the failed links, they are not posted."""
+        if record.submission() in ("submitted", "updated", "unchanged"):
+            sheet_name = record.sheet_name
+            system_accession = record.schema["accession"]
+            for linkto_category, accession in unresolved:
+                error = "%s in %s has not been submitted." % (accession, linkto_category)
+                self.db_poster.failed_links.append((sheet_name, system_accession, [accession], error))
+                logging.error("Unable to link %s in %s to %s in %s, it has not been submitted!" % (system_accession, sheet_name, accession, linkto_category))
+
+    def run(self, action, records):
+        """Call action on every record, at most self.workers at the same time. Keep the order of records if workers is 1."""
+        if self.workers == 1:
+            for record in records:
+                action(record)
+            return
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(action, record) for record in records]
+            for future in futures:
+                future.result()  # raise the error from the worker thread, if any.
@@ -0,0 +1,116 @@
+import time
+import random
+import logging
+import requests
+import requests.adapters
+import urllib3.exceptions
+
+import metrics
+
+TIMEOUT = 60
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+NOT_PROCESSED_STATUS_CODES = (429, 503)  # the server did not process the request, safe to retry even if it is not idempotent.
+
+
+class Transport:
+    def __init__(self, pool_connections=10, pool_maxsize=10, retries=3, backoff=0.5, max_backoff=30, timeout=TIMEOUT, run_metrics=None):
+        """
+        One keep-alive session shared by MetaStructure and Poster.
+
+        :param: pool_connections - the number of hosts to keep connection pools for.
+        :param: pool_maxsize - the max number of connections kept alive per host. Should be at least the number of threads posting records.
+        :param: retries - how many times a request is retried after a connection error, a timeout or a status code in RETRY_STATUS_CODES.
+        A request which is not idempotent is only retried if it never reached the server, see request.
+        :param: backoff - the base delay in seconds. The n-th retry waits a random time between 0 and backoff * 2 ** (n - 1) seconds.
+        :param: max_backoff - the max delay in seconds between two retries.
+        :param: timeout - the default time budget in seconds of a call, shared by all its retries.
+        :param: run_metrics - the metrics.Metrics obj recording every request. A new one is created if it is None.
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.metrics = run_metrics if run_metrics is not None else metrics.Metrics()
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, headers=None, timeout=None):
+        return self.request("GET", url, headers=headers, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None, idempotent=True):
+        return self.request("POST", url, headers=headers, data=data, timeout=timeout, idempotent=idempotent)
+
+    def request(self, method, url, headers=None, data=None, timeout=None, idempotent=True):
+        """
+        Send a request and return the decoded json response.
+
+        Retry with exponential backoff and jitter until self.retries or the time budget runs out.
+        :param: idempotent - False for a request which must not be done twice, e.g. creating a record. It is only retried
+        if the connection could not be made or the server answered with a status code in NOT_PROCESSED_STATUS_CODES,
+        never after a timeout or another error, when the server may have processed it already.
+        :raise: TransportError if the request failed.
+        """
+        budget = timeout if timeout is not None else self.timeout
+        deadline = time.monotonic() + budget
+        attempt = 0
+        while True:
+            remaining = max(deadline - time.monotonic(), 0.1)
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, headers=headers, data=data, timeout=remaining)
+                self._record(method, url, start, r)
+                if r.status_code not in (RETRY_STATUS_CODES if idempotent else NOT_PROCESSED_STATUS_CODES):
+                    r.raise_for_status()
+                    return r.json()
+                error = "Http Error: %s %s for url: %s" % (r.status_code, r.reason, url)
+            except requests.exceptions.HTTPError as errh:  # status codes not worth to retry, such as 400 or 404.
+                logging.error(errh.response.content)
+                raise TransportError("Http Error: %s" % errh)
+            except requests.exceptions.ConnectionError as errc:
+                self._record(method, url, start)
+                error = "Error Connecting: %s" % errc
+                if not idempotent and not _is_not_sent(errc):
+                    raise TransportError(error)
+            except requests.exceptions.Timeout as errt:
+                self._record(method, url, start)
+                error = "Timeout Error: %s" % errt
+                if not idempotent:
+                    raise TransportError(error)
+            except requests.exceptions.RequestException as err:
+                self._record(method, url, start)
+                raise TransportError(err)
+            except ValueError as err:  # the response is not a json.
+                raise TransportError("Invalid json response from %s: %s" % (url, err))
+
+            attempt += 1
+            delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+            if attempt > self.retries or time.monotonic() + delay >= deadline:
+                raise TransportError(error)
+            logging.warning("%s, retry %d of %d in %.1f seconds." % (error, attempt, self.retries, delay))
+            time.sleep(delay)
+
+    def _record(self, method, url, start, response=None):
+        """Add a finished attempt to self.metrics, without a response if the connection failed."""
+        seconds = time.perf_counter() - start
+        if response is None:
+            self.metrics.record_request(method, url, seconds, 0, 0, "error")
+            return
+        body = response.request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.metrics.record_request(method, url, seconds, len(body), len(response.content), response.status_code)
+
+
+def _is_not_sent(connection_error):
+    """If the request of a requests ConnectionError never reached the server: the connection could not be made or timed out."""
+    if isinstance(connection_error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(connection_error.args[0], "reason", None) if connection_error.args else None
+    return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+
+
+class TransportError(Exception):
+    """A request failed after all the retries."""
+    pass
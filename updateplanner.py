@@ -0,0 +1,122 @@
+import re
+import logging
+import collections
+
+DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}")
+NUMBER_TYPES = frozenset(["number", "float", "textnumber"])
+
+# Why a row is posted or skipped, in the order of the summary.
+CHANGED = "changed"
+UNCHANGED = "unchanged"
+NOT_FOUND = "not found in the database"
+NO_ACCESSION = "without a system accession"
+
+
+def normalize(value, data_type):
+    """
+    Return the value in a form comparable between the excel file and the database.
+
+    Numbers of number columns as floats, so 1, 1.0 and "1.00" are the same. Dates as yyyy-mm-dd, without the time the database may add.
+    Everything else as text without surrounding spaces. Text columns are never compared as numbers, "007" is not "7".
+    """
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    if data_type in NUMBER_TYPES:
+        try:
+            return float(value)
+        except (TypeError, ValueError):  # "NA" in a textnumber column.
+            pass
+    text = str(value).strip()
+    if data_type == "date":
+        match = DATE_PATTERN.match(text)
+        if match:
+            return match.group(0)
+    return text
+
+
+class UpdatePlanner:
+    def __init__(self, meta_structure, record_snapshot, changed_fields_only=False):
+        """
+        Decide which rows of an update are posted, by comparing the fields of every row with its record in the database.
+
+        A row is only posted if a field differs after normalize. The other rows are marked "unchanged" by submitter.Submitter
+        and never posted, their relationships are still compared and written by linkwriter.LinkWriter.
+        :param: meta_structure - the MetaStructure obj.
+        :param: record_snapshot - a loaded snapshot.Snapshot obj with the records to be updated.
+        :param: changed_fields_only - post only the changed fields of a row, instead of all the fields in the excel file.
+        """
+        self.meta_structure = meta_structure
+        self.snapshot = record_snapshot
+        self.changed_fields_only = changed_fields_only
+        self.plans = dict()  # (sheet_name, row) -> (reason, a list of changed field names)
+        self.reasons = collections.Counter()
+        self.field_changes = collections.Counter()  # (sheet_name, field name) -> number of changed rows
+        self._data_types = dict()  # sheet_name -> {field name: data type}
+
+    def plan_book(self, book_data):
+        """Compare all the rows of book_data, the rows are numbered the same as linkgraph.LinkGraph. Returns self."""
+        for sheet_name, sheet_data in book_data.data.items():
+            for row, record in enumerate(sheet_data.all_records):
+                reason, fields = self.compare(record)
+                self.set_plan(sheet_name, row, reason, fields)
+        return self
+
+    def set_plan(self, sheet_name, row, reason, fields):
+        """Set the plan of a row, e.g. the one saved by plan.Plan instead of comparing it again."""
+        self.plans[(sheet_name, row)] = (reason, fields)
+        self.reasons[reason] += 1
+        for field in fields:
+            self.field_changes[(sheet_name, field)] += 1
+
+    def compare(self, record):
+        """Returns (reason, a list of the changed field names) of a row. The fields are only compared if the record is in the snapshot."""
+        sheet_name = record.sheet_name
+        system_accession = record.schema.get("accession", "")
+        if system_accession == "":
+            return NO_ACCESSION, []
+        existing_record = self.snapshot.get(sheet_name, system_accession)
+        if existing_record is None:
+            return NOT_FOUND, []
+        data_types = self.get_data_types(sheet_name)
+        existing_schema = existing_record.schema
+        changed = []
+        for field, value in record.schema.items():
+            if field == "accession":  # the address of the update request, not a posted field.
+                continue
+            data_type = data_types.get(field)
+            if normalize(value, data_type) != normalize(existing_schema.get(field), data_type):
+                changed.append(field)
+        return (CHANGED if changed else UNCHANGED), changed
+
+    def get_data_types(self, sheet_name):
+        data_types = self._data_types.get(sheet_name)
+        if data_types is None:
+            data_types = {x["name"]: x["type"] for x in self.meta_structure.get_sheet_schema(sheet_name)}
+            self._data_types[sheet_name] = data_types
+        return data_types
+
+    def is_unchanged(self, sheet_name, row):
+        """If the row is the same as its record in the database, so it is not posted."""
+        plan = self.plans.get((sheet_name, row))
+        return plan is not None and plan[0] == UNCHANGED
+
+    def get_fields(self, sheet_name, row):
+        """Return the names of the fields to post with changed_fields_only, None to post all of them."""
+        plan = self.plans.get((sheet_name, row))
+        if not self.changed_fields_only or plan is None or plan[0] != CHANGED:
+            return None
+        return plan[1]
+
+    def log_summary(self):
+        """Log how many rows are posted and skipped, and why."""
+        reasons = self.reasons
+        logging.info("Update plan of %d rows: %d changed, %d unchanged and skipped, %d not found in the database, %d without a system accession and skipped."
+                     % (sum(reasons.values()), reasons[CHANGED], reasons[UNCHANGED], reasons[NOT_FOUND], reasons[NO_ACCESSION]))
+        if reasons[NOT_FOUND]:
+            logging.warning("%d rows are not found in the database, they are posted without comparison." % reasons[NOT_FOUND])
+        for (sheet_name, field), count in sorted(self.field_changes.items()):
+            logging.info("%s in %s changed in %d rows." % (field, sheet_name, count))
+        if self.changed_fields_only and reasons[CHANGED]:
+            logging.info("Only the changed fields of the %d changed rows are posted." % reasons[CHANGED])
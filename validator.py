@@ -2,6 +2,8 @@ import pprint
 import logging
 import xlrd
 import re
+import functools
+import collections
 import sheetreader
 
 CTYPE_NUMBER = 2
@@ -36,7 +38,7 @@ class Validator:
             for column_header in unknown_columns:
                 logging.warning("warning! The database does not know what is column %s in %s. Please update your excel file to the latest version." % (column_header, sheet_name))
 
-    def duplication_check(self, poster, sheet_data):
+    def duplication_check(self, poster, sheet_data, all_errors=False):
         """
         Make sure all the system accessions and user accessions are unique in the sheet. (except user_accession=="NA-web")
 
@@ -48,21 +50,24 @@ class Validator:
 
         In the end, for records exist in database, both system and user accession must exist in the record;
         fo new records, only user accession in the record, system accession is ""
+        :param: all_errors - log every accession error of the sheet and raise one ValidatorError in the end, instead of raising the first one.
         """
 
         sheet_name = sheet_data.name
-        existing_sheet_data = poster.fetch_all(sheet_name)
-        existing_sheet_data_uniq = [x for x in existing_sheet_data if x["user_accession"] != "NA-web"]  # python2.7+, remove NA-web so I can get a list with uniq user_accessions.
-        existing_user_accessions = [x['user_accession'] for x in existing_sheet_data_uniq]
-        if len(existing_user_accessions) != len(set(existing_user_accessions)):
-            raise ValidatorError("redundant user accession exists in the %s, please contact dcc to fix the issue!" % sheet_name)
-            # sys.exit("redundant user accession exists in the %s, please contact dcc to fix the issue!" % sheet_name)
-        existing_user_system_accession_pair = {x["user_accession"]: x["accession"] for x in existing_sheet_data_uniq}  # python2.7+
-        existing_system_accessions = existing_user_system_accession_pair.values()
-        # FIMXE user_accessions_in_sheet = Set(...)
-        # system_accessions_in_sheet = Set(...)
-        user_accession_list = []
-        system_accession_list = []
+        existing_sheet_data = poster.fetch_user_accession(sheet_name)
+        # remove NA-web so I can get uniq user_accessions, then index the accessions both ways:
+        existing_user_system_accession_pair = dict()
+        existing_system_user_accession_pair = dict()
+        for x in existing_sheet_data:
+            if x["user_accession"] == "NA-web":
+                continue
+            if x["user_accession"] in existing_user_system_accession_pair:
+                raise ValidatorError("redundant user accession exists in the %s, please contact dcc to fix the issue!" % sheet_name)
+            existing_user_system_accession_pair[x["user_accession"]] = x["accession"]
+            existing_system_user_accession_pair.setdefault(x["accession"], x["user_accession"])
+        user_accession_set = set()
+        system_accession_set = set()
+        errors = [] if all_errors else None
         for record in sheet_data.all_records:
             accession = record.schema["accession"]
             user_accession = record.schema["user_accession"]
@@ -74,39 +79,120 @@ class Validator:
             """
             if user_accession != "" and accession != "":
                 if user_accession == "NA-web":  # add the system accession to the list and no more validation if it is NA-web.
-                    system_accession_list.append(accession)
+                    system_accession_set.add(accession)
                 else:
-                    if user_accession in existing_user_accessions and existing_user_system_accession_pair[user_accession] == accession:
-                        if user_accession not in user_accession_list and accession not in system_accession_list:
-                            user_accession_list.append(user_accession)
-                            system_accession_list.append(accession)
+                    if existing_user_system_accession_pair.get(user_accession) == accession:
+                        if user_accession not in user_accession_set and accession not in system_accession_set:
+                            user_accession_set.add(user_accession)
+                            system_accession_set.add(accession)
                         else:
-                            raise ValidatorError("redundant accession %s or %s in %s!" % (user_accession, accession, sheet_name))
-                            # sys.exit("redundant accession %s or %s in %s!" % (user_accession, accession, sheet_name))
+                            self._accession_error(errors, "redundant accession %s or %s in %s!" % (user_accession, accession, sheet_name))
                     else:
-                        raise ValidatorError("accession %s or %s in %s does not match our database record!" % (user_accession, accession, sheet_name))
+                        self._accession_error(errors, "accession %s or %s in %s does not match our database record!" % (user_accession, accession, sheet_name))
             elif user_accession == "" and accession != "":
-                if accession in system_accession_list:
-                    raise ValidatorError("System accession %s in %s in invalid. It is a redundant accession in the worksheet." % (accession, sheet_name))
-                elif accession not in existing_system_accessions:
-                    raise ValidatorError("System accession %s in %s in invalid. It does not exist in the database." % (accession, sheet_name))
+                if accession in system_accession_set:
+                    self._accession_error(errors, "System accession %s in %s in invalid. It is a redundant accession in the worksheet." % (accession, sheet_name))
+                elif accession not in existing_system_user_accession_pair:
+                    self._accession_error(errors, "System accession %s in %s in invalid. It does not exist in the database." % (accession, sheet_name))
                 else:
-                    matching_user_accession = [k for k, v in existing_user_system_accession_pair.items() if v == accession][0]
+                    matching_user_accession = existing_system_user_accession_pair[accession]
                     record.schema["user_accession"] = matching_user_accession
-                    user_accession_list.append(matching_user_accession)
-                    system_accession_list.append(accession)
+                    user_accession_set.add(matching_user_accession)
+                    system_accession_set.add(accession)
             elif user_accession != "" and accession == "":
-                if user_accession in user_accession_list:
-                    raise ValidatorError("User accession %s in %s in invalid. It is a redundant accesion in the worksheet." % (user_accession, sheet_name))
-                elif user_accession in existing_user_accessions:
+                if user_accession in user_accession_set:
+                    self._accession_error(errors, "User accession %s in %s in invalid. It is a redundant accesion in the worksheet." % (user_accession, sheet_name))
+                elif user_accession in existing_user_system_accession_pair:
                     matching_accession = existing_user_system_accession_pair[user_accession]
                     record.schema["accession"] = matching_accession
-                    user_accession_list.append(user_accession)
-                    system_accession_list.append(matching_accession)
+                    user_accession_set.add(user_accession)
+                    system_accession_set.add(matching_accession)
                 else:
-                    user_accession_list.append(user_accession)
+                    user_accession_set.add(user_accession)
             else:
-                raise ValidatorError("Unexpected validation error")
+                self._accession_error(errors, "Unexpected validation error")
+        self._raise_accession_errors(errors, sheet_name)
+
+    def local_duplication_check(self, sheet_data, all_errors=False):
+        """
+        The part of duplication_check without the database: the user accessions (except "NA-web") and the system accessions are unique in the worksheet.
+
+        Used by the offline validation without an accession index.
+        :param: all_errors - same as duplication_check.
+        """
+        sheet_name = sheet_data.name
+        user_accession_set = set()
+        system_accession_set = set()
+        errors = [] if all_errors else None
+        for record in sheet_data.all_records:
+            accession = record.schema["accession"]
+            user_accession = record.schema["user_accession"]
+            if user_accession != "" and user_accession != "NA-web":
+                if user_accession in user_accession_set:
+                    self._accession_error(errors, "User accession %s in %s in invalid. It is a redundant accesion in the worksheet." % (user_accession, sheet_name))
+                user_accession_set.add(user_accession)
+            if accession != "":
+                if accession in system_accession_set:
+                    self._accession_error(errors, "System accession %s in %s in invalid. It is a redundant accession in the worksheet." % (accession, sheet_name))
+                system_accession_set.add(accession)
+        self._raise_accession_errors(errors, sheet_name)
+
+    def _accession_error(self, errors, message):
+        """Raise ValidatorError of message, or with all_errors log it and add it to errors, the list of all the errors of the sheet."""
+        if errors is None:
+            raise ValidatorError(message)
+        logging.error(message)
+        errors.append(message)
+
+    def _raise_accession_errors(self, errors, sheet_name):
+        if errors:
+            raise ValidatorError("%d accession errors in %s." % (len(errors), sheet_name))
+
+    def link_check(self, book_data, accession_index=None):
+        """
+        Make sure every accession in the relationships can be linked, without posting anything.
+
+        An accession is fine if it is a user or system accession of a record of the linked category in the workbook.
+        Otherwise it must follow the system or user accession rule of the linked category, and with an accession_index.AccessionIndex,
+        it must also be in the database, a user accession must be one of the user's records.
+        Without the index, user accessions not in the workbook are only warned about.
+        :return: False if any accession can not be linked, every one of them is logged.
+        """
+        meta_structure = self.meta_structure
+        workbook_accessions = dict()  # category -> set of the user and system accessions in the workbook.
+        for sheet_name, sheet_data in book_data.data.items():
+            accessions = workbook_accessions.setdefault(meta_structure.get_category(sheet_name), set())
+            for record in sheet_data.all_records:
+                accessions.add(record.schema.get("user_accession", ""))
+                accessions.add(record.schema.get("accession", ""))
+        rules = dict()  # category -> (system accession rule, user accession rule)
+        valid = True
+        for sheet_name, sheet_data in book_data.data.items():
+            for record in sheet_data.all_records:
+                for column_name, linkto in record.relationships.items():
+                    for linkto_category, accession_list in linkto.items():
+                        accessions = workbook_accessions.get(linkto_category, ())
+                        if linkto_category not in rules:
+                            linkto_sheet_name = meta_structure.category_to_sheet_name[linkto_category]
+                            rules[linkto_category] = (meta_structure.get_system_accession_rule(linkto_sheet_name), meta_structure.get_user_accession_rule(linkto_sheet_name))
+                        system_accession_rule, user_accession_rule = rules[linkto_category]
+                        for accession in accession_list:
+                            if accession == "" or accession in accessions:
+                                continue
+                            if accession.startswith(system_accession_rule):
+                                if accession_index is not None and not accession_index.has_system_accession(linkto_category, accession):
+                                    logging.error("%s of %s in %s links to %s, which is not a %s in the workbook or the database." % (column_name, record.schema["user_accession"] or record.schema["accession"], sheet_name, accession, linkto_category))
+                                    valid = False
+                            elif accession.startswith(user_accession_rule):
+                                if accession_index is None:
+                                    logging.warning("%s of %s in %s links to %s, which is not a %s in the workbook. It must be your record in the database." % (column_name, record.schema["user_accession"] or record.schema["accession"], sheet_name, accession, linkto_category))
+                                elif not accession_index.has_user_accession(linkto_category, accession):
+                                    logging.error("%s of %s in %s links to %s, which is not a %s in the workbook or your records in the database." % (column_name, record.schema["user_accession"] or record.schema["accession"], sheet_name, accession, linkto_category))
+                                    valid = False
+                            else:
+                                logging.error("%s of %s in %s links to %s, which is not an accession of %s." % (column_name, record.schema["user_accession"] or record.schema["accession"], sheet_name, accession, linkto_category))
+                                valid = False
+        return valid
 
     def cell_value_audit(self, sheet_name, column_header, cell_obj, datemode):
         """
@@ -120,59 +206,46 @@ class Validator:
         "" in text become "NA"
         all float value round to 2 digits.
         """
-        value = cell_obj.value
-        ctype = cell_obj.ctype
-        # Now begin validation:
+        column_audit = self.get_column_batch_audit(sheet_name, column_header)
+        values, problems = column_audit([cell_obj.value], [cell_obj.ctype], datemode)
+        for row_offset, level, message in problems:
+            if level >= logging.ERROR:
+                raise ValidatorError(message)
+            logging.log(level, message)
+        return values[0]
 
+    def get_column_batch_audit(self, sheet_name, column_header):
+        """
+        Validate all the cells of a column in one call, with the same rules and results as cell_value_audit on every cell.
+
+        The rules of the column are looked up once, and the whole column is converted in one loop for its data type.
+        The errors are collected instead of raised, so one pass finds every error in the column.
+        A cell with an error keeps its value, same as SheetReader.read_sheet did with one cell at a time.
+        :return: a function(values, ctypes, datemode) returns (validated values, problems).
+        problems is a list of (row_offset, logging level, message) in the order of the rows, and of the checks within a row.
+        """
         # change accessions from "NA" to "":
         if column_header == "User accession" or column_header == "System Accession":
-            value = "" if value == "NA" else value
+            return _audit_accession_column
 
         # Validate other fields:
-        else:
-            column_schema = self.meta_structure.get_column_dict(sheet_name, column_header)
-            data_type = column_schema['type']
-            required = column_schema['required']
-            if required and value == "":
-                raise ValidatorError("column %s in %s is a required!" % (column_header, sheet_name))
-
-            elif ctype == CTYPE_BOOLEAN:
-                if value:
-                    value = "TRUE"
-                else:
-                    value = "FALSE"
-            # now consider data_type:
-            elif data_type == "text":
-                if ctype == CTYPE_NUMBER:
-                    if "(include units)" in column_header:
-                        raise ValidatorError("please include units for %s in %s" % (column_header, sheet_name))
-                    else:
-                        value = str(value).rstrip('0').rstrip('.')  # delete trailing 0s if it is a number.
-                elif value == "":
-                    value = "NA"
-            elif data_type == "date":
-                if value == "NA" or value == "":
-                    value = '1970-01-01'
-                elif ctype == CTYPE_DATE:
-                    value = xlrd.xldate.xldate_as_datetime(value, datemode).date().isoformat()
-            elif data_type == "number" or data_type == "float":
-                if ctype == CTYPE_NUMBER:
-                    value = round(value, 2)
-                elif value == "NA" or value == "":  # assign number field to -1 if it is NA in the excel.
-                    value = -1
-                    logging.debug("Change NA to -1 for %s in %s." % (column_header, sheet_name))
-                else:
-                    raise ValidatorError("please use number for %s in %s" % (column_header, sheet_name))
-            elif data_type == "textnumber":
-                if ctype == CTYPE_NUMBER:
-                    value = round(value, 2)
-                elif value == "":
-                    value = "NA"
-            if "values_restricted" in column_schema and column_schema["values_restricted"] and value not in column_schema["values"]:
-                raise ValidatorError("%s in column %s in %s is not from the provided list: %s!" % (value, column_header, sheet_name, column_schema["values"]))
-            # if column_header in self.meta_structure.get_link_column_headers(sheet_name) and (not ("allow_multiple" in column_schema and column_schema["allow_multiple"])) and re.search(',',value):
-                # raise ValidatorError("relationship column %s in %s does not allow multiple connection!" % (column_header, sheet_name))
-        return value
+        column_schema = self.meta_structure.get_column_dict(sheet_name, column_header)
+        restricted = "values_restricted" in column_schema and column_schema["values_restricted"]
+        allowed_values = column_schema["values"] if restricted else None
+        if restricted:
+            try:
+                allowed_values = frozenset(allowed_values)
+            except TypeError:  # not a list of strings, compare with the list itself.
+                pass
+        rule = ColumnRule(sheet_name=sheet_name,
+                          column_header=column_header,
+                          required=column_schema['required'],
+                          include_units="(include units)" in column_header,
+                          allowed_values=allowed_values,
+                          values=column_schema["values"] if restricted else None
+                          )
+        type_audit = TYPE_AUDITS.get(column_schema['type'], _audit_other_column)
+        return functools.partial(_audit_column, type_audit, rule)
 
     def row_value_audit(self, row_data):
         """
@@ -287,6 +360,129 @@ class Validator:
         return valid
 
 
+# The rules of a database column, see Validator.get_column_batch_audit. allowed_values is None if the values are not restricted.
+ColumnRule = collections.namedtuple("ColumnRule", ["sheet_name", "column_header", "required", "include_units", "allowed_values", "values"])
+
+
+def _audit_accession_column(values, ctypes, datemode):
+    return ["" if value == "NA" else value for value in values], []
+
+
+def _audit_column(type_audit, rule, values, ctypes, datemode):
+    """
+    Validate a column in three passes: the required cells, the data type of every cell with type_audit, then the restricted values.
+
+    A cell with an error is skipped by the later passes.
+    """
+    problems = []
+    failed = set()  # the row offsets with an error.
+    if rule.required:
+        for row_offset, value in enumerate(values):
+            if value == "":
+                _column_error(problems, failed, row_offset, "column %s in %s is a required!" % (rule.column_header, rule.sheet_name))
+    results = type_audit(rule, values, ctypes, datemode, problems, failed)
+    if rule.allowed_values is not None:
+        allowed_values = rule.allowed_values
+        for row_offset, value in enumerate(results):
+            if value not in allowed_values and row_offset not in failed:
+                _column_error(problems, failed, row_offset, "%s in column %s in %s is not from the provided list: %s!" % (value, rule.column_header, rule.sheet_name, rule.values))
+                results[row_offset] = values[row_offset]  # an invalid cell keeps the value in the excel file.
+    problems.sort(key=lambda x: x[0])  # stable, the problems of a row stay in the order of the passes.
+    return results, problems
+
+
+def _column_error(problems, failed, row_offset, message):
+    problems.append((row_offset, logging.ERROR, ValidatorError(message)))
+    failed.add(row_offset)
+
+
+def _audit_text_column(rule, values, ctypes, datemode, problems, failed):
+    results = []
+    for row_offset, (value, ctype) in enumerate(zip(values, ctypes)):
+        if failed and row_offset in failed:
+            pass
+        elif ctype == CTYPE_BOOLEAN:
+            value = "TRUE" if value else "FALSE"
+        elif ctype == CTYPE_NUMBER:
+            if rule.include_units:
+                _column_error(problems, failed, row_offset, "please include units for %s in %s" % (rule.column_header, rule.sheet_name))
+            else:
+                value = str(value).rstrip('0').rstrip('.')  # delete trailing 0s if it is a number.
+        elif value == "":
+            value = "NA"
+        results.append(value)
+    return results
+
+
+def _audit_date_column(rule, values, ctypes, datemode, problems, failed):
+    results = []
+    dates = dict()  # date serial number -> iso date, a column repeats the same few dates.
+    for row_offset, (value, ctype) in enumerate(zip(values, ctypes)):
+        if failed and row_offset in failed:
+            pass
+        elif ctype == CTYPE_BOOLEAN:
+            value = "TRUE" if value else "FALSE"
+        elif value == "NA" or value == "":
+            value = '1970-01-01'
+        elif ctype == CTYPE_DATE:
+            date = dates.get(value)
+            if date is None:
+                date = dates[value] = xlrd.xldate.xldate_as_datetime(value, datemode).date().isoformat()
+            value = date
+        results.append(value)
+    return results
+
+
+def _audit_number_column(rule, values, ctypes, datemode, problems, failed):
+    results = []
+    for row_offset, (value, ctype) in enumerate(zip(values, ctypes)):
+        if failed and row_offset in failed:
+            pass
+        elif ctype == CTYPE_BOOLEAN:
+            value = "TRUE" if value else "FALSE"
+        elif ctype == CTYPE_NUMBER:
+            value = round(value, 2)
+        elif value == "NA" or value == "":  # assign number field to -1 if it is NA in the excel.
+            value = -1
+            problems.append((row_offset, logging.DEBUG, "Change NA to -1 for %s in %s." % (rule.column_header, rule.sheet_name)))
+        else:
+            _column_error(problems, failed, row_offset, "please use number for %s in %s" % (rule.column_header, rule.sheet_name))
+        results.append(value)
+    return results
+
+
+def _audit_textnumber_column(rule, values, ctypes, datemode, problems, failed):
+    results = []
+    for row_offset, (value, ctype) in enumerate(zip(values, ctypes)):
+        if failed and row_offset in failed:
+            pass
+        elif ctype == CTYPE_BOOLEAN:
+            value = "TRUE" if value else "FALSE"
+        elif ctype == CTYPE_NUMBER:
+            value = round(value, 2)
+        elif value == "":
+            value = "NA"
+        results.append(value)
+    return results
+
+
+def _audit_other_column(rule, values, ctypes, datemode, problems, failed):
+    results = []
+    for row_offset, (value, ctype) in enumerate(zip(values, ctypes)):
+        if ctype == CTYPE_BOOLEAN and row_offset not in failed:
+            value = "TRUE" if value else "FALSE"
+        results.append(value)
+    return results
+
+
+TYPE_AUDITS = {"text": _audit_text_column,
+               "date": _audit_date_column,
+               "number": _audit_number_column,
+               "float": _audit_number_column,
+               "textnumber": _audit_textnumber_column
+               }
+
+
 class ValidatorError(Exception):
     """catch my validation errors"""
     pass
@@ -0,0 +1,310 @@
+import re
+import array
+import zipfile
+import datetime
+import posixpath
+import collections
+import xml.etree.ElementTree as ElementTree
+
+# cell types, the same as xlrd.
+XL_CELL_EMPTY = 0
+XL_CELL_TEXT = 1
+XL_CELL_NUMBER = 2
+XL_CELL_DATE = 3
+XL_CELL_BOOLEAN = 4
+XL_CELL_ERROR = 5
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+BUILTIN_DATE_FORMATS = set(range(14, 23)) | set(range(27, 37)) | {45, 46, 47} | set(range(50, 59))
+ISO_DATE_PATTERN = re.compile(r"^(?:(\d{4})-(\d{2})-(\d{2}))?T?(?:(\d{2}):(\d{2})(?::(\d{2}(?:\.\d*)?))?)?")
+EPOCHS = (datetime.datetime(1899, 12, 30), datetime.datetime(1904, 1, 1))  # day 0 of datemode 0 and 1.
+CHUNK_ROWS = 10000  # the rows of a worksheet parsed at a time when streaming, if no other chunk size is given.
+ERROR_CODES = {"#NULL!": 0x00, "#DIV/0!": 0x07, "#VALUE!": 0x0F, "#REF!": 0x17, "#NAME?": 0x1D, "#NUM!": 0x24, "#N/A": 0x2A}
+
+Cell = collections.namedtuple("Cell", ["ctype", "value"])
+
+
+class StreamingBook:
+    def __init__(self, file_name):
+        """
+        Read a .xlsx workbook one worksheet at a time, with iterparse over the xml in the zip file.
+
+        Only the workbook index, the shared strings and the styles are read when it is opened.
+        A worksheet is only parsed when it is asked for, so "Instructions" and "Lists" are never parsed.
+        It mimics the part of the xlrd Book and Sheet api used by SheetReader and Validator.
+        :param: file_name - the .xlsx file.
+        """
+        self.zip_file = zipfile.ZipFile(file_name)
+        self.datemode = 0
+        self._sheet_paths = collections.OrderedDict()  # sheet name -> path of the worksheet xml in the zip.
+        self._read_workbook()
+        self._shared_strings = None
+        self._date_styles = None
+
+    def sheet_names(self):
+        return list(self._sheet_paths.keys())
+
+    def sheet_by_name(self, sheet_name):
+        """Parse one worksheet and return a StreamingSheet. Nothing is kept in the book, so the sheet is freed once the caller drops it."""
+        return next(self.iter_chunks(sheet_name))
+
+    def iter_chunks(self, sheet_name, chunk_rows=None, start_rowx=0):
+        """
+        Parse a worksheet once and yield it in StreamingSheets of chunk_rows rows, so only one chunk of the cells is kept at a time.
+
+        Every chunk has the rows before start_rowx (the headers) too. The nrows of a chunk is where it ends, or the end of the worksheet for the last one,
+        so SheetReader.read_sheet(chunk, datemode, chunk.start_rowx) reads the same rows as from the whole worksheet.
+        At least one chunk is yielded, even without any row from start_rowx.
+        :param: chunk_rows - the number of rows of a chunk. None means a single chunk of all the rows from start_rowx.
+        :param: start_rowx - the first row of the first chunk.
+        """
+        head_rows = []
+        sheet = StreamingSheet(sheet_name, start_rowx)
+        for row_index, cells in self.iter_rows(sheet_name):
+            if row_index < start_rowx:
+                head_rows.append((row_index, cells))
+            while chunk_rows and row_index >= sheet.start_rowx + chunk_rows:  # also yields the empty chunks of a gap, same as the empty rows of a whole worksheet.
+                sheet.nrows = sheet.start_rowx + chunk_rows
+                yield sheet
+                sheet = StreamingSheet(sheet_name, sheet.start_rowx + chunk_rows)
+                for head_index, head_cells in head_rows:
+                    for col_index, ctype, value in head_cells:
+                        sheet.put_cell(head_index, col_index, ctype, value)
+            for col_index, ctype, value in cells:
+                sheet.put_cell(row_index, col_index, ctype, value)
+        yield sheet
+
+    def get_nrows(self, sheet_name):
+        """
+        Return the number of rows of a worksheet from its <dimension> element, without parsing the rows.
+
+        :return: the number of rows, or None if the worksheet has no dimension.
+        """
+        with self.zip_file.open(self._sheet_paths[sheet_name]) as sheet_file:
+            for event, elem in ElementTree.iterparse(sheet_file, events=("start",)):
+                if elem.tag == MAIN_NS + "dimension":
+                    last_cell = elem.get("ref", "").split(":")[-1]
+                    digits = last_cell.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+                    return int(digits) if digits.isdigit() else None
+                if elem.tag == MAIN_NS + "sheetData":
+                    return None
+        return None
+
+    def iter_rows(self, sheet_name):
+        """
+        Yield (row_index, [(col_index, ctype, value), ...]) for every row with a value in the worksheet, in constant memory.
+
+        Empty cells are not yielded. Indexes start from 0, same as xlrd.
+        """
+        if self._shared_strings is None:
+            self._shared_strings = self._read_shared_strings()
+            self._date_styles = self._read_date_styles()
+        shared_strings = self._shared_strings
+        date_styles = self._date_styles
+        next_row_index = 0
+        with self.zip_file.open(self._sheet_paths[sheet_name]) as sheet_file:
+            for event, elem in ElementTree.iterparse(sheet_file, events=("end",)):
+                if elem.tag != MAIN_NS + "row":
+                    continue
+                row_ref = elem.get("r")
+                row_index = int(row_ref) - 1 if row_ref else next_row_index
+                next_row_index = row_index + 1
+                cells = []
+                next_col_index = 0
+                for cell_elem in elem.iter(MAIN_NS + "c"):
+                    cell_ref = cell_elem.get("r")
+                    col_index = _column_index(cell_ref) if cell_ref else next_col_index
+                    next_col_index = col_index + 1
+                    cell = self._read_cell(cell_elem, shared_strings, date_styles)
+                    if cell is not None:
+                        cells.append((col_index, cell.ctype, cell.value))
+                elem.clear()  # drop the parsed row, keep the memory constant.
+                if cells:
+                    yield row_index, cells
+
+    def release_resources(self):
+        self.zip_file.close()
+
+    def _read_cell(self, cell_elem, shared_strings, date_styles):
+        cell_type = cell_elem.get("t", "n")
+        if cell_type == "inlineStr":
+            inline = cell_elem.find(MAIN_NS + "is")
+            return Cell(XL_CELL_TEXT, _text(inline)) if inline is not None else None
+        value_elem = cell_elem.find(MAIN_NS + "v")
+        if value_elem is None or value_elem.text is None:
+            return None  # a blank cell with formatting only.
+        text = value_elem.text
+        if cell_type == "s":
+            return Cell(XL_CELL_TEXT, shared_strings[int(text)])
+        if cell_type == "str":
+            return Cell(XL_CELL_TEXT, text)
+        if cell_type == "b":
+            return Cell(XL_CELL_BOOLEAN, int(text))
+        if cell_type == "e":
+            return Cell(XL_CELL_ERROR, ERROR_CODES.get(text, 0))
+        if cell_type == "d":  # an ISO 8601 date, written by some tools instead of a serial number with a date style.
+            try:
+                return Cell(XL_CELL_DATE, _date_serial(text, self.datemode))
+            except ValueError:
+                return Cell(XL_CELL_TEXT, text)  # not a date, the validator reports it in a date column.
+        if int(cell_elem.get("s", "0")) in date_styles:
+            return Cell(XL_CELL_DATE, float(text))
+        return Cell(XL_CELL_NUMBER, float(text))
+
+    def _read_workbook(self):
+        relationships = dict()
+        rels_path = "xl/_rels/workbook.xml.rels"
+        with self.zip_file.open(rels_path) as rels_file:
+            for rel in ElementTree.parse(rels_file).getroot().iter(PACKAGE_REL_NS + "Relationship"):
+                target = rel.get("Target")
+                if target.startswith("/"):
+                    target = target[1:]
+                else:
+                    target = posixpath.normpath(posixpath.join("xl", target))
+                relationships[rel.get("Id")] = target
+        with self.zip_file.open("xl/workbook.xml") as workbook_file:
+            root = ElementTree.parse(workbook_file).getroot()
+        workbook_pr = root.find(MAIN_NS + "workbookPr")
+        if workbook_pr is not None and workbook_pr.get("date1904", "0").lower() in ("1", "true"):
+            self.datemode = 1
+        for sheet in root.iter(MAIN_NS + "sheet"):
+            self._sheet_paths[sheet.get("name")] = relationships[sheet.get(REL_NS + "id")]
+
+    def _read_shared_strings(self):
+        shared_strings = []
+        if "xl/sharedStrings.xml" not in self.zip_file.namelist():
+            return shared_strings
+        with self.zip_file.open("xl/sharedStrings.xml") as strings_file:
+            for event, elem in ElementTree.iterparse(strings_file, events=("end",)):
+                if elem.tag == MAIN_NS + "si":
+                    shared_strings.append(_text(elem))
+                    elem.clear()
+        return shared_strings
+
+    def _read_date_styles(self):
+        """Return a set of the cell style indexes with a date number format."""
+        date_styles = set()
+        if "xl/styles.xml" not in self.zip_file.namelist():
+            return date_styles
+        with self.zip_file.open("xl/styles.xml") as styles_file:
+            root = ElementTree.parse(styles_file).getroot()
+        date_formats = set(BUILTIN_DATE_FORMATS)
+        num_fmts = root.find(MAIN_NS + "numFmts")
+        if num_fmts is not None:
+            for num_fmt in num_fmts.iter(MAIN_NS + "numFmt"):
+                if _is_date_format(num_fmt.get("formatCode", "")):
+                    date_formats.add(int(num_fmt.get("numFmtId")))
+        cell_xfs = root.find(MAIN_NS + "cellXfs")
+        if cell_xfs is not None:
+            for style_index, xf in enumerate(cell_xfs.iter(MAIN_NS + "xf")):
+                if int(xf.get("numFmtId", "0")) in date_formats:
+                    date_styles.add(style_index)
+        return date_styles
+
+
+class StreamingSheet:
+    def __init__(self, name, start_rowx=0):
+        """
+        One worksheet from StreamingBook, or a chunk of it, stored by column. Missing cells read as empty, same as xlrd.
+
+        :param: start_rowx - the first row of the chunk. The rows before it are the header rows, kept apart in a dict.
+        """
+        self.name = name
+        self.start_rowx = start_rowx
+        self.nrows = 0
+        self.ncols = 0
+        self._head = dict()  # (row_index, col_index) -> Cell of the rows before start_rowx.
+        self._values = dict()  # col_index -> list of values, indexed by row_index - start_rowx.
+        self._ctypes = dict()  # col_index -> array of ctypes, indexed by row_index - start_rowx.
+
+    def put_cell(self, row_index, col_index, ctype, value):
+        self.nrows = max(self.nrows, row_index + 1)
+        self.ncols = max(self.ncols, col_index + 1)
+        if row_index < self.start_rowx:
+            self._head[(row_index, col_index)] = Cell(ctype, value)
+            return
+        row_index -= self.start_rowx
+        if col_index not in self._values:
+            self._values[col_index] = []
+            self._ctypes[col_index] = array.array("b")
+        values = self._values[col_index]
+        ctypes = self._ctypes[col_index]
+        if len(values) <= row_index:
+            values.extend([""] * (row_index + 1 - len(values)))
+            ctypes.extend([XL_CELL_EMPTY] * (row_index + 1 - len(ctypes)))
+        values[row_index] = value
+        ctypes[row_index] = ctype
+
+    def cell(self, row_index, col_index):
+        if row_index < self.start_rowx:
+            return self._head.get((row_index, col_index), Cell(XL_CELL_EMPTY, ""))
+        return Cell(self._get(self._ctypes, row_index, col_index, XL_CELL_EMPTY), self._get(self._values, row_index, col_index, ""))
+
+    def row_values(self, row_index):
+        return [self.cell(row_index, col_index).value for col_index in range(self.ncols)]
+
+    def col_values(self, col_index, start_rowx=0, end_rowx=None):
+        return self._slice(self._values, "value", col_index, start_rowx, end_rowx, "")
+
+    def col_types(self, col_index, start_rowx=0, end_rowx=None):
+        return self._slice(self._ctypes, "ctype", col_index, start_rowx, end_rowx, XL_CELL_EMPTY)
+
+    def _get(self, columns, row_index, col_index, empty):
+        column = columns.get(col_index)
+        row_index -= self.start_rowx
+        if column is None or row_index >= len(column):
+            return empty
+        return column[row_index]
+
+    def _slice(self, columns, field, col_index, start_rowx, end_rowx, empty):
+        end_rowx = self.nrows if end_rowx is None else end_rowx
+        head = [getattr(self.cell(row_index, col_index), field) for row_index in range(start_rowx, min(end_rowx, self.start_rowx))]
+        start, end = max(start_rowx, self.start_rowx) - self.start_rowx, max(end_rowx - self.start_rowx, 0)
+        column = list(columns.get(col_index, [])[start:end])
+        column.extend([empty] * (end - start - len(column)))
+        return head + column if head else column
+
+
+def _text(elem):
+    """All the text in <t> of a shared string or inline string, rich text runs joined."""
+    return "".join(t.text or "" for t in elem.iter(MAIN_NS + "t"))
+
+
+def _column_index(cell_ref):
+    """"AB12" -> 27"""
+    col_index = 0
+    for char in cell_ref:
+        if not char.isalpha():
+            break
+        col_index = col_index * 26 + ord(char.upper()) - ord("A") + 1
+    return col_index - 1
+
+
+def _date_serial(text, datemode):
+    """
+    "2016-09-21T12:00:00" -> 42634.5, the serial number of an ISO 8601 date or time, as xlrd gives for a date cell.
+
+    A time without a date is a fraction of a day. Raises ValueError if it is not an ISO 8601 date.
+    """
+    match = ISO_DATE_PATTERN.match(text.strip())
+    if not match or not any(match.groups()):
+        raise ValueError("%s is not an ISO 8601 date" % text)
+    year, month, day, hour, minute, second = match.groups()
+    serial = (int(hour or 0) * 3600 + int(minute or 0) * 60 + float(second or 0)) / 86400
+    if year is not None:
+        serial += (datetime.datetime(int(year), int(month), int(day)) - EPOCHS[datemode]).days
+        if datemode == 0 and serial < 61:  # the day numbers before 1900-03-01 skip the 1900-02-29 of excel.
+            serial -= 1
+    return serial
+
+
+def _is_date_format(format_code):
+    """If a custom number format shows a date or time, in the same spirit as xlrd."""
+    format_code = re.sub(r'"[^"]*"|\[[^\]]*\]|\\.|_.|\*.', "", format_code)
+    format_code = format_code.split(";")[0].lower()
+    if format_code == "general":
+        return False
+    return any(char in format_code for char in "ymdhs")